@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CrmConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'CRM'
+
+    def ready(self):
+        # connects the signals bumping the versions of cached responses
+        from CRM import versions  # noqa: F401
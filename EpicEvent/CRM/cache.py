@@ -0,0 +1,89 @@
+import hashlib
+from rest_framework.response import Response
+from .conditional import (
+    normalized_query,
+    not_modified,
+    set_validators
+)
+from .metrics import response_cache_total
+from .permissions import visibility_scope
+from .versions import (
+    RESPONSE_CACHE,
+    VERSIONED_MODELS,
+    get_cache,
+    get_versions,
+    is_shared
+)
+
+
+def get_stats(endpoints, collected):
+    """
+    hits, misses and hit ratio of each (basename, action),
+    from the metrics collected from the workers
+    """
+    lookups = collected.get(response_cache_total.name, {})
+    stats = {}
+    for basename, action in endpoints:
+        hits = lookups.get((basename, action, "hits"), 0)
+        misses = lookups.get((basename, action, "misses"), 0)
+        ratio = hits / (hits + misses) if hits + misses else 0
+        stats[(basename, action)] = (hits, misses, ratio)
+    return stats
+
+
+class CachedResponseMixin:
+    """
+    caches the data and ETag of list and retrieve responses
+    key : viewset, action, row, sorted query string, visibility scope
+    of the caller and versions of cache_models, so a change of one
+    of these models makes the responses stale without scanning keys
+    only with a cache shared by the workers, see is_shared
+    """
+    cache_models = VERSIONED_MODELS
+    cached_actions = ("list", "retrieve")
+
+    def get_visibility_scope(self):
+        return visibility_scope(self.request.user)
+
+    def get_response_key(self):
+        parts = [
+            self.basename,
+            self.action,
+            str(self.kwargs.get("pk", "")),
+            normalized_query(self.request),
+            self.get_visibility_scope(),
+        ] + [str(version) for version in get_versions(self.cache_models)]
+        digest = hashlib.sha256("\n".join(parts).encode()).hexdigest()
+        return f"crm:response:{digest}"
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if (not RESPONSE_CACHE.get("ENABLED", False) or not is_shared()
+                or self.action not in self.cached_actions):
+            return handler(request, *args, **kwargs)
+        cache = get_cache()
+        key = self.get_response_key()
+        entry = cache.get(key)
+        if entry is not None:
+            response_cache_total.inc((self.basename, self.action, "hits"))
+            data, etag = entry
+            # the entry is current, so is its ETag
+            if etag is None:
+                return Response(data)
+            response = not_modified(request, etag)
+            if response is None:
+                response = Response(data)
+            return set_validators(response, etag)
+        response_cache_total.inc((self.basename, self.action, "misses"))
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            entry = (response.data, response.get("ETag"))
+            cache.set(key, entry, RESPONSE_CACHE.get("TIMEOUT", 300))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            super().retrieve, request, *args, **kwargs
+        )
@@ -0,0 +1,135 @@
+import hashlib
+import json
+from urllib.parse import urlencode
+from django.db.models import (
+    Count,
+    Max
+)
+from django.http import HttpResponseNotModified
+from django.utils.cache import get_conditional_response
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from .permissions import visibility_scope
+from .versions import (
+    VERSIONED_MODELS,
+    get_versions,
+    is_shared
+)
+
+
+def make_etag(*parts):
+    digest = hashlib.sha256(
+        "\n".join(str(part) for part in parts).encode()
+    ).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def normalized_query(request):
+    return urlencode(sorted(
+        (param, value)
+        for param, values in request.query_params.lists()
+        for value in values
+    ))
+
+
+def set_validators(response, etag):
+    response["ETag"] = etag
+    return response
+
+
+def not_modified(request, etag):
+    """
+    a 304 response if the ETag sent by the client still matches,
+    None otherwise
+    """
+    response = get_conditional_response(request, etag=etag)
+    if isinstance(response, HttpResponseNotModified):
+        return set_validators(response, etag)
+    return None
+
+
+def conditional_response(request, etag, get_response):
+    """
+    a 304 response if the ETag sent by the client still matches,
+    the response of get_response otherwise
+    without etag, the ETag is the digest of the data, compared
+    once serialized
+    """
+    if etag is not None:
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+    response = get_response()
+    if etag is None:
+        etag = make_etag(json.dumps(response.data, cls=JSONEncoder))
+        response = not_modified(request, etag) or response
+    return set_validators(response, etag)
+
+
+class ConditionalGetMixin:
+    """
+    ETag of list and detail responses, computed from date_updated,
+    a request whose ETag matches gets a 304 without anything
+    being serialized
+    the ETag of a list comes from MAX(date_updated) and COUNT
+    of the filtered rows, an aggregate read from the indexes
+    the ETag also holds the versions of etag_models, the related rows
+    printed by the serializers, and for a list the visibility scope
+    of the caller
+    the versions of a cache of the process (locmem) miss the changes
+    made by the other workers, the ETag is then the digest of the data
+    no Last-Modified: the dates of the rows miss the deleted rows
+    and the changes of the related rows
+    """
+    etag_models = VERSIONED_MODELS
+
+    def get_list_etag(self, queryset):
+        if not is_shared():
+            return None
+        aggregate = queryset.order_by().aggregate(
+            last_updated=Max("date_updated"), rows=Count("pk")
+        )
+        return make_etag(
+            self.basename,
+            normalized_query(self.request),
+            aggregate["rows"],
+            aggregate["last_updated"],
+            visibility_scope(self.request.user),
+            *get_versions(self.etag_models),
+        )
+
+    def get_detail_etag(self, instance):
+        if not is_shared():
+            return None
+        return make_etag(
+            self.basename,
+            instance.pk,
+            instance.date_updated,
+            *get_versions(self.etag_models),
+        )
+
+    def list_response(self, queryset):
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(
+                self.get_serializer(page, many=True).data
+            )
+        return Response(self.get_serializer(queryset, many=True).data)
+
+    def list(self, request, *args, **kwargs):
+        # as ListModelMixin.list, with the queryset filtered once
+        queryset = self.filter_queryset(self.get_queryset())
+        return conditional_response(
+            request,
+            self.get_list_etag(queryset),
+            lambda: self.list_response(queryset)
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        # the row is loaded once, with the permissions checked
+        instance = self.get_object()
+        return conditional_response(
+            request,
+            self.get_detail_etag(instance),
+            lambda: Response(self.get_serializer(instance).data)
+        )
@@ -0,0 +1,79 @@
+import csv
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import JSONRenderer
+
+# rows fetched from the server-side cursor at each round trip
+# and written to the response in one piece
+EXPORT_CHUNK_SIZE = 2000
+
+
+class CSVRenderer(JSONRenderer):
+    """
+    only used to select ?format=csv on export,
+    rows are streamed by the view, errors are still rendered as json
+    """
+    media_type = "text/csv"
+    format = "csv"
+
+
+class NDJSONRenderer(JSONRenderer):
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+
+class Echo:
+    """
+    file-like object for csv.writer, returns the line instead of storing it
+    """
+    @staticmethod
+    def write(value):
+        return value
+
+
+def iter_chunks(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    yields lists of rows as tuples, never holding more than one chunk
+    """
+    chunk = []
+    for row in queryset.values_list(*fields).iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def csv_lines(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for chunk in iter_chunks(queryset, fields, chunk_size):
+        yield "".join(writer.writerow(row) for row in chunk)
+
+
+def ndjson_lines(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    for chunk in iter_chunks(queryset, fields, chunk_size):
+        yield "".join(
+            json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder) + "\n"
+            for row in chunk
+        )
+
+
+EXPORT_FORMATS = {
+    "csv": (csv_lines, CSVRenderer.media_type),
+    "ndjson": (ndjson_lines, NDJSONRenderer.media_type),
+}
+
+
+def export_response(queryset, fields, export_format, filename):
+    lines, content_type = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(
+        lines(queryset, fields),
+        content_type=content_type
+    )
+    response["Content-Disposition"] = (
+        f'attachment; filename="{filename}.{export_format}"'
+    )
+    return response
@@ -0,0 +1,243 @@
+import functools
+from django.core.exceptions import (
+    FieldDoesNotExist,
+    ImproperlyConfigured,
+    ValidationError as DjangoValidationError
+)
+from django.db.models import Q
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.functions import Upper
+from rest_framework.exceptions import (
+    NotFound,
+    ValidationError
+)
+from rest_framework.settings import api_settings
+
+# lookups a btree index on the column can serve
+BTREE_LOOKUPS = {"exact", "in", "gt", "gte", "lt", "lte", "range", "isnull"}
+# lookups served by an index on UPPER(column)
+UPPER_LOOKUPS = {"iexact"}
+
+ORDERING_PARAM = api_settings.ORDERING_PARAM
+
+INEXISTENT_FIELDS = (
+    "Sorry, looks like you search for inexistent fields. "
+    "Please ensure you correctly entered searched fields."
+)
+
+
+def indexed_lookups(model):
+    """
+    for each column of model leading an index,
+    the lookups this index can serve
+    a partial index only serves its condition, e.g. status=True
+    """
+    lookups = {}
+
+    def add(field_name, supported):
+        lookups.setdefault(field_name, set()).update(supported)
+
+    for field in model._meta.concrete_fields:
+        if field.primary_key or field.unique or field.db_index:
+            add(field.name, BTREE_LOOKUPS)
+    for index in model._meta.indexes:
+        if index.condition is not None:
+            condition = index.condition
+            if condition.connector == Q.AND and not condition.negated:
+                for child in condition.children:
+                    if isinstance(child, tuple) and LOOKUP_SEP not in child[0]:
+                        add(child[0], {"exact"})
+            continue
+        if index.fields:
+            add(index.fields[0].lstrip("-"), BTREE_LOOKUPS)
+        elif index.expressions:
+            expression = index.expressions[0]
+            if isinstance(expression, Upper):
+                add(expression.source_expressions[0].name, UPPER_LOOKUPS)
+    return lookups
+
+
+def resolve_field(model, path):
+    """
+    follows the relations of path, e.g. contract__client,
+    and returns (model, field) of its last part
+    raises FieldDoesNotExist if one part isn't a field
+    """
+    names = path.split(LOOKUP_SEP)
+    for name in names[:-1]:
+        field = model._meta.get_field(name)
+        if not field.is_relation:
+            raise FieldDoesNotExist(f"{name} isn't a relation")
+        model = field.related_model
+    return model, model._meta.get_field(names[-1])
+
+
+class FilterSpec:
+    """
+    searchable fields of a viewset with their allowed lookups
+    and the fields results can be ordered on, e.g.
+    FilterSpec(
+        Client,
+        fields={"sales_contact": ("exact", "in")},
+        ordering=("date_created", "id")
+    )
+    every field and lookup must be served by an index,
+    this is checked when the spec is declared
+    """
+    def __init__(self, model, fields, ordering=("date_created", "id")):
+        self.model = model
+        self.fields = {
+            field: frozenset(lookups) for field, lookups in fields.items()
+        }
+        self.ordering = tuple(ordering)
+        for field, lookups in self.fields.items():
+            self.check_indexed(field, lookups)
+        for field in self.ordering:
+            self.check_indexed(field, {"exact"})
+
+    def check_indexed(self, path, lookups):
+        try:
+            model, field = resolve_field(self.model, path)
+        except FieldDoesNotExist as error:
+            raise ImproperlyConfigured(
+                f"{self.model.__name__} filter <{path}>: {error}"
+            )
+        unsupported = set(lookups) - indexed_lookups(model).get(
+            field.name, set()
+        )
+        if unsupported:
+            raise ImproperlyConfigured(
+                f"{self.model.__name__} filter <{path}>: "
+                f"no index serves {sorted(unsupported)}"
+            )
+
+    def is_model_field(self, param):
+        # param may end with a lookup, e.g. contract__event__notes__icontains
+        for path in (param, param.rpartition(LOOKUP_SEP)[0]):
+            try:
+                resolve_field(self.model, path)
+                return True
+            except FieldDoesNotExist:
+                continue
+        return False
+
+    def split(self, param):
+        """
+        returns (field, lookup) of a query parameter
+        e.g. date_created__gte gives (date_created, gte)
+        """
+        if param in self.fields:
+            return param, "exact"
+        field, _, lookup = param.rpartition(LOOKUP_SEP)
+        if field in self.fields:
+            return field, lookup
+        return param, "exact"
+
+    @functools.lru_cache(maxsize=512)
+    def compile(self, params):
+        """
+        filter plan of a sorted tuple of query parameters names:
+        a tuple of (parameter, orm lookup, lookup)
+        the plan only depends on the names so it's cached,
+        the values are bound on each request
+        """
+        plan = []
+        for param in params:
+            field, lookup = self.split(param)
+            if field not in self.fields:
+                if not self.is_model_field(field):
+                    raise NotFound(detail=INEXISTENT_FIELDS)
+                raise ValidationError(
+                    {param: f"Sorry, <{field}> isn't a searchable field."}
+                )
+            if lookup not in self.fields[field]:
+                raise ValidationError(
+                    {
+                        param:
+                            f"Sorry, <{lookup}> isn't available on "
+                            f"<{field}>. Available lookups : "
+                            f"{', '.join(sorted(self.fields[field]))}"
+                    }
+                )
+            plan.append((param, f"{field}{LOOKUP_SEP}{lookup}", lookup))
+        return tuple(plan)
+
+    @staticmethod
+    def bind(plan, query_params):
+        filters = {}
+        for param, orm_lookup, lookup in plan:
+            value = query_params[param]
+            if lookup == "in":
+                value = value.split(",")
+            elif lookup == "range":
+                value = value.split(",")
+                if len(value) != 2:
+                    raise ValidationError(
+                        {param: "Please provide a range as <start>,<end>"}
+                    )
+            elif lookup == "isnull":
+                value = value.lower() in ("true", "1")
+            filters[orm_lookup] = value
+        return filters
+
+    def get_ordering(self, value):
+        # the first field of ordering is the default one
+        value = value or self.ordering[0]
+        field = value.lstrip("-")
+        if field not in self.ordering:
+            raise ValidationError(
+                {
+                    ORDERING_PARAM:
+                        f"Sorry, results can't be ordered on <{field}>. "
+                        f"Available orderings : {', '.join(self.ordering)}"
+                }
+            )
+        direction = "-" if value.startswith("-") else ""
+        # id breaks ties in the same direction so that
+        # the (field, id) index can be read backwards
+        if field == "id":
+            return (value,)
+        return (value, f"{direction}id")
+
+
+class SpecFilterBackend:
+    """
+    filters and orders the queryset following the view's filter_spec
+    """
+    @staticmethod
+    def reserved_params(view):
+        # pagination and format parameters aren't searched fields
+        reserved = {api_settings.URL_FORMAT_OVERRIDE, ORDERING_PARAM}
+        paginator = getattr(view, "paginator", None)
+        if paginator:
+            reserved |= {
+                getattr(paginator, "cursor_query_param", None),
+                getattr(paginator, "page_size_query_param", None),
+            }
+        return reserved
+
+    def filter_queryset(self, request, queryset, view):
+        if "pk" in view.kwargs:
+            # a detail row, fetched by get_object
+            return queryset
+        spec = view.filter_spec
+        reserved = self.reserved_params(view)
+        params = tuple(sorted(
+            param for param in request.query_params if param not in reserved
+        ))
+        plan = spec.compile(params)
+        try:
+            queryset = queryset.filter(
+                **spec.bind(plan, request.query_params)
+            )
+        except ValueError as error:
+            raise ValidationError({"filter": str(error)})
+        except DjangoValidationError as error:
+            raise ValidationError({"filter": error.messages})
+        return queryset.order_by(*self.get_ordering(request, queryset, view))
+
+    @staticmethod
+    def get_ordering(request, queryset, view):
+        return view.filter_spec.get_ordering(
+            request.query_params.get(ORDERING_PARAM)
+        )
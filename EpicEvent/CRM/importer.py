@@ -0,0 +1,359 @@
+import csv
+import datetime
+import io
+import itertools
+import os
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import (
+    connection,
+    transaction
+)
+from authentication.models import User
+from authentication.validators import Validators
+from .versions import bump_version
+from .models import (
+    Client,
+    Contract,
+    Event
+)
+from .serializers import EventDetailSerializer
+
+IMPORT_BATCH_SIZE = 5000
+
+# NULL in the rows given to COPY, unlike an empty string
+COPY_NULL = "\\N"
+
+EVENT_STATUS = {"Incoming": 1, "In progress": 2, "Closed": 3}
+
+
+def parse_date(value, field):
+    for date_format in settings.DATETIME_INPUT_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValidationError(
+        f"<{field}>: {value} doesn't match "
+        f"{' or '.join(settings.DATETIME_INPUT_FORMATS)}"
+    )
+
+
+def parse_number(value, field, cast):
+    try:
+        return cast(value)
+    except ValueError:
+        raise ValidationError(f"<{field}>: {value} isn't a number")
+
+
+def check_columns(row, columns):
+    """
+    a short row has None for its last columns,
+    the extra values of a long row are under None
+    """
+    if None in row:
+        raise ValidationError("more values than columns")
+    missing = [column for column in columns if row[column] is None]
+    if missing:
+        raise ValidationError([f"<{column}>: missing" for column in missing])
+
+
+def check_lengths(model, values):
+    # strings longer than their column, refused by PostgreSQL
+    errors = []
+    for field, value in values.items():
+        max_length = model._meta.get_field(field).max_length
+        if isinstance(value, str) and max_length and len(value) > max_length:
+            errors.append(f"<{field}>: more than {max_length} characters")
+    if errors:
+        raise ValidationError(errors)
+
+
+def team_map(team):
+    # username: id of the members of team, users are few
+    return dict(
+        User.objects.filter(groups__name=team).values_list("username", "id")
+    )
+
+
+class ClientImport:
+    """
+    columns : first_name, last_name, email, phone, mobile, company_name
+    and sales_contact, the username of a member of the sales team
+    """
+    model = Client
+    columns = (
+        "first_name", "last_name", "email", "phone", "mobile",
+        "company_name", "sales_contact",
+    )
+    fields = (
+        "first_name", "last_name", "email", "phone", "mobile",
+        "company_name", "sales_contact_id", "date_created", "date_updated",
+    )
+
+    def __init__(self):
+        self.sales_contacts = team_map("Sales team")
+
+    def prepare(self, rows):
+        pass
+
+    def parse(self, row):
+        Validators.check_letters_hyphen(row["first_name"], "first_name")
+        Validators.check_letters_hyphen(row["last_name"], "last_name")
+        Validators.check_is_phone_number(row["phone"], "phone")
+        Validators.check_is_phone_number(row["mobile"], "mobile")
+        try:
+            validate_email(row["email"])
+        except ValidationError:
+            raise ValidationError(f"<email>: {row['email']} isn't an email")
+        if row["sales_contact"] not in self.sales_contacts:
+            raise ValidationError(
+                f"<sales_contact>: {row['sales_contact']} "
+                "isn't member of Sales team"
+            )
+        return {
+            "first_name": row["first_name"].title(),
+            "last_name": row["last_name"].title(),
+            "email": row["email"],
+            "phone": row["phone"],
+            "mobile": row["mobile"],
+            "company_name": row["company_name"],
+            "sales_contact_id": self.sales_contacts[row["sales_contact"]],
+        }
+
+
+class ContractImport:
+    """
+    columns : client, the email of the client, status (True or False),
+    amount and payment_due
+    """
+    model = Contract
+    columns = ("client", "status", "amount", "payment_due")
+    fields = (
+        "client_id", "status", "amount", "payment_due",
+        "date_created", "date_updated",
+    )
+
+    def __init__(self):
+        # email: id of the clients of the current chunk
+        self.clients = {}
+
+    def prepare(self, rows):
+        emails = {row["client"] for row in rows}
+        # the oldest client wins when an email is shared
+        self.clients = dict(
+            Client.objects.filter(email__in=emails)
+            .order_by("-id").values_list("email", "id")
+        )
+
+    def parse(self, row):
+        if row["client"] not in self.clients:
+            raise ValidationError(
+                f"<client>: no client with email {row['client']}"
+            )
+        if row["status"] not in ("True", "False"):
+            raise ValidationError("<status>: must be True or False")
+        return {
+            "client_id": self.clients[row["client"]],
+            "status": row["status"] == "True",
+            "amount": parse_number(row["amount"], "amount", float),
+            "payment_due": parse_date(row["payment_due"], "payment_due"),
+        }
+
+
+class EventImport:
+    """
+    columns : name, contract (id of a signed contract without event),
+    support_contact (username of a member of the support team, may be
+    empty), event_status (Incoming, In progress or Closed), attendees,
+    event_date and notes
+    """
+    model = Event
+    columns = (
+        "name", "contract", "support_contact", "event_status",
+        "attendees", "event_date",
+    )
+    fields = (
+        "name", "contract_id", "support_contact_id", "event_status",
+        "attendees", "event_date", "notes", "date_created", "date_updated",
+    )
+
+    def __init__(self):
+        self.support_contacts = team_map("Support team")
+        # signed contracts still free, filled with the contracts of a chunk
+        self.free_contracts = set()
+
+    def prepare(self, rows):
+        contracts = {
+            int(row["contract"]) for row in rows
+            if row["contract"].isdigit()
+        }
+        self.free_contracts = set(
+            Contract.objects.filter(
+                id__in=contracts, status=True, event__isnull=True
+            ).values_list("id", flat=True)
+        )
+
+    def parse(self, row):
+        contract = parse_number(row["contract"], "contract", int)
+        if contract not in self.free_contracts:
+            raise ValidationError(
+                f"<contract>: contract {contract} doesn't exist, "
+                "isn't signed or already has an event"
+            )
+        support_contact = None
+        if row["support_contact"]:
+            if row["support_contact"] not in self.support_contacts:
+                raise ValidationError(
+                    f"<support_contact>: {row['support_contact']} "
+                    "isn't member of Support team"
+                )
+            support_contact = self.support_contacts[row["support_contact"]]
+        if row["event_status"] not in EVENT_STATUS:
+            raise ValidationError(
+                "<event_status>: Must be <Incoming>, <In progress> or <Closed>"
+            )
+        event_status = EVENT_STATUS[row["event_status"]]
+        event_date = parse_date(row["event_date"], "event_date")
+        EventDetailSerializer.check_status(event_date, event_status)
+        attendees = parse_number(row["attendees"], "attendees", int)
+        # one event per contract, in the file too
+        self.free_contracts.discard(contract)
+        return {
+            "name": row["name"],
+            "contract_id": contract,
+            "support_contact_id": support_contact,
+            "event_status": str(event_status),
+            "attendees": attendees,
+            "event_date": event_date,
+            "notes": row.get("notes") or None,
+        }
+
+
+IMPORTS = {
+    "clients": ClientImport,
+    "contracts": ContractImport,
+    "events": EventImport,
+}
+
+
+def read_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as checkpoint:
+        return int(checkpoint.read().strip() or 0)
+
+
+def write_checkpoint(path, rows):
+    # replaced in one step, a crash leaves the previous checkpoint
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as checkpoint:
+        checkpoint.write(str(rows))
+    os.replace(temporary, path)
+
+
+def copy_line(row):
+    """
+    a row in the csv format of COPY: NULL is an unquoted COPY_NULL,
+    every value is quoted so an empty string stays one
+    """
+    return ",".join(
+        COPY_NULL if value is None
+        else '"' + str(value).replace('"', '""') + '"'
+        for value in row
+    ) + "\n"
+
+
+def copy_rows(model, fields, rows):
+    """
+    writes rows with COPY, PostgreSQL only
+    """
+    buffer = io.StringIO("".join(copy_line(row) for row in rows))
+    columns = ", ".join(
+        connection.ops.quote_name(model._meta.get_field(field).column)
+        for field in fields
+    )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {connection.ops.quote_name(model._meta.db_table)} "
+            f"({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')",
+            buffer
+        )
+
+
+def write_rows(model, fields, rows, use_copy):
+    if use_copy:
+        copy_rows(model, fields, [
+            [row[field] for field in fields] for row in rows
+        ])
+    else:
+        model.objects.bulk_create(
+            [model(**row) for row in rows], batch_size=IMPORT_BATCH_SIZE
+        )
+
+
+def import_csv(resource, csv_file, batch_size=IMPORT_BATCH_SIZE,
+               checkpoint=None, use_copy=None, on_batch=None):
+    """
+    reads csv_file in batches of batch_size rows, each batch being
+    validated then written in one transaction
+    after each batch the number of rows read is saved to checkpoint,
+    an import started again with the same checkpoint skips these rows
+    COPY is used on PostgreSQL unless use_copy is False
+    on_batch(read, imported, rejected) is called after each batch,
+    rejected being a list of (line, error)
+    returns the number of rows read, imported and rejected
+    """
+    if use_copy is None:
+        use_copy = connection.vendor == "postgresql"
+    importer = IMPORTS[resource]()
+    reader = csv.DictReader(csv_file)
+    missing = set(importer.columns) - set(reader.fieldnames or ())
+    if missing:
+        raise ValueError(f"Missing columns : {', '.join(sorted(missing))}")
+    skipped = read_checkpoint(checkpoint)
+    rows = itertools.islice(enumerate(reader, start=2), skipped, None)
+    read = skipped
+    imported = 0
+    rejected = 0
+    while True:
+        chunk = list(itertools.islice(rows, batch_size))
+        if not chunk:
+            break
+        complete = []
+        errors = []
+        for line, row in chunk:
+            try:
+                check_columns(row, importer.columns)
+            except ValidationError as error:
+                errors.append((line, "; ".join(error.messages)))
+                continue
+            complete.append((line, row))
+        importer.prepare([row for _, row in complete])
+        now = datetime.datetime.now()
+        valid = []
+        for line, row in complete:
+            try:
+                values = importer.parse(row)
+                check_lengths(importer.model, values)
+            except ValidationError as error:
+                errors.append((line, "; ".join(error.messages)))
+                continue
+            values["date_created"] = now
+            values["date_updated"] = now
+            valid.append(values)
+        errors.sort()
+        with transaction.atomic():
+            write_rows(importer.model, importer.fields, valid, use_copy)
+        read += len(chunk)
+        imported += len(valid)
+        rejected += len(errors)
+        if checkpoint:
+            write_checkpoint(checkpoint, read)
+        if on_batch:
+            on_batch(read, imported, errors)
+    if imported:
+        # bulk_create and COPY send no signal
+        bump_version(importer.model)
+    return read, imported, rejected
@@ -0,0 +1,57 @@
+import time
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+from authentication.authentication import (
+    JWTAuthentication,
+    token_cache
+)
+from authentication.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Authenticates the same request repeatedly, with and without "
+        "the cache of verified tokens, and reports the cost per request"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--requests", type=int, default=10000,
+            help="number of authentications of each run")
+
+    @staticmethod
+    def run(authentication, request, requests):
+        start = time.perf_counter()
+        for _ in range(requests):
+            authentication.authenticate(request)
+        return (time.perf_counter() - start) / requests
+
+    def handle(self, *args, **options):
+        user = User.objects.order_by("id").first()
+        if not user:
+            self.stdout.write("No user to authenticate")
+            return
+        requests = options["requests"]
+        request = APIRequestFactory().get(
+            "/crm/clients/",
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}"
+        )
+        results = {}
+        for use_token_cache in (False, True):
+            token_cache.clear()
+            authentication = JWTAuthentication()
+            authentication.use_token_cache = use_token_cache
+            # the user is loaded once then taken from user_cache
+            authentication.authenticate(request)
+            results[use_token_cache] = self.run(
+                authentication, request, requests
+            )
+            self.stdout.write(
+                f"token cache {'on' if use_token_cache else 'off':<3} : "
+                f"{results[use_token_cache] * 1e6:.1f} us per request "
+                f"({requests} requests)"
+            )
+        self.stdout.write(
+            f"speedup : {results[False] / results[True]:.1f}x"
+        )
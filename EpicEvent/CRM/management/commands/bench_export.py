@@ -0,0 +1,64 @@
+import resource
+import time
+from django.core.management.base import BaseCommand
+from CRM.export import (
+    EXPORT_CHUNK_SIZE,
+    EXPORT_FORMATS
+)
+from CRM.models import (
+    Client,
+    Contract,
+    Event
+)
+from CRM.views import (
+    ClientViewset,
+    ContractViewset,
+    EventViewset
+)
+
+RESOURCES = {
+    "clients": (Client, ClientViewset.export_fields),
+    "contracts": (Contract, ContractViewset.export_fields),
+    "events": (Event, EventViewset.export_fields),
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs an export over the rows of the database "
+        "and reports rows per second and peak RSS"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "resource", choices=RESOURCES.keys())
+        parser.add_argument(
+            "--format", choices=EXPORT_FORMATS.keys(), default="csv")
+        parser.add_argument(
+            "--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        model, fields = RESOURCES[options["resource"]]
+        lines, content_type = EXPORT_FORMATS[options["format"]]
+        queryset = model.objects.order_by("date_created", "id")
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        size = 0
+        for chunk in lines(queryset, fields, options["chunk_size"]):
+            size += len(chunk)
+        duration = time.perf_counter() - start
+        rows = queryset.count()
+        self.stdout.write(
+            f"{rows} rows ({size / 1024 / 1024:.1f} MB) "
+            f"exported in {duration:.2f}s : "
+            f"{rows / duration if duration else 0:.0f} rows/s"
+        )
+        self.stdout.write(
+            f"peak RSS {peak_rss_mb():.1f} MB "
+            f"(before export {rss_before:.1f} MB)"
+        )
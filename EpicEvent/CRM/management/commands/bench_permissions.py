@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from authentication.models import User
+from CRM.models import (
+    Client,
+    Contract,
+    Event
+)
+
+TEAMS = ["Management team", "Sales team", "Support team"]
+
+
+def is_group_query(sql):
+    # a query of its own on the groups of a user,
+    # not the team loaded with the user by JWTAuthentication
+    return '"auth_group"' in sql and '"authentication_user"' not in sql
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends GET requests on list and detail endpoints "
+        "as the first user of each team and counts "
+        "queries and group queries per request"
+    )
+
+    @staticmethod
+    def get_urls():
+        urls = ["/crm/clients/", "/crm/contracts/", "/crm/events/"]
+        for prefix, model in [
+            ("clients", Client),
+            ("contracts", Contract),
+            ("events", Event)
+        ]:
+            row = model.objects.order_by("id").first()
+            if row:
+                urls.append(f"/crm/{prefix}/{row.pk}/")
+        return urls
+
+    def handle(self, *args, **options):
+        urls = self.get_urls()
+        requests = 0
+        total_group_queries = 0
+        for team in TEAMS:
+            user = User.objects.filter(groups__name=team).first()
+            if not user:
+                continue
+            client = APIClient(HTTP_HOST="localhost")
+            client.credentials(
+                HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}"
+            )
+            for url in urls:
+                with CaptureQueriesContext(connection) as queries:
+                    response = client.get(url)
+                group_queries = sum(
+                    is_group_query(query["sql"])
+                    for query in queries.captured_queries
+                )
+                requests += 1
+                total_group_queries += group_queries
+                self.stdout.write(
+                    f"{team:<16} {url:<22} {response.status_code} : "
+                    f"{len(queries)} queries, {group_queries} on groups"
+                )
+        if requests:
+            self.stdout.write(
+                f"{total_group_queries / requests:.2f} group queries "
+                f"per request ({requests} requests)"
+            )
@@ -0,0 +1,61 @@
+import time
+from django.core.management.base import (
+    BaseCommand,
+    CommandError
+)
+from CRM.importer import (
+    IMPORT_BATCH_SIZE,
+    IMPORTS,
+    import_csv
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports clients, contracts or events from a csv file in batches, "
+        "rejected rows are reported with their line and error"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("resource", choices=IMPORTS.keys())
+        parser.add_argument("csv_path")
+        parser.add_argument(
+            "--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+        parser.add_argument(
+            "--checkpoint",
+            help="file keeping the number of rows already imported, "
+                 "an import started again with it resumes after them")
+        parser.add_argument(
+            "--no-copy", action="store_true",
+            help="use bulk_create instead of COPY on PostgreSQL")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+
+        def report(read, imported, rejected):
+            for line, error in rejected:
+                self.stderr.write(f"line {line} : {error}")
+            duration = time.perf_counter() - start
+            self.stdout.write(
+                f"{read} rows read, {imported} imported : "
+                f"{imported / duration if duration else 0:.0f} rows/s"
+            )
+
+        with open(options["csv_path"], newline="") as csv_file:
+            try:
+                read, imported, rejected = import_csv(
+                    options["resource"],
+                    csv_file,
+                    batch_size=options["batch_size"],
+                    checkpoint=options["checkpoint"],
+                    use_copy=False if options["no_copy"] else None,
+                    on_batch=report,
+                )
+            except ValueError as error:
+                raise CommandError(error)
+        duration = time.perf_counter() - start
+        self.stdout.write(
+            f"{imported} {options['resource']} imported, "
+            f"{rejected} rejected in {duration:.2f}s : "
+            f"{imported / duration if duration else 0:.0f} rows/s"
+        )
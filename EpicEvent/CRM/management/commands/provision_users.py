@@ -0,0 +1,60 @@
+import csv
+import time
+from django.core.management.base import (
+    BaseCommand,
+    CommandError
+)
+from authentication.serializers import bulk_register_users
+
+COLUMNS = ("first_name", "last_name", "password", "team")
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the users of a csv file with columns first_name, "
+        "last_name, password and team (Management, Sales or Support), "
+        "passwords are hashed on every core, "
+        "usernames are written to stdout"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("csv_path")
+        parser.add_argument(
+            "--workers", type=int,
+            help="processes hashing passwords, one per core by default")
+
+    def handle(self, *args, **options):
+        with open(options["csv_path"], newline="") as csv_file:
+            reader = csv.DictReader(csv_file)
+            missing = set(COLUMNS) - set(reader.fieldnames or ())
+            if missing:
+                raise CommandError(
+                    f"Missing columns : {', '.join(sorted(missing))}"
+                )
+            items = [
+                {
+                    "first_name": row["first_name"],
+                    "last_name": row["last_name"],
+                    "password1": row["password"],
+                    "password2": row["password"],
+                    "team": row["team"],
+                }
+                for row in reader
+            ]
+        start = time.perf_counter()
+        results = bulk_register_users(items, options["workers"])
+        duration = time.perf_counter() - start
+        created = 0
+        for result in results:
+            if result["status"] == 201:
+                created += 1
+                self.stdout.write(result["user"]["username"])
+            else:
+                # the header is line 1
+                self.stderr.write(
+                    f"line {result['index'] + 2} : {result['errors']}"
+                )
+        self.stdout.write(
+            f"{created} users created, {len(results) - created} rejected "
+            f"in {duration:.2f}s"
+        )
@@ -0,0 +1,45 @@
+from django.core.management.base import (
+    BaseCommand,
+    CommandError
+)
+from CRM.cache import get_stats
+from CRM.metrics import get_store
+from CRM.views import (
+    ClientViewset,
+    ContractViewset,
+    EventViewset
+)
+
+BASENAMES = {
+    ClientViewset: "clients",
+    ContractViewset: "contracts",
+    EventViewset: "events",
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports hits, misses and hit ratio of the response cache "
+        "for each endpoint, read from the metrics the workers write "
+        "in DIRECTORY of METRICS"
+    )
+
+    def handle(self, *args, **options):
+        store = get_store()
+        if store is None:
+            # the counters only live in the server processes
+            raise CommandError(
+                "Please set DIRECTORY in METRICS, or read "
+                "crm_response_cache_total at /metrics/"
+            )
+        endpoints = [
+            (basename, action)
+            for viewset, basename in BASENAMES.items()
+            for action in viewset.cached_actions
+        ]
+        for (basename, action), (hits, misses, ratio) in get_stats(
+                endpoints, store.collect()).items():
+            self.stdout.write(
+                f"{basename:<10} {action:<9} : {hits} hits, "
+                f"{misses} misses, {ratio:.0%} hit ratio"
+            )
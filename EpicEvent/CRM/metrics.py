@@ -0,0 +1,471 @@
+import asyncio
+import atexit
+import bisect
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+
+METRICS = getattr(settings, "METRICS", {})
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # label values: value
+        self.values = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def merge(value, other):
+        raise NotImplementedError
+
+    def samples(self, labels, value):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    @staticmethod
+    def merge(value, other):
+        return value + other
+
+    def samples(self, labels, value):
+        yield self.name, labels, value
+
+
+class Histogram(Metric):
+    """
+    counts of the observed values in fixed buckets, each bucket
+    counting the values up to its bound, then the values above the last
+    one, followed by the sum of the values
+    """
+    kind = "histogram"
+
+    def __init__(self, name, description, labels, buckets):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @staticmethod
+    def merge(value, other):
+        return [count + more for count, more in zip(value, other)]
+
+    def samples(self, labels, value):
+        cumulated = 0
+        for bound, count in zip(self.buckets + ("+Inf",), value):
+            cumulated += count
+            yield (
+                f"{self.name}_bucket", labels + (("le", str(bound)),),
+                cumulated
+            )
+        yield f"{self.name}_sum", labels, value[-1]
+        yield f"{self.name}_count", labels, cumulated
+
+
+requests_total = Counter(
+    "crm_requests_total",
+    "Requests handled, by viewset, action and status code",
+    ("viewset", "action", "status"),
+)
+request_duration = Histogram(
+    "crm_request_duration_seconds",
+    "Time to handle a request, by viewset and action",
+    ("viewset", "action"),
+    LATENCY_BUCKETS,
+)
+request_queries = Histogram(
+    "crm_request_queries",
+    "SQL queries made by a request, by viewset and action",
+    ("viewset", "action"),
+    QUERIES_BUCKETS,
+)
+response_cache_total = Counter(
+    "crm_response_cache_total",
+    "Lookups of the response cache, by endpoint, action and result",
+    ("basename", "action", "result"),
+)
+process_cache_total = Counter(
+    "crm_process_cache_total",
+    "Lookups of the per-process caches, by cache and result",
+    ("cache", "result"),
+)
+REGISTRY = (
+    requests_total, request_duration, request_queries, response_cache_total,
+    process_cache_total,
+)
+# name: LRUCache of the process, see register_cache
+PROCESS_CACHES = {}
+
+
+def register_cache(name, cache):
+    """
+    publishes the hits and misses counted by cache
+    in process_cache_total
+    """
+    PROCESS_CACHES[name] = cache
+
+
+def read_process_caches():
+    for name, cache in PROCESS_CACHES.items():
+        stats = cache.stats()
+        with process_cache_total._lock:
+            for result in ("hits", "misses"):
+                process_cache_total.values[(name, result)] = stats[result]
+
+
+def dump():
+    # metric name: [[label values, value]], as written in the store
+    read_process_caches()
+    dumped = {}
+    for metric in REGISTRY:
+        with metric._lock:
+            dumped[metric.name] = [
+                [list(labels), list(value) if isinstance(value, list)
+                 else value]
+                for labels, value in metric.values.items()
+            ]
+    return dumped
+
+
+def to_dump(collected):
+    # merged metrics back in the format of dump
+    return {
+        name: [[list(labels), value] for labels, value in values.items()]
+        for name, values in collected.items()
+    }
+
+
+def merge(into, dumped):
+    for metric in REGISTRY:
+        values = into.setdefault(metric.name, {})
+        for labels, value in dumped.get(metric.name, ()):
+            labels = tuple(labels)
+            if labels in values:
+                value = metric.merge(values[labels], value)
+            values[labels] = value
+    return into
+
+
+def reset():
+    for metric in REGISTRY:
+        with metric._lock:
+            metric.values.clear()
+
+
+# <pid>-<token>.json, the token tells apart processes sharing a pid
+WORKER_FILE = re.compile(r"^(\d+)-([0-9a-f]{32})\.json$")
+# metrics of the stopped workers
+FOLDED_FILE = "folded.json"
+FOLD_LOCK = "fold.lock"
+# a lock left by a crashed worker is ignored after this many seconds
+FOLD_LOCK_TIMEOUT = 60
+
+
+def is_running(pid):
+    if os.name == "nt":
+        # a process can't be probed with a signal, its file is kept
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@lru_cache(maxsize=1)
+def worker_name(pid):
+    # the file of the current process, drawn again in a forked worker
+    return f"{pid}-{uuid.uuid4().hex}.json"
+
+
+def read_json(path):
+    with open(path) as store:
+        return json.load(store)
+
+
+def write_json(path, data):
+    # replaced in one step, readers never see half a file
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as store:
+        json.dump(data, store)
+    os.replace(temporary, path)
+
+
+class DirectoryStore:
+    """
+    each process writes its metrics to <directory>/<pid>-<token>.json,
+    replaced in one step every FLUSH_INTERVAL seconds, the endpoint
+    sums the files of the other processes with its own metrics
+    the token is drawn by each process, so a new worker reusing the pid
+    of a stopped one doesn't overwrite its counts
+    the files of stopped workers are folded into folded.json,
+    which lists them until they are removed: a count is never lost
+    nor added twice, and the directory doesn't grow
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.flushed = 0
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def flush(self, force=False):
+        interval = METRICS.get("FLUSH_INTERVAL", 5)
+        if not force and time.monotonic() - self.flushed < interval:
+            return
+        with self._lock:
+            self.flushed = time.monotonic()
+            os.makedirs(self.directory, exist_ok=True)
+            write_json(self.path(worker_name(os.getpid())), dump())
+        self.fold()
+
+    def read_folded(self):
+        try:
+            return read_json(self.path(FOLDED_FILE))
+        except FileNotFoundError:
+            return {}
+
+    def worker_files(self):
+        # (name, pid) of the files of every worker
+        files = []
+        for name in os.listdir(self.directory):
+            match = WORKER_FILE.match(name)
+            if match:
+                files.append((name, int(match.group(1))))
+        return files
+
+    def fold(self):
+        """
+        adds the metrics of the stopped workers to folded.json,
+        by one process at a time, then removes their files
+        """
+        lock = self.path(FOLD_LOCK)
+        try:
+            os.mkdir(lock)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > FOLD_LOCK_TIMEOUT:
+                    os.rmdir(lock)
+            except OSError:
+                pass
+            return
+        try:
+            folded = self.read_folded()
+            names = set(folded.get("files", ()))
+            stopped = []
+            for name, pid in self.worker_files():
+                if name in names:
+                    # already folded, left by a crash of the last fold
+                    os.remove(self.path(name))
+                elif not is_running(pid):
+                    stopped.append(name)
+            if not stopped:
+                return
+            collected = merge({}, folded.get("metrics", {}))
+            for name in stopped:
+                try:
+                    merge(collected, read_json(self.path(name)))
+                except ValueError:
+                    continue
+            # the files listed aren't read anymore, a crash before
+            # their removal can't count them twice
+            write_json(self.path(FOLDED_FILE), {
+                "files": sorted(stopped),
+                "metrics": to_dump(collected),
+            })
+            for name in stopped:
+                os.remove(self.path(name))
+        finally:
+            os.rmdir(lock)
+
+    def collect(self):
+        if not os.path.isdir(self.directory):
+            return merge({}, dump())
+        # a file folded meanwhile is read again from folded.json
+        for _ in range(3):
+            names = [name for name, pid in self.worker_files()]
+            folded = self.read_folded()
+            collected = merge(merge({}, dump()), folded.get("metrics", {}))
+            skipped = set(folded.get("files", ())) | {worker_name(os.getpid())}
+            folded_meanwhile = False
+            for name in names:
+                if name in skipped:
+                    continue
+                try:
+                    merge(collected, read_json(self.path(name)))
+                except FileNotFoundError:
+                    folded_meanwhile = True
+                    break
+                except ValueError:
+                    continue
+            if not folded_meanwhile:
+                break
+        return collected
+
+
+def get_store():
+    directory = METRICS.get("DIRECTORY")
+    return DirectoryStore(directory) if directory else None
+
+
+def collect():
+    store = get_store()
+    if store is None:
+        return merge({}, dump())
+    return store.collect()
+
+
+def escape(value):
+    return (
+        str(value).replace("\\", "\\\\").replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def render(collected):
+    """
+    collected metrics in the text format of Prometheus
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for labels, value in sorted(collected.get(metric.name, {}).items()):
+            for name, sample_labels, sample in metric.samples(
+                    tuple(zip(metric.labels, labels)), value):
+                text = ",".join(
+                    f'{label}="{escape(label_value)}"'
+                    for label, label_value in sample_labels
+                )
+                lines.append(f"{name}{{{text}}} {sample}")
+    return "\n".join(lines) + "\n"
+
+
+def view_labels(request):
+    """
+    viewset (or view class) and action of the view of the request
+    """
+    match = request.resolver_match
+    if match is None:
+        return "unresolved", request.method.lower()
+    view = getattr(match.func, "cls", None) or getattr(
+        match.func, "view_class", None
+    )
+    name = view.__name__ if view else match.func.__name__
+    # the actions of a viewset route, e.g. {"get": "list"}
+    actions = getattr(match.func, "actions", None) or {}
+    method = request.method.lower()
+    if method == "head":
+        method = "get"
+    return name, actions.get(method, method)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+@asynccontextmanager
+async def async_execute_wrapper(wrapper):
+    """
+    connection.execute_wrapper of the async middlewares: the sync views
+    query with the connection of the thread sync_to_async runs them in,
+    the wrapper is added to it and removed from there
+    """
+    def enter():
+        manager = connection.execute_wrapper(wrapper)
+        manager.__enter__()
+        return manager
+    manager = await sync_to_async(enter)()
+    try:
+        yield
+    finally:
+        await sync_to_async(manager.__exit__)(None, None, None)
+
+
+class MetricsMiddleware:
+    """
+    counts the requests by viewset, action and status code, and
+    observes their latency and number of queries in histograms
+    async under asgi.py, the async views (LoginView) stay on the event loop
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # awaited by the handler, as MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        else:
+            self._is_coroutine = None
+        self.store = get_store()
+        if self.store is not None:
+            atexit.register(self.store.flush, force=True)
+
+    def __call__(self, request):
+        if self._is_coroutine:
+            return self.__acall__(request)
+        if not METRICS.get("ENABLED", True):
+            return self.get_response(request)
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, counter)
+        return response
+
+    async def __acall__(self, request):
+        if not METRICS.get("ENABLED", True):
+            return await self.get_response(request)
+        counter = QueryCounter()
+        start = time.perf_counter()
+        async with async_execute_wrapper(counter):
+            response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, counter)
+        return response
+
+    def record(self, request, response, duration, counter):
+        viewset, action = view_labels(request)
+        requests_total.inc((viewset, action, str(response.status_code)))
+        request_duration.observe((viewset, action), duration)
+        request_queries.observe((viewset, action), counter.queries)
+        if self.store is not None:
+            self.store.flush()
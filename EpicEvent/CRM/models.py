@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import Q
+from django.db.models.functions import Upper
 from authentication.models import User
 
 
@@ -14,9 +16,32 @@ class Client(models.Model):
     sales_contact = models.ForeignKey(
         to=User,
         on_delete=models.PROTECT,
-        limit_choices_to={'groups__name': "Sales team"}
+        limit_choices_to={'groups__name': "Sales team"},
+        # served by client_sales_created_idx
+        db_index=False,
     )
 
+    class Meta:
+        indexes = [
+            # cursor pagination
+            models.Index(
+                fields=["date_created", "id"],
+                name="client_created_id_idx"
+            ),
+            # a sales contact's clients, in pagination order
+            models.Index(
+                fields=["sales_contact", "date_created", "id"],
+                name="client_sales_created_idx"
+            ),
+            models.Index(fields=["email"], name="client_email_idx"),
+            models.Index(fields=["last_name"], name="client_last_name_idx"),
+            # case insensitive search on last_name (iexact)
+            models.Index(
+                Upper("last_name"),
+                name="client_upper_last_name_idx"
+            ),
+        ]
+
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
 
@@ -25,6 +50,8 @@ class Contract(models.Model):
     client = models.ForeignKey(
         to=Client,
         on_delete=models.CASCADE,
+        # served by contract_client_status_idx
+        db_index=False,
     )
     status = models.BooleanField(default=False)
     amount = models.FloatField()
@@ -32,6 +59,29 @@ class Contract(models.Model):
     date_created = models.DateTimeField()
     date_updated = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            # cursor pagination
+            models.Index(
+                fields=["date_created", "id"],
+                name="contract_created_id_idx"
+            ),
+            models.Index(
+                fields=["client", "status"],
+                name="contract_client_status_idx"
+            ),
+            models.Index(
+                fields=["payment_due"],
+                name="contract_payment_due_idx"
+            ),
+            # signed contracts only
+            models.Index(
+                fields=["client"],
+                condition=Q(status=True),
+                name="contract_signed_client_idx"
+            ),
+        ]
+
     def __str__(self):
         return f"{self.client} - Contract N° {self.pk}"
 
@@ -49,6 +99,8 @@ class Event(models.Model):
         to=User,
         on_delete=models.PROTECT,
         limit_choices_to={'groups__name': "Support team"},
+        # served by event_support_date_idx
+        db_index=False,
     )
     STATUS = [
         ("1", "Incoming"),
@@ -64,5 +116,19 @@ class Event(models.Model):
     date_updated = models.DateTimeField()
     notes = models.TextField(blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # cursor pagination
+            models.Index(
+                fields=["date_created", "id"],
+                name="event_created_id_idx"
+            ),
+            models.Index(
+                fields=["support_contact", "event_date"],
+                name="event_support_date_idx"
+            ),
+            models.Index(fields=["event_status"], name="event_status_idx"),
+        ]
+
     def __str__(self):
         return f"{self.name} ({self.contract}) "
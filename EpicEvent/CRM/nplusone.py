@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+import re
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from .metrics import async_execute_wrapper
+
+queries_logger = logging.getLogger("queries")
+
+NPLUSONE = getattr(settings, "NPLUSONE", {})
+
+# frames left out of the stacks: database layer, request handling
+# and the wrappers of the queries
+SKIPPED_FRAMES = tuple(
+    os.path.join(*path) for path in (
+        ("django", "db", ""),
+        ("django", "core", "handlers", ""),
+        ("django", "test", ""),
+        ("django", "utils", "deprecation.py"),
+        ("rest_framework", "test.py"),
+        ("unittest", ""),
+        ("CRM", "metrics.py"),
+        ("CRM", "nplusone.py"),
+        ("CRM", "profiling.py"),
+    )
+)
+STACK_DEPTH = 12
+
+LITERALS = (
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"%s"), "?"),
+    # IN lists of any length
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),
+    (re.compile(r"\s+"), " "),
+)
+
+
+class RepeatedQueriesError(Exception):
+    pass
+
+
+def fingerprint(sql):
+    """
+    the statement without its values, the same for every row
+    """
+    for pattern, replacement in LITERALS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def caller_stack():
+    # the last frames, from the view or the test to the serializer field
+    frames = [
+        frame for frame in traceback.extract_stack()
+        if not any(skipped in frame.filename for skipped in SKIPPED_FRAMES)
+    ]
+    return "".join(traceback.format_list(frames[-STACK_DEPTH:]))
+
+
+class QueryDetector:
+    """
+    connection.execute_wrapper counting the queries by fingerprint,
+    the stack of the query repeating a fingerprint more than threshold
+    times is kept
+    """
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.counts = Counter()
+        self.stacks = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        key = fingerprint(sql)
+        self.counts[key] += 1
+        if self.counts[key] == self.threshold + 1:
+            self.stacks[key] = caller_stack()
+        return execute(sql, params, many, context)
+
+    def report(self):
+        return "\n".join(
+            f"{key}\nrepeated {self.counts[key]} times, from:\n{stack}"
+            for key, stack in self.stacks.items()
+        )
+
+
+@contextmanager
+def detect_repeated_queries(threshold=None):
+    """
+    raises RepeatedQueriesError when a statement of the block
+    is repeated more than threshold times
+    """
+    detector = QueryDetector(threshold or NPLUSONE.get("THRESHOLD", 5))
+    with connection.execute_wrapper(detector):
+        yield detector
+    if detector.stacks:
+        raise RepeatedQueriesError(detector.report())
+
+
+class NPlusOneMiddleware:
+    """
+    when NPLUSONE is enabled, looks for statements repeated more than
+    THRESHOLD times by a request: ACTION "log" logs a warning with the
+    stack of the query (staging), "raise" raises RepeatedQueriesError
+    (tests, see DetectRepeatedQueries)
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # awaited by the handler, as MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        else:
+            self._is_coroutine = None
+
+    def __call__(self, request):
+        if self._is_coroutine:
+            return self.__acall__(request)
+        if not NPLUSONE.get("ENABLED", False):
+            return self.get_response(request)
+        detector = QueryDetector(NPLUSONE.get("THRESHOLD", 5))
+        with connection.execute_wrapper(detector):
+            response = self.get_response(request)
+        self.report(request, detector)
+        return response
+
+    async def __acall__(self, request):
+        if not NPLUSONE.get("ENABLED", False):
+            return await self.get_response(request)
+        detector = QueryDetector(NPLUSONE.get("THRESHOLD", 5))
+        async with async_execute_wrapper(detector):
+            response = await self.get_response(request)
+        self.report(request, detector)
+        return response
+
+    @staticmethod
+    def report(request, detector):
+        if not detector.stacks:
+            return
+        if NPLUSONE.get("ACTION", "log") == "raise":
+            raise RepeatedQueriesError(
+                f"{request.method} {request.path}\n{detector.report()}"
+            )
+        queries_logger.warning(
+            "%s %s repeated queries:\n%s",
+            request.method, request.path, detector.report()
+        )
@@ -0,0 +1,133 @@
+import json
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import (
+    CursorPagination,
+    _reverse_ordering
+)
+
+
+def keyset_filter(ordering, position, reverse):
+    """
+    rows after position in ordering, e.g. for (date_created, id)
+    date_created >= d AND (date_created > d OR (date_created = d AND id > i))
+    the first condition lets the (date_created, id) index bound the scan
+    """
+    lookups = [
+        # the cursor goes backwards XOR the field is descending
+        (order.lstrip("-"), reverse != order.startswith("-"))
+        for order in ordering
+    ]
+    after = Q()
+    equal = Q()
+    for (field, backwards), value in zip(lookups, position):
+        lookup = "lt" if backwards else "gt"
+        after |= equal & Q(**{f"{field}__{lookup}": value})
+        equal &= Q(**{field: value})
+    if len(lookups) == 1:
+        return after
+    (field, backwards), value = lookups[0], position[0]
+    lookup = "lte" if backwards else "gte"
+    return Q(**{f"{field}__{lookup}": value}) & after
+
+
+class CRMCursorPagination(CursorPagination):
+    """
+    opaque cursor holding the values of every ordering field of the last
+    row, (date_created, id) by default: a page is read from the index
+    after this row, without COUNT nor OFFSET, even among the rows
+    a bulk import created with the same date_created
+    page size can be chosen with ?page_size= up to max_page_size
+    """
+    ordering = ("date_created", "id")
+    page_size_query_param = "page_size"
+    max_page_size = 500
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # as CursorPagination.paginate_queryset, the rows being filtered
+        # on the whole position instead of its first field
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            offset, reverse, current_position = 0, False, None
+        else:
+            offset, reverse, current_position = self.cursor
+
+        if reverse:
+            queryset = queryset.order_by(*_reverse_ordering(self.ordering))
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if current_position is not None:
+            try:
+                queryset = queryset.filter(keyset_filter(
+                    self.ordering, self.load_position(current_position),
+                    reverse
+                ))
+            except (ValueError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+
+        # one more row tells if there is a following page
+        results = list(queryset[offset:offset + self.page_size + 1])
+        self.page = results[:self.page_size]
+        if len(results) > len(self.page):
+            has_following_position = True
+            following_position = self._get_position_from_instance(
+                results[-1], self.ordering
+            )
+        else:
+            has_following_position = False
+            following_position = None
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = current_position is not None or offset > 0
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = current_position is not None or offset > 0
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def load_position(self, position):
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def _get_position_from_instance(self, instance, ordering):
+        # the ordering ends with id, so a position is unique
+        # and the cursors never need an offset
+        values = []
+        for order in ordering:
+            field = order.lstrip("-")
+            if isinstance(instance, dict):
+                value = instance[field]
+            else:
+                value = getattr(instance, field)
+            values.append(str(value))
+        return json.dumps(values)
+
+
+class UserCursorPagination(CRMCursorPagination):
+    # users have no creation date, their id follows creation order
+    ordering = ("id",)
@@ -1,9 +1,24 @@
 from rest_framework.permissions import BasePermission
-from CRM.models import (
-    Client,
-    Contract,
-    Event
+from django.db.models import (
+    Exists,
+    OuterRef,
+    Q
 )
+from CRM.models import Event
+
+
+def is_member(user, team):
+    # the team comes from the access token or is loaded
+    # with the user by JWTAuthentication
+    return bool(user and user.is_authenticated and user.get_team() == team)
+
+
+def visibility_scope(user):
+    # management sees every row, other teams their own rows
+    team = user.get_team()
+    if team == "Management team":
+        return team
+    return f"{team}:{user.pk}"
 
 
 class IsAuthenticated(BasePermission):
@@ -18,28 +33,34 @@ class IsManagementTeam(BasePermission):
     )
 
     def has_permission(self, request, view):
-        return bool(request.user.groups.filter(
-            name="Management team"
-        ).exists())
+        return is_member(request.user, "Management team")
 
 
 class IsSalesTeam(BasePermission):
     message = "Sorry, only members of the sales team can perform this action"
 
     def has_permission(self, request, view):
-        return bool(request.user.groups.filter(
-            name="Sales team"
-        ).exists())
+        return is_member(request.user, "Sales team")
 
 
 class IsSupportTeam(BasePermission):
     message = "Sorry, only members of the support team can perform this action"
 
     def has_permission(self, request, view):
-        return bool(request.user.groups.filter(name="Support team").exists())
+        return is_member(request.user, "Support team")
 
 
-class IsClientSalesContact(BasePermission):
+class OwnershipPermission(BasePermission):
+    """
+    an ownership rule, checked on a loaded object by has_object_permission
+    and turned by scope() into a predicate listing the user's rows
+    """
+    @staticmethod
+    def scope(user):
+        raise NotImplementedError
+
+
+class IsClientSalesContact(OwnershipPermission):
     message = (
         "Sorry, you don't have permission to access "
         "informations related to this client."
@@ -47,13 +68,14 @@ class IsClientSalesContact(BasePermission):
     )
 
     def has_object_permission(self, request, view, obj):
-        return Client.objects.filter(
-            pk=obj.pk,
-            sales_contact=request.user
-        ).exists()
+        return obj.sales_contact_id == request.user.id
+
+    @staticmethod
+    def scope(user):
+        return Q(sales_contact=user.id)
 
 
-class IsClientEventSupportContact(BasePermission):
+class IsClientEventSupportContact(OwnershipPermission):
     message = (
         "Sorry, you don't have permission to access "
         "informations related to this client."
@@ -61,12 +83,24 @@ class IsClientEventSupportContact(BasePermission):
     )
 
     def has_object_permission(self, request, view, obj):
-        return Client.objects.filter(
-            pk=obj.pk, contract__event__support_contact=request.user
+        # annotated by ClientViewset on detail requests
+        if hasattr(obj, "is_event_support_contact"):
+            return obj.is_event_support_contact
+        return Event.objects.filter(
+            contract__client=obj, support_contact=request.user
         ).exists()
 
+    @staticmethod
+    def scope(user):
+        return Exists(
+            Event.objects.filter(
+                contract__client=OuterRef("pk"),
+                support_contact=user.id
+            )
+        )
+
 
-class IsContractSalesContact(BasePermission):
+class IsContractSalesContact(OwnershipPermission):
     message = (
         "Sorry, you don't have permission to access "
         "informations related to this client."
@@ -74,12 +108,14 @@ class IsContractSalesContact(BasePermission):
     )
 
     def has_object_permission(self, request, view, obj):
-        return Contract.objects.filter(
-            pk=obj.pk, client__sales_contact=request.user
-        ).exists()
+        return obj.client.sales_contact_id == request.user.id
+
+    @staticmethod
+    def scope(user):
+        return Q(client__sales_contact=user.id)
 
 
-class IsEventSupportContact(BasePermission):
+class IsEventSupportContact(OwnershipPermission):
     message = (
         "Sorry, you don't have permission to access "
         "informations related to this event."
@@ -87,13 +123,14 @@ class IsEventSupportContact(BasePermission):
     )
 
     def has_object_permission(self, request, view, obj):
-        return Event.objects.filter(
-            pk=obj.pk,
-            support_contact=request.user
-        ).exists()
+        return obj.support_contact_id == request.user.id
+
+    @staticmethod
+    def scope(user):
+        return Q(support_contact=user.id)
 
 
-class IsEventContractSalesContact(BasePermission):
+class IsEventContractSalesContact(OwnershipPermission):
     message = (
         "Sorry, you don't have permission to access "
         "informations related to this event."
@@ -101,6 +138,127 @@ class IsEventContractSalesContact(BasePermission):
     )
 
     def has_object_permission(self, request, view, obj):
-        return Event.objects.filter(
-            pk=obj.pk, contract__client__sales_contact=request.user
-        ).exists()
+        return obj.contract.client.sales_contact_id == request.user.id
+
+    @staticmethod
+    def scope(user):
+        return Q(contract__client__sales_contact=user.id)
+
+
+class DenyAll(BasePermission):
+    message = "Sorry, this action isn't available"
+
+    def has_permission(self, request, view):
+        return False
+
+
+# (viewset basename, method, detail request): permissions
+# every permission must be granted, as in permission_classes
+PERMISSION_RULES = {
+    ("clients", "GET", False): (
+        IsAuthenticated,
+        IsManagementTeam | IsSalesTeam | IsSupportTeam,
+    ),
+    ("clients", "GET", True): (
+        IsAuthenticated,
+        IsManagementTeam |
+        (IsSalesTeam & IsClientSalesContact) |
+        (IsSupportTeam & IsClientEventSupportContact),
+    ),
+    ("clients", "PUT", True): (
+        IsAuthenticated,
+        IsManagementTeam | (IsSalesTeam & IsClientSalesContact),
+    ),
+    ("clients", "DELETE", True): (
+        IsAuthenticated,
+        IsManagementTeam | (IsSalesTeam & IsClientSalesContact),
+    ),
+    ("clients", "POST", False): (
+        IsAuthenticated,
+        IsManagementTeam | IsSalesTeam,
+    ),
+    ("contracts", "GET", False): (
+        IsAuthenticated,
+        IsManagementTeam | IsSalesTeam | IsSupportTeam,
+    ),
+    ("contracts", "GET", True): (
+        IsAuthenticated,
+        IsManagementTeam | (IsSalesTeam & IsContractSalesContact),
+    ),
+    ("contracts", "PUT", True): (
+        IsAuthenticated,
+        IsManagementTeam | (IsSalesTeam & IsContractSalesContact),
+    ),
+    ("contracts", "DELETE", True): (
+        IsAuthenticated,
+        IsManagementTeam | (IsSalesTeam & IsContractSalesContact),
+    ),
+    ("contracts", "POST", False): (
+        IsAuthenticated,
+        IsManagementTeam | IsSalesTeam,
+    ),
+    ("events", "GET", False): (
+        IsAuthenticated,
+        IsManagementTeam | IsSalesTeam | IsSupportTeam,
+    ),
+    ("events", "GET", True): (
+        IsAuthenticated,
+        IsManagementTeam |
+        (IsSalesTeam & IsEventContractSalesContact) |
+        (IsSupportTeam & IsEventSupportContact),
+    ),
+    ("events", "PUT", True): (
+        IsAuthenticated,
+        IsManagementTeam |
+        (IsSalesTeam & IsEventContractSalesContact) |
+        (IsSupportTeam & IsEventSupportContact),
+    ),
+    ("events", "DELETE", True): (
+        IsAuthenticated,
+        IsManagementTeam | (IsSalesTeam & IsEventContractSalesContact),
+    ),
+    ("events", "POST", False): (
+        IsAuthenticated,
+        IsManagementTeam | IsSalesTeam,
+    ),
+    # batch of status changes, each event is looked up in the caller's ones
+    ("events", "PATCH", False): (
+        IsAuthenticated,
+        IsManagementTeam | IsSalesTeam | IsSupportTeam,
+    ),
+    ("user", "GET", False): (IsAuthenticated, IsManagementTeam),
+    ("user", "GET", True): (IsAuthenticated, IsManagementTeam),
+    ("user", "PUT", True): (IsAuthenticated, IsManagementTeam),
+    ("user", "DELETE", True): (IsAuthenticated, IsManagementTeam),
+    ("user", "POST", False): (IsAuthenticated, IsManagementTeam),
+    # reassignment of the clients or events of a user
+    ("user", "POST", True): (IsAuthenticated, IsManagementTeam),
+}
+
+
+def compile_rules(rules):
+    """
+    instantiates every rule once,
+    permissions keep no state so instances are shared by requests
+    """
+    return {
+        key: tuple(permission() for permission in permissions)
+        for key, permissions in rules.items()
+    }
+
+
+PERMISSION_MATRIX = compile_rules(PERMISSION_RULES)
+DENIED = (DenyAll(),)
+
+
+class PermissionMatrixMixin:
+    """
+    reads the permissions of the request in PERMISSION_MATRIX,
+    a request without rule is denied
+    """
+    def get_permissions(self):
+        method = self.request.method
+        if method == "HEAD":
+            method = "GET"
+        detail = "pk" in self.request.parser_context["kwargs"]
+        return PERMISSION_MATRIX.get((self.basename, method, detail), DENIED)
@@ -0,0 +1,263 @@
+import asyncio
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from .metrics import async_execute_wrapper
+from .permissions import is_member
+
+profiling_logger = logging.getLogger("profiling")
+
+PROFILING = getattr(settings, "PROFILING", {})
+
+# steps of a request, in the order of the Server-Timing header
+STEPS = ("sql", "perm", "queryset", "serialize", "render", "total")
+
+# profile of the request being handled, None when it isn't profiled
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+class Profile:
+    def __init__(self, confirmed=True):
+        # step: seconds
+        self.durations = defaultdict(float)
+        self.queries = 0
+        # a profile asked with X-Profile is kept once the caller
+        # is known to be a management user
+        self.confirmed = confirmed
+
+    def add(self, step, duration):
+        self.durations[step] += duration
+
+    def execute(self, execute, sql, params, many, context):
+        # connection.execute_wrapper, times every query
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.add("sql", time.perf_counter() - start)
+
+    def server_timing(self):
+        metrics = []
+        for step in STEPS:
+            if step not in self.durations:
+                continue
+            metric = f"{step};dur={self.durations[step] * 1000:.1f}"
+            if step == "sql":
+                metric += f';desc="{self.queries} queries"'
+            metrics.append(metric)
+        return ", ".join(metrics)
+
+
+@contextmanager
+def measure(step, excluded=()):
+    """
+    adds the time of the block to step,
+    less the time of the excluded steps measured meanwhile
+    """
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    nested = sum(profile.durations[name] for name in excluded)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        nested = sum(profile.durations[name] for name in excluded) - nested
+        profile.add(step, time.perf_counter() - start - nested)
+
+
+def timed(step, function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with measure(step):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+class Aggregate:
+    """
+    sums of the profiles of each endpoint, logged then reset
+    every LOG_INTERVAL seconds by the request ending the interval
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # endpoint: [requests, queries, {step: seconds}, max total]
+        self.endpoints = {}
+        self.started = time.monotonic()
+
+    def add(self, endpoint, profile):
+        with self._lock:
+            stats = self.endpoints.setdefault(
+                endpoint, [0, 0, defaultdict(float), 0]
+            )
+            stats[0] += 1
+            stats[1] += profile.queries
+            for step, duration in profile.durations.items():
+                stats[2][step] += duration
+            stats[3] = max(stats[3], profile.durations["total"])
+            if time.monotonic() - self.started < PROFILING.get(
+                    "LOG_INTERVAL", 60):
+                return
+            endpoints = self.endpoints
+            self.reset()
+        for endpoint, (requests, queries, durations, slowest) in sorted(
+                endpoints.items()):
+            averages = ", ".join(
+                f"{step} {durations[step] / requests * 1000:.1f}ms"
+                for step in STEPS if step in durations
+            )
+            profiling_logger.info(
+                "%s: %s requests, %.1f queries, %s, max %.1fms",
+                endpoint, requests, queries / requests, averages,
+                slowest * 1000
+            )
+
+
+aggregate = Aggregate()
+
+
+def is_sampled():
+    return random.random() < PROFILING.get("SAMPLE_RATE", 0.01)
+
+
+def is_profiled(request, sampled):
+    return PROFILING.get("ENABLED", True) and (
+        sampled or "HTTP_X_PROFILE" in request.META
+    )
+
+
+def is_management(request):
+    return is_member(getattr(request, "user", None), "Management team")
+
+
+class ProfilingMiddleware:
+    """
+    profiles a sample of the requests (SAMPLE_RATE of PROFILING)
+    and the ones of management users with a X-Profile header: number
+    and time of the queries and time of the steps timed by ProfilingMixin
+    management users get them in a Server-Timing header,
+    every profile is added to the aggregate logged by "profiling"
+    the api users are only known once authenticated by the view,
+    a X-Profile header starts a profile ProfilingMixin confirms
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # awaited by the handler, as MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        else:
+            self._is_coroutine = None
+
+    def __call__(self, request):
+        if self._is_coroutine:
+            return self.__acall__(request)
+        sampled = is_sampled()
+        if not is_profiled(request, sampled):
+            return self.get_response(request)
+        profile = Profile(confirmed=sampled or is_management(request))
+        token = current_profile.set(profile)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(profile.execute):
+                response = self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        if profile.confirmed:
+            profile.add("total", time.perf_counter() - start)
+            self.report(request, response, profile, is_management(request))
+        return response
+
+    async def __acall__(self, request):
+        sampled = is_sampled()
+        if not is_profiled(request, sampled):
+            return await self.get_response(request)
+        # the user of a session is loaded by a query
+        management = sync_to_async(is_management)
+        profile = Profile(confirmed=sampled or await management(request))
+        # copied with the context to the threads of the sync views
+        token = current_profile.set(profile)
+        start = time.perf_counter()
+        try:
+            async with async_execute_wrapper(profile.execute):
+                response = await self.get_response(request)
+        finally:
+            current_profile.reset(token)
+        if profile.confirmed:
+            profile.add("total", time.perf_counter() - start)
+            self.report(request, response, profile, await management(request))
+        return response
+
+    @staticmethod
+    def report(request, response, profile, management):
+        if management:
+            response["Server-Timing"] = profile.server_timing()
+        match = request.resolver_match
+        endpoint = match.view_name if match else "unresolved"
+        aggregate.add(f"{request.method} {endpoint}", profile)
+
+
+class ProfilingMixin:
+    """
+    times the permission checks, get_queryset, list and retrieve
+    without them (filters, pagination and serializers)
+    and the rendering of the requests profiled by ProfilingMiddleware
+    """
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # viewsets define their own get_queryset, timed where defined
+        if "get_queryset" in cls.__dict__:
+            cls.get_queryset = timed("queryset", cls.__dict__["get_queryset"])
+
+    def perform_authentication(self, request):
+        super().perform_authentication(request)
+        profile = current_profile.get()
+        if profile is not None and not profile.confirmed:
+            profile.confirmed = is_member(request.user, "Management team")
+
+    def check_permissions(self, request):
+        with measure("perm"):
+            super().check_permissions(request)
+
+    def check_object_permissions(self, request, obj):
+        with measure("perm"):
+            super().check_object_permissions(request, obj)
+
+    def list(self, request, *args, **kwargs):
+        with measure("serialize", excluded=("perm", "queryset")):
+            return super().list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        with measure("serialize", excluded=("perm", "queryset")):
+            return super().retrieve(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(
+            request, response, *args, **kwargs
+        )
+        profile = current_profile.get()
+        if profile is not None and hasattr(
+                response, "add_post_render_callback"):
+            # rendered by django once the view has returned
+            start = time.perf_counter()
+            response.add_post_render_callback(
+                lambda rendered: profile.add(
+                    "render", time.perf_counter() - start
+                )
+            )
+        return response
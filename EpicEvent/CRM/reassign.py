@@ -0,0 +1,82 @@
+import datetime
+from django.db import transaction
+from django.db.models import (
+    Case,
+    F,
+    Value,
+    When
+)
+from django.db.models.functions import Mod
+from django.db.models.lookups import Exact
+from authentication.models import User
+from .versions import bump_version
+from .models import (
+    Client,
+    Event
+)
+
+# role: (model, contact field, team of the contacts)
+ROLES = {
+    "sales_contact": (Client, "sales_contact", "Sales team"),
+    "support_contact": (Event, "support_contact", "Support team"),
+}
+
+# rows counted at most by the delete check of a user
+OWNED_COUNT_LIMIT = 100
+
+
+def team_members(role, exclude=()):
+    """
+    ids of the users who can take over the rows of role
+    """
+    team = ROLES[role][2]
+    return list(
+        User.objects.filter(groups__name=team)
+        .exclude(id__in=exclude)
+        .order_by("id")
+        .values_list("id", flat=True)
+    )
+
+
+def reassign(role, from_users, to_users, dry_run=False):
+    """
+    moves the rows of role owned by from_users to to_users
+    in one UPDATE, rows being spread over to_users by id
+    returns the number of rows moved, or to be moved on a dry run
+    """
+    model, field, _ = ROLES[role]
+    queryset = model.objects.filter(**{f"{field}__in": from_users})
+    if dry_run:
+        return queryset.count()
+    if len(to_users) == 1:
+        new_contact = Value(to_users[0])
+    else:
+        new_contact = Case(*[
+            When(
+                Exact(Mod(F("id"), len(to_users)), index),
+                then=Value(user_id)
+            )
+            for index, user_id in enumerate(to_users)
+        ])
+    with transaction.atomic():
+        moved = queryset.update(**{
+            f"{field}_id": new_contact,
+            "date_updated": datetime.datetime.now(),
+        })
+    if moved:
+        # update sends no signal
+        bump_version(model)
+    return moved
+
+
+def owned_counts(user):
+    """
+    clients and events of user, each counted up to OWNED_COUNT_LIMIT + 1
+    so the check stays bounded whatever the size of their book
+    """
+    return {
+        str(model._meta.verbose_name_plural): model.objects.filter(
+            **{field: user}
+        ).values("id")[:OWNED_COUNT_LIMIT + 1].count()
+        for model, field, _ in ROLES.values()
+    }
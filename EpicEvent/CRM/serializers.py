@@ -1,12 +1,16 @@
-from rest_framework import serializers
+from rest_framework import (
+    serializers,
+    status
+)
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from .models import (
     Client,
     Contract,
     Event
 )
 from authentication.models import User
-from authentication.serializers import UserListSerializer
+from authentication.serializers import SalesContactSerializer
 from authentication.validators import Validators
 import datetime
 
@@ -16,12 +20,10 @@ class ClientListSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def get_sales_contact(instance):
-        queryset = User.objects.filter(id=instance.sales_contact.id)
-        serializer = UserListSerializer(queryset, many=True)
-        # we only need sales_contact id, first_name and last_name
-        for saler in serializer.data:
-            del (saler['username'])
-            del (saler['groups'])
+        # sales_contact is loaded with the client by the viewset queryset
+        serializer = SalesContactSerializer(
+            [instance.sales_contact], many=True
+        )
         return serializer.data
 
     class Meta:
@@ -42,12 +44,10 @@ class ClientDetailSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def get_sales_contact(instance):
-        queryset = User.objects.filter(id=instance.sales_contact.id)
-        serializer = UserListSerializer(queryset, many=True)
-        # we only need sales_contact id, first_name and last_name
-        for saler in serializer.data:
-            del (saler['username'])
-            del (saler['groups'])
+        # sales_contact is loaded with the client by the viewset queryset
+        serializer = SalesContactSerializer(
+            [instance.sales_contact], many=True
+        )
         return serializer.data
 
     class Meta:
@@ -75,8 +75,7 @@ class ClientDetailSerializer(serializers.ModelSerializer):
         return data
 
     def create(self, validated_data):
-        if self.context['request'].user.groups.filter(
-                name="Management team").exists():
+        if self.context['request'].user.get_team() == "Management team":
             if "contact" not in validated_data:
                 raise serializers.ValidationError(
                     {
@@ -84,14 +83,16 @@ class ClientDetailSerializer(serializers.ModelSerializer):
                     }
                 )
             try:
-                sales_contact = User.objects.get(id=validated_data["contact"])
+                sales_contact = User.objects.with_team().get(
+                    id=validated_data["contact"]
+                )
             except User.DoesNotExist:
                 raise serializers.ValidationError(
                     {
                         "sales_contact error": "This user doesn't exist."
                     }
                 )
-            if not sales_contact.groups.filter(name="Sales team").exists():
+            if sales_contact.get_team() != "Sales team":
                 raise serializers.ValidationError(
                     {
                         "sales_contact error":
@@ -116,11 +117,10 @@ class ClientDetailSerializer(serializers.ModelSerializer):
 
     def update(self, instance, validated_data):
         instance = super().update(instance, validated_data)
-        if self.context['request'].user.groups.filter(
-                name="Management team").exists():
+        if self.context['request'].user.get_team() == "Management team":
             if "contact" in validated_data:
                 try:
-                    sales_contact = User.objects.get(
+                    sales_contact = User.objects.with_team().get(
                         id=validated_data["contact"]
                     )
                 except User.DoesNotExist:
@@ -129,7 +129,7 @@ class ClientDetailSerializer(serializers.ModelSerializer):
                             "sales_contact error": "This user doesn't exist."
                         }
                     )
-                if not sales_contact.groups.filter(name="Sales team").exists():
+                if sales_contact.get_team() != "Sales team":
                     raise serializers.ValidationError(
                         {
                             "sales_contact error":
@@ -142,13 +142,95 @@ class ClientDetailSerializer(serializers.ModelSerializer):
         return instance
 
 
+def multi_status(results, ok_status):
+    """
+    status of the response to a batch from the result of each item:
+    ok_status when every item succeeded, 207 when some did, 400 otherwise
+    """
+    succeeded = sum(result["status"] == ok_status for result in results)
+    if succeeded == len(results):
+        return ok_status
+    if succeeded:
+        return status.HTTP_207_MULTI_STATUS
+    return status.HTTP_400_BAD_REQUEST
+
+
+def bulk_create_clients(items, context, batch_size=500):
+    """
+    validates every item, loads the sales contacts they reference
+    in one query and inserts the valid ones with bulk_create
+    in one transaction
+    returns, in order, the result of each item :
+    {"index", "status": 201, "client"} or {"index", "status": 400, "errors"}
+    """
+    user = context['request'].user
+    is_management = user.get_team() == "Management team"
+    serializers_ = [
+        ClientDetailSerializer(data=item, context=context) for item in items
+    ]
+    valid = [serializer.is_valid() for serializer in serializers_]
+    contacts = {}
+    if is_management:
+        contacts = User.objects.with_team().in_bulk({
+            serializer.validated_data["contact"]
+            for serializer, is_valid in zip(serializers_, valid)
+            if is_valid and "contact" in serializer.validated_data
+        })
+    results = []
+    clients = []
+    now = datetime.datetime.now()
+    for index, (serializer, is_valid) in enumerate(zip(serializers_, valid)):
+        if not is_valid:
+            results.append(
+                {"index": index, "status": 400, "errors": serializer.errors}
+            )
+            continue
+        data = serializer.validated_data
+        sales_contact = user
+        if is_management:
+            sales_contact = contacts.get(data.get("contact"))
+            error = None
+            if "contact" not in data:
+                error = "Please fill 'contact' field"
+            elif sales_contact is None:
+                error = "This user doesn't exist."
+            elif sales_contact.get_team() != "Sales team":
+                error = "Please choose a user belonging to Sales team"
+            if error:
+                results.append({
+                    "index": index,
+                    "status": 400,
+                    "errors": {"sales_contact error": error}
+                })
+                continue
+        client = Client(
+            first_name=data["first_name"].title(),
+            last_name=data["last_name"].title(),
+            email=data["email"],
+            phone=data["phone"],
+            mobile=data["mobile"],
+            company_name=data["company_name"],
+            sales_contact=sales_contact,
+            date_created=now,
+            date_updated=now
+        )
+        clients.append(client)
+        results.append({"index": index, "status": 201, "client": client})
+    with transaction.atomic():
+        Client.objects.bulk_create(clients, batch_size=batch_size)
+    for result in results:
+        if "client" in result:
+            result["client"] = ClientListSerializer(result["client"]).data
+    return results
+
+
 class ContractListSerializer(serializers.ModelSerializer):
     client = serializers.SerializerMethodField()
 
     @staticmethod
     def get_client(instance):
-        queryset = Client.objects.filter(id=instance.client.id)
-        serializer = ClientListSerializer(queryset, many=True)
+        # client and its sales_contact are loaded with the contract
+        serializer = ClientListSerializer([instance.client], many=True)
         return serializer.data
 
     class Meta:
@@ -183,8 +265,8 @@ class ContractDetailSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def get_client(instance):
-        queryset = Client.objects.filter(id=instance.client.id)
-        serializer = ClientListSerializer(queryset, many=True)
+        # client and its sales_contact are loaded with the contract
+        serializer = ClientListSerializer([instance.client], many=True)
         return serializer.data
 
     def validate_id_client(self, value):
@@ -192,9 +274,8 @@ class ContractDetailSerializer(serializers.ModelSerializer):
         request_user = self.context['request'].user
         if not client:
             raise ValidationError(f"Sorry, client {value} doesn't exist")
-        if request_user.groups.filter(
-                name="Sales team").exists() \
-                and client.sales_contact != request_user:
+        if request_user.get_team() == "Sales team" \
+                and client.sales_contact_id != request_user.id:
             raise ValidationError(
                 "Sorry, you are not the sales contact of this client")
         if self.context['request'].method == "POST":
@@ -238,7 +319,9 @@ class ContractDetailSerializer(serializers.ModelSerializer):
     def update(self, instance, validated_data):
         instance = super().update(instance, validated_data)
         instance.date_updated = datetime.datetime.now()
-        instance.client = Client.objects.get(id=validated_data['id_client'])
+        instance.client = Client.objects.select_related(
+            "sales_contact"
+        ).get(id=validated_data['id_client'])
         instance.save()
         return instance
 
@@ -308,9 +391,8 @@ class EventDetailSerializer(serializers.ModelSerializer):
                 raise ValidationError(
                     "Sorry, there's already an event "
                     "associated with this contract")
-        if request_user.groups.filter(
-                name="Sales team"
-        ).exists() and contract.client.sales_contact != request_user:
+        if request_user.get_team() == "Sales team" \
+                and contract.client.sales_contact_id != request_user.id:
             raise ValidationError(
                 "Sorry, you are not the sales contact of this client")
         if not contract.status:
@@ -331,34 +413,38 @@ class EventDetailSerializer(serializers.ModelSerializer):
 
     def validate_support_contact(self, value):
         request_user = self.context['request'].user
-        if request_user.groups.filter(name="Sales team").exists():
+        if request_user.get_team() == "Sales team":
             raise ValidationError(
                 "Only users of management team "
                 "can change/add support_contact. "
                 "Please dont't use this field."
             )
         try:
-            support_contact = User.objects.get(id=value)
-            if not support_contact.groups.filter(name="Support team").exists():
+            support_contact = User.objects.with_team().get(id=value)
+            if support_contact.get_team() != "Support team":
                 raise ValidationError(
                     f"Sorry, user {value} isn't member of support team")
         except User.DoesNotExist:
             raise ValidationError(f"Sorry, user {value} doesn't exist")
         return support_contact
 
-    def validate(self, data):
-        if (data['event_date'] > datetime.datetime.now()
-                and data['event_status'] in [2, 3]):
+    @staticmethod
+    def check_status(event_date, event_status):
+        if (event_date > datetime.datetime.now()
+                and event_status in [2, 3]):
             raise ValidationError(
                 {"event_status": "This event can't be in progress"
                                  " or closed since its date "
                                  "is later than the current date"})
-        elif (data['event_date'] < datetime.datetime.now()
-              and data['event_status'] == 1):
+        elif (event_date < datetime.datetime.now()
+              and event_status == 1):
             raise ValidationError(
                 {"event_status": "This event can't be incoming "
                                  "since its date is earlier "
                                  "than the current date"})
+
+    def validate(self, data):
+        self.check_status(data['event_date'], data['event_status'])
         return data
 
     def create(self, validated_data):
@@ -383,3 +469,79 @@ class EventDetailSerializer(serializers.ModelSerializer):
         instance.date_updated = datetime.datetime.now()
         instance.save()
         return instance
+
+
+class EventStatusSerializer(serializers.Serializer):
+    """
+    an item of a batch of event status changes
+    """
+    event_id = serializers.IntegerField()
+    event_status = serializers.CharField()
+    notes = serializers.CharField(required=False, allow_blank=True)
+
+    validate_event_status = staticmethod(
+        EventDetailSerializer.validate_event_status
+    )
+
+
+def bulk_update_event_status(items, queryset, batch_size=500):
+    """
+    checks every item against the date of its event, the events being
+    loaded from queryset, the caller's events, in one query,
+    and saves the valid ones with bulk_update in one transaction
+    returns, in order, the result of each item :
+    {"index", "event_id", "status": 200} or
+    {"index", "event_id", "status": 400 or 404, "errors"}
+    """
+    serializers_ = [EventStatusSerializer(data=item) for item in items]
+    valid = [serializer.is_valid() for serializer in serializers_]
+    events = queryset.only(
+        "id", "event_date", "event_status", "notes"
+    ).in_bulk({
+        serializer.validated_data["event_id"]
+        for serializer, is_valid in zip(serializers_, valid)
+        if is_valid
+    })
+    results = []
+    changed = {}
+    now = datetime.datetime.now()
+    for index, (serializer, is_valid) in enumerate(zip(serializers_, valid)):
+        item = serializer.initial_data
+        event_id = item.get("event_id") if isinstance(item, dict) else None
+        result = {"index": index, "event_id": event_id}
+        results.append(result)
+        if not is_valid:
+            result.update(status=400, errors=serializer.errors)
+            continue
+        data = serializer.validated_data
+        event = events.get(data["event_id"])
+        if event is None:
+            result.update(status=404, errors={
+                "event_id": f"Sorry, event {data['event_id']} doesn't exist"
+            })
+            continue
+        if event.pk in changed:
+            result.update(status=400, errors={
+                "event_id": "This event is already changed by this batch"
+            })
+            continue
+        try:
+            EventDetailSerializer.check_status(
+                event.event_date, data["event_status"]
+            )
+        except ValidationError as error:
+            result.update(status=400, errors=error.message_dict)
+            continue
+        event.event_status = str(data["event_status"])
+        if "notes" in data:
+            event.notes = data["notes"]
+        event.date_updated = now
+        changed[event.pk] = event
+        result["status"] = 200
+    with transaction.atomic():
+        Event.objects.bulk_update(
+            changed.values(),
+            ["event_status", "notes", "date_updated"],
+            batch_size=batch_size
+        )
+    return results
@@ -6,8 +6,17 @@ from CRM.models import (
     Event
 )
 from authentication.models import User
+from authentication.authentication import (
+    token_cache,
+    user_cache
+)
+from authentication.throttle import login_throttle
+from CRM.cache import get_cache
+from CRM.nplusone import NPLUSONE
+from unittest import mock
 from django.contrib.auth.models import Group
 import datetime
+import tempfile
 
 
 class Data(APITestCase):
@@ -160,3 +169,46 @@ class Data(APITestCase):
             date_created=cls.date_now,
             date_updated=cls.date_now,
         )
+
+    def setUp(self):
+        # caches outlive the rollback of the previous test
+        get_cache().clear()
+        user_cache.clear()
+        token_cache.clear()
+        login_throttle.buckets.clear()
+
+
+class DetectRepeatedQueries:
+    """
+    opt-in of a test class: a request of its tests repeating
+    a statement more than NPLUSONE THRESHOLD times, as a query per row,
+    raises RepeatedQueriesError with the stack of the query
+    """
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(
+            NPLUSONE, {"ENABLED": True, "ACTION": "raise"}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class SharedCache:
+    """
+    opt-in of a test class: the cache of RESPONSE_CACHE is a
+    FileBasedCache, shared by the processes as in production,
+    so the ETags hold the versions and the response cache can be enabled
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        shared = self.settings(CACHES={
+            "default": {
+                "BACKEND": "django.core.cache.backends."
+                           "filebased.FileBasedCache",
+                "LOCATION": directory.name,
+            }
+        })
+        shared.enable()
+        self.addCleanup(shared.disable)
+        super().setUp()
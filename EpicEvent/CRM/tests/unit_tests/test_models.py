@@ -1,9 +1,28 @@
-from django.test import TestCase
+from django.contrib import admin
+from django.test import (
+    RequestFactory,
+    TestCase
+)
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from rest_framework.test import (
+    APIRequestFactory,
+    force_authenticate
+)
 from CRM.models import (
     Client,
     Contract,
     Event
 )
+from CRM.views import (
+    ClientViewset,
+    ContractViewset,
+    EventViewset
+)
+from authentication.admin import (
+    ClientAdmin,
+    CustomUserAdmin
+)
 from authentication.models import User
 from django.contrib.auth.models import Group
 import datetime
@@ -359,3 +378,156 @@ class EventTest(DataTest):
         self.assertEqual(self.event1.date_updated, self.date_update_event_5)
         self.assertEqual(self.event2.date_updated, self.date_now)
         self.assertEqual(self.event3.date_updated, self.date_past)
+
+
+class IndexTest(DataTest):
+    """
+    Check with EXPLAIN that the queries built by the viewsets
+    and the admin are served by their index
+    """
+
+    def setUp(self):
+        self.create_dates()
+        self.get_groups()
+        self.get_users()
+        self.get_clients()
+        self.get_contracts()
+        self.get_events()
+
+    def disable_seqscan(self):
+        if connection.vendor == "postgresql":
+            # on such small tables, the planner would rather scan them
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def explain(self, sql):
+        prefix = "EXPLAIN QUERY PLAN" if connection.vendor == "sqlite" \
+            else "EXPLAIN"
+        with connection.cursor() as cursor:
+            cursor.execute(f"{prefix} {sql}")
+            return "\n".join(str(row) for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, index_name):
+        self.disable_seqscan()
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, f"plan:\n{plan}")
+
+    def assertRunsOnIndex(self, function, index_name, sqlite_index=None):
+        """
+        one of the queries run by function is served by index_name,
+        or sqlite_index on SQLite, which plans without statistics
+        """
+        if connection.vendor == "sqlite" and sqlite_index:
+            index_name = sqlite_index
+        with CaptureQueriesContext(connection) as queries:
+            function()
+        self.disable_seqscan()
+        plans = [self.explain(query["sql"]) for query in queries]
+        self.assertTrue(
+            any(index_name in plan for plan in plans),
+            "\n".join(f"{query['sql']}\n{plan}"
+                      for query, plan in zip(queries, plans))
+        )
+
+    def list_queryset(self, viewset, user, team, query=""):
+        """
+        rows of a list request, filtered, scoped to the team of user
+        and paginated as by viewset
+        """
+        user.team = team
+        request = APIRequestFactory().get(f"/?{query}")
+        force_authenticate(request, user)
+        view = viewset(
+            action_map={"get": "list"}, args=(), kwargs={}, format_kwarg=None
+        )
+        view.request = view.initialize_request(request)
+        queryset = view.filter_queryset(view.get_queryset())
+        paginator = view.paginator
+        ordering = paginator.get_ordering(view.request, queryset, view)
+        return queryset.order_by(*ordering)[:paginator.page_size + 1]
+
+    def test_list_queries(self):
+        manager = self.user_manager1
+        self.assertUsesIndex(
+            self.list_queryset(
+                ClientViewset, manager, "Management team",
+                "email=pipo@null.com"
+            ),
+            "client_email_idx")
+        self.assertUsesIndex(
+            self.list_queryset(
+                ClientViewset, manager, "Management team", "last_name=Bidon"
+            ),
+            "client_last_name_idx")
+        self.assertUsesIndex(
+            self.list_queryset(
+                ContractViewset, manager, "Management team",
+                f"client={self.client1.id}"
+            ),
+            "contract_client_status_idx")
+        self.assertUsesIndex(
+            self.list_queryset(
+                ContractViewset, manager, "Management team",
+                f"client={self.client1.id}&status=True"
+            ),
+            "contract_signed_client_idx")
+        self.assertUsesIndex(
+            self.list_queryset(
+                EventViewset, manager, "Management team", "event_status=3"
+            ),
+            "event_status_idx")
+
+    def test_payment_due_range(self):
+        if connection.vendor != "postgresql":
+            self.skipTest("SQLite reads contract_created_id_idx in order")
+        self.assertUsesIndex(
+            self.list_queryset(
+                ContractViewset, self.user_manager1, "Management team",
+                "payment_due__lte=2030-01-01"
+            ),
+            "contract_payment_due_idx")
+
+    def test_case_insensitive_last_name(self):
+        if connection.vendor != "postgresql":
+            self.skipTest("iexact only compares UPPER() on PostgreSQL")
+        self.assertUsesIndex(
+            self.list_queryset(
+                ClientViewset, self.user_manager1, "Management team",
+                "last_name__iexact=bidon"
+            ),
+            "client_upper_last_name_idx")
+
+    def test_scope_queries(self):
+        # the list scopes, the ownership rules of the permissions
+        # in SQL (IsClientSalesContact and IsEventSupportContact),
+        # the object permissions of a detail are checked in memory
+        self.assertUsesIndex(
+            self.list_queryset(ClientViewset, self.user_sales1, "Sales team"),
+            "client_sales_created_idx")
+        self.assertUsesIndex(
+            self.list_queryset(
+                EventViewset, self.user_support1, "Support team"
+            ),
+            "event_support_date_idx")
+
+    def test_admin_queries(self):
+        # ClientAdmin.status, CustomUserAdmin.number_of_clients
+        # and ClientAdmin list_filter
+        self.assertRunsOnIndex(
+            lambda: ClientAdmin(Client, admin.site).status(self.client1),
+            "contract_signed_client_idx",
+            # covers the whole condition
+            sqlite_index="contract_client_status_idx")
+        Group.objects.create(name="Sales team").user_set.add(self.user_sales1)
+        self.assertRunsOnIndex(
+            lambda: CustomUserAdmin(User, admin.site).number_of_clients(
+                self.user_sales1
+            ),
+            "client_sales_created_idx")
+        request = RequestFactory().get("/admin/CRM/client/?last_name=Bidon")
+        request.user = self.user_manager1
+        changelist = ClientAdmin(Client, admin.site).get_changelist_instance(
+            request
+        )
+        self.assertUsesIndex(
+            changelist.get_queryset(request), "client_last_name_idx")
@@ -1,12 +1,95 @@
+from asgiref.sync import sync_to_async
 from django.urls import reverse
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.exceptions import ImproperlyConfigured
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connection
+from django.http import HttpResponse
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TransactionTestCase
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date
 from authentication.models import User
+from authentication import provisioning
+from authentication.provisioning import (
+    allocate_usernames,
+    hash_passwords
+)
+from authentication.throttle import (
+    LOGIN_THROTTLE,
+    CacheBuckets,
+    LoginThrottle,
+    client_ip
+)
+from django.contrib.auth.hashers import check_password
 from CRM.models import (
     Client,
     Contract,
     Event
 )
-from .data_for_tests import Data
+from CRM import metrics
+from CRM.filters import FilterSpec
+from CRM.importer import (
+    COPY_NULL,
+    copy_line
+)
+from CRM.nplusone import (
+    NPLUSONE,
+    NPlusOneMiddleware,
+    RepeatedQueriesError,
+    detect_repeated_queries,
+    fingerprint
+)
+from CRM.profiling import (
+    PROFILING,
+    ProfilingMiddleware,
+    aggregate,
+    current_profile
+)
+from CRM.reassign import OWNED_COUNT_LIMIT
+from CRM.serializers import multi_status
+from CRM.versions import (
+    RESPONSE_CACHE,
+    bump_version
+)
+from CRM.views import ClientViewset
+from EpicEvent.log_handlers import (
+    JsonFormatter,
+    QueueFileHandler
+)
+from .data_for_tests import (
+    Data,
+    DetectRepeatedQueries,
+    SharedCache
+)
+import asyncio
+import base64
+import bisect
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+from rest_framework_simplejwt.tokens import AccessToken
+from django.contrib.auth.models import Group
+from authentication.authentication import (
+    token_cache,
+    user_cache
+)
+from authentication.cache import LRUCache
+from unittest import mock
 from authentication.serializers import (
+    RegisterUserSerializer,
     UserListSerializer,
     UserDetailSerializer,
 )
@@ -25,6 +108,46 @@ class DataTest(Data):
         )
         return response.json()
 
+    def add_rows(self, number):
+        clients = Client.objects.bulk_create([
+            Client(
+                first_name="Han",
+                last_name="Solo",
+                email=f"han{index}@falcon.com",
+                phone="12345678",
+                mobile="888888",
+                company_name="Smugglers",
+                sales_contact=self.sales_user2,
+                date_created=self.date_now,
+                date_updated=self.date_now,
+            ) for index in range(number)
+        ])
+        contracts = Contract.objects.bulk_create([
+            Contract(
+                client=client,
+                status=True,
+                amount=1000,
+                payment_due=self.date_p20d,
+                date_created=self.date_now,
+                date_updated=self.date_now,
+            ) for client in clients
+        ])
+        Event.objects.bulk_create([
+            Event(
+                name="Kessel Run",
+                contract=contract,
+                support_contact=self.support_user2,
+                event_status='1',
+                attendees=2,
+                event_date=self.date_p20d,
+                date_created=self.date_now,
+                date_updated=self.date_now,
+            ) for contract in contracts
+        ])
+        # bulk_create sends no signal
+        for model in (Client, Contract, Event):
+            bump_version(model)
+
 
 class LoginTest(DataTest):
     def test_login_succes(self):
@@ -58,6 +181,66 @@ class LoginTest(DataTest):
             'No active account found with the given credentials')
         return resp.json()
 
+    def post_credentials(self, username, password="toto1234"):
+        return self.client.post(
+            reverse("login"),
+            {"username": username, "password": password},
+            format="json",
+        )
+
+    def test_login_in_one_query(self):
+        # the user, their team and the log read by the same query
+        with self.assertNumQueries(1), \
+                self.assertLogs("login_security", "INFO") as logs:
+            response = self.post_credentials(self.sales_user.username)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            AccessToken(response.json()["access"])["team"], "Sales team"
+        )
+        self.assertIn("user Yves Antou connected to API", logs.output[0])
+
+    def test_login_unknown_user_logged(self):
+        with self.assertLogs("login_security", "WARNING") as logs:
+            response = self.post_credentials("nobody")
+        self.assertEqual(response.status_code, 401)
+        self.assertIn("username nobody tried", logs.output[0])
+
+    def test_password_checked_by_password_pool(self):
+        threads = []
+
+        def check(password, encoded):
+            threads.append(threading.current_thread().name)
+            return check_password(password, encoded)
+
+        with mock.patch("authentication.login.check_password", check):
+            response = self.post_credentials(self.sales_user.username)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith("password-check"))
+
+    def test_login_wrong_password(self):
+        response = self.post_credentials(self.sales_user.username, "wrong")
+        self.assertEqual(response.status_code, 401)
+
+    def test_login_missing_password(self):
+        response = self.client.post(
+            reverse("login"), {"username": "yantou"}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json(), {"password": ["This field is required."]}
+        )
+
+    def test_too_many_logins(self):
+        pending_checks = threading.BoundedSemaphore(1)
+        pending_checks.acquire()
+        with mock.patch(
+                "authentication.login.pending_checks", pending_checks
+        ), self.assertNumQueries(0):
+            response = self.post_credentials(self.sales_user.username)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+
     def test_token_refresh(self):
         url = "/crm/token/refresh/"
         token = self.login(self.management_user)
@@ -85,17 +268,74 @@ class LoginTest(DataTest):
             response.json()['detail'],
             'Token is invalid or expired')
 
+    def test_token_carries_team(self):
+        token = AccessToken(self.login(self.sales_user)["access"])
+        self.assertEqual(token["team"], "Sales team")
+        self.assertEqual(token["role_version"], 0)
+
+    def test_token_refresh_after_team_change(self):
+        url = "/crm/token/refresh/"
+        token = self.login(self.support_user)
+        management_token = self.login(self.management_user)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + management_token["access"]
+        )
+        response = self.client.put(f"/crm/users/{self.support_user.id}/", {
+            "first_name": self.support_user.first_name,
+            "last_name": self.support_user.last_name,
+            "team": "Sales",
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            User.objects.get(id=self.support_user.id).role_version, 1
+        )
+        response = self.client.post(
+            url,
+            {
+                "refresh": token['refresh'],
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 401)
+        # a new login gives a token with the new team
+        token = AccessToken(self.login(self.support_user)["access"])
+        self.assertEqual(token["team"], "Sales team")
+
+    def test_token_refresh_same_team_kept(self):
+        url = "/crm/token/refresh/"
+        token = self.login(self.support_user)
+        management_token = self.login(self.management_user)
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer " + management_token["access"]
+        )
+        self.client.put(f"/crm/users/{self.support_user.id}/", {
+            "first_name": "Hella",
+            "last_name": self.support_user.last_name,
+            "team": "Support",
+        })
+        response = self.client.post(
+            url,
+            {
+                "refresh": token['refresh'],
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+
 
-class UserTest(DataTest):
+class UserTest(DetectRepeatedQueries, DataTest):
     def test_get_users_list(self):
         url = "/crm/users/"
         token = self.login(self.management_user)
         self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
         response = self.client.get(url, format="json")
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), User.objects.count())
-        list_usernames = [data['username'] for data in response.data]
-        list_last_names = [data['last_name'] for data in response.data]
+        self.assertEqual(
+            len(response.data['results']), User.objects.count())
+        list_usernames = [
+            data['username'] for data in response.data['results']]
+        list_last_names = [
+            data['last_name'] for data in response.data['results']]
         self.assertTrue(self.management_user.username in list_usernames)
         self.assertTrue(self.sales_user.last_name in list_last_names)
         self.assertTrue(
@@ -378,10 +618,12 @@ class UserTest(DataTest):
         clients = Client.objects.filter(sales_contact=self.sales_user)
         self.assertEqual(response.json()['Unauthorized delete'],
                          "This user is sales contact "
-                         "for the following clients :"
-                         f" {[client for client in clients]}. "
-                         f"You must change these clients sales contact "
-                         f"prior to delete this user.")
+                         f"for {clients.count()} clients "
+                         "and support contact for 0 events. "
+                         "You must reassign them "
+                         f"(POST /crm/users/{self.sales_user.id}/reassign/) "
+                         "prior to delete this user.")
+        self.assertEqual(response.json()['clients'], clients.count())
 
     def test_delete_a_user_event_support_contact(self):
         url = f"/crm/users/{self.support_user.id}/"
@@ -391,22 +633,136 @@ class UserTest(DataTest):
         self.assertEqual(response.status_code, 400)
         events = Event.objects.filter(support_contact=self.support_user)
         self.assertEqual(response.json()['Unauthorized delete'],
-                         "This user is support for the following events :"
-                         f" {[event for event in events]}. "
-                         f"You must change these events support contact "
+                         "This user is sales contact for 0 clients "
+                         f"and support contact for {events.count()} events. "
+                         "You must reassign them "
+                         f"(POST /crm/users/{self.support_user.id}/reassign/) "
                          "prior to delete this user.")
+        self.assertEqual(response.json()['events'], events.count())
+
+    def test_delete_a_user_owned_rows_count_is_bounded(self):
+        self.add_rows(OWNED_COUNT_LIMIT + 5)
+        url = f"/crm/users/{self.sales_user2.id}/"
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json()['clients'], f"more than {OWNED_COUNT_LIMIT}"
+        )
+
+
+class ReassignTest(DetectRepeatedQueries, DataTest):
+    def reassign(self, user, data):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        return self.client.post(
+            f"/crm/users/{user.id}/reassign/", data, format="json"
+        )
+
+    def test_reassign_clients_to_user(self):
+        count = Client.objects.filter(sales_contact=self.sales_user).count()
+        response = self.reassign(self.sales_user, {
+            "role": "sales_contact", "to": self.sales_user2.id
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], count)
+        self.assertFalse(
+            Client.objects.filter(sales_contact=self.sales_user).exists()
+        )
+        response = self.client.delete(f"/crm/users/{self.sales_user.id}/")
+        self.assertEqual(response.status_code, 204)
+
+    def test_reassign_is_one_update(self):
+        self.add_rows(30)
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(
+                f"/crm/users/{self.support_user2.id}/reassign/",
+                {"role": "support_contact", "to": self.support_user.id},
+                format="json"
+            )
+        updates = [
+            query for query in queries.captured_queries
+            if query["sql"].startswith("UPDATE")
+        ]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse(
+            Event.objects.filter(support_contact=self.support_user2).exists()
+        )
+
+    def test_dry_run(self):
+        count = Event.objects.filter(support_contact=self.support_user).count()
+        response = self.reassign(self.support_user, {
+            "role": "support_contact",
+            "to": self.support_user2.id,
+            "dry_run": True
+        })
+        self.assertEqual(response.json()["count"], count)
+        self.assertEqual(
+            Event.objects.filter(support_contact=self.support_user).count(),
+            count
+        )
+
+    def test_spread_across_team(self):
+        self.add_rows(10)
+        response = self.reassign(self.sales_user2, {"role": "sales_contact"})
+        self.assertEqual(response.status_code, 200)
+        team = set(response.json()["to"])
+        self.assertNotIn(self.sales_user2.id, team)
+        owners = set(
+            Client.objects.values_list("sales_contact", flat=True)
+        )
+        self.assertEqual(owners, team)
+
+    def test_reassign_to_other_team(self):
+        response = self.reassign(self.sales_user, {
+            "role": "sales_contact", "to": self.support_user.id
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json()["to"],
+            [f"Sorry, user {self.support_user.id} isn't member of Sales team"]
+        )
+
+    def test_reassign_unauthorized(self):
+        token = self.login(self.sales_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        response = self.client.post(
+            f"/crm/users/{self.sales_user.id}/reassign/",
+            {"role": "sales_contact", "to": self.sales_user2.id},
+            format="json"
+        )
+        self.assertEqual(response.status_code, 403)
+
+    def test_reassign_makes_responses_stale(self):
+        url = f"/crm/clients/{self.client1.id}/"
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        self.client.get(url)
+        self.reassign(self.sales_user, {
+            "role": "sales_contact", "to": self.sales_user2.id
+        })
+        response = self.client.get(url)
+        self.assertEqual(
+            response.json()["sales_contact"][0]["id"], self.sales_user2.id
+        )
 
 
-class ClientTest(DataTest):
+class ClientTest(DetectRepeatedQueries, DataTest):
     def test_get_client_list(self):
         url = "/crm/clients/"
         token = self.login(self.management_user)
         self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
         response = self.client.get(url, format="json")
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), Client.objects.count())
-        list_last_names = [data['last_name'] for data in response.data]
-        list_companies = [data['company_name'] for data in response.data]
+        self.assertEqual(
+            len(response.data['results']), Client.objects.count())
+        list_last_names = [
+            data['last_name'] for data in response.data['results']]
+        list_companies = [
+            data['company_name'] for data in response.data['results']]
         self.assertTrue(self.client1.last_name in list_last_names)
         self.assertTrue(self.client2.company_name in list_companies)
 
@@ -681,6 +1037,15 @@ class ClientTest(DataTest):
         self.assertEqual(response.json()['detail'],
                          "You do not have permission to perform this action.")
 
+    def test_partial_update_a_client_not_available(self):
+        url = f"/crm/clients/{self.client1.id}/"
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        response = self.client.patch(url, {"phone": "123"}, format="json")
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()['detail'],
+                         "Sorry, this action isn't available")
+
     def test_delete_a_client(self):
         url = f"/crm/clients/{self.client2.id}/"
         token = self.login(self.sales_user)
@@ -709,14 +1074,15 @@ class ClientTest(DataTest):
                          "You do not have permission to perform this action.")
 
 
-class ContractTest(DataTest):
+class ContractTest(DetectRepeatedQueries, DataTest):
     def test_get_contract_list(self):
         url = "/crm/contracts/"
-        token = self.login(self.support_user)
+        token = self.login(self.sales_user)
         self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
         response = self.client.get(url, format="json")
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), Contract.objects.count())
+        self.assertEqual(
+            len(response.data['results']), Contract.objects.count())
 
     def test_get_contract_list_with_incorrect_filter(self):
         url = "/crm/contracts/?xzk=2"
@@ -944,14 +1310,15 @@ class ContractTest(DataTest):
                          "You do not have permission to perform this action.")
 
 
-class EventTest(DataTest):
+class EventTest(DetectRepeatedQueries, DataTest):
     def test_get_event_list(self):
         url = "/crm/events/"
         token = self.login(self.support_user)
         self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
         response = self.client.get(url, format="json")
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), Event.objects.count())
+        self.assertEqual(
+            len(response.data['results']), Event.objects.count())
 
     def test_get_event_list_with_incorrect_filter(self):
         url = "/crm/events/?xzk=2"
@@ -1332,3 +1699,2007 @@ class EventTest(DataTest):
         self.assertEqual(response.status_code, 403)
         self.assertEqual(response.json()['detail'],
                          "You do not have permission to perform this action.")
+
+
+class QueryBudgetTest(SharedCache, DetectRepeatedQueries, DataTest):
+    """
+    the number of queries of a list endpoint
+    mustn't depend on the number of rows
+    """
+    # user lookup with their team, MAX/COUNT of the validators
+    # and list query
+    # budgets are measured with the user out of user_cache
+    list_query_budget = 3
+
+    def check_list_budget(self, url):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        user_cache.clear()
+        with self.assertNumQueries(self.list_query_budget):
+            response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, 200)
+
+    def check_all_lists(self):
+        for url in ["/crm/clients/", "/crm/contracts/", "/crm/events/"]:
+            with self.subTest(url=url):
+                self.check_list_budget(url)
+
+    def test_detail_query_budget(self):
+        # user lookup with their team and the row with its ownership chain
+        for user, url in [
+            (self.support_user, f"/crm/events/{self.event1.id}/"),
+            (self.sales_user, f"/crm/events/{self.event1.id}/"),
+            (self.support_user, f"/crm/clients/{self.client1.id}/"),
+            (self.sales_user, f"/crm/clients/{self.client1.id}/"),
+            (self.sales_user, f"/crm/contracts/{self.contract1.id}/"),
+        ]:
+            with self.subTest(user=user.username, url=url):
+                token = self.login(user)
+                self.client.credentials(
+                    HTTP_AUTHORIZATION="Bearer " + token["access"])
+                user_cache.clear()
+                with self.assertNumQueries(2):
+                    response = self.client.get(url, format="json")
+                self.assertEqual(response.status_code, 200)
+
+    def test_unauthorized_detail_query_budget(self):
+        token = self.login(self.support_user2)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        user_cache.clear()
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                f"/crm/clients/{self.client1.id}/", format="json")
+        self.assertEqual(response.status_code, 403)
+
+    def test_no_group_query_per_request(self):
+        out = io.StringIO()
+        call_command("bench_permissions", stdout=out)
+        self.assertIn("0.00 group queries per request", out.getvalue())
+
+    def test_list_query_budget_10_rows(self):
+        self.add_rows(10)
+        self.check_all_lists()
+
+    def test_list_query_budget_10000_rows(self):
+        self.add_rows(10000)
+        self.check_all_lists()
+
+
+class UserCacheTest(DataTest):
+    def get_events(self, user):
+        token = self.login(user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        return self.client.get("/crm/events/", format="json")
+
+    def test_cached_user_skips_user_lookup(self):
+        user_cache.clear()
+        hits, misses = user_cache.hits, user_cache.misses
+        self.get_events(self.management_user)
+        # only the list query
+        with self.assertNumQueries(1):
+            response = self.client.get("/crm/events/?id=1", format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(user_cache.hits - hits, 1)
+        self.assertEqual(user_cache.misses - misses, 1)
+
+    def test_saved_user_is_forgotten(self):
+        self.get_events(self.sales_user)
+        self.assertIsNotNone(user_cache.get(self.sales_user.id))
+        self.sales_user.first_name = "Lando"
+        self.sales_user.save()
+        self.assertIsNone(user_cache.get(self.sales_user.id))
+        self.client.get("/crm/events/", format="json")
+        self.assertEqual(
+            user_cache.get(self.sales_user.id).first_name, "Lando"
+        )
+
+    def test_deleted_user_is_forgotten(self):
+        self.get_events(self.support_user2)
+        self.support_user2.delete()
+        response = self.client.get("/crm/events/", format="json")
+        self.assertEqual(response.status_code, 401)
+
+    def test_group_change_forgets_user(self):
+        self.get_events(self.sales_user)
+        self.sales_user.groups.clear()
+        self.assertIsNone(user_cache.get(self.sales_user.id))
+        self.get_events(self.sales_user)
+        Group.objects.get(name="Sales team").user_set.remove(self.sales_user)
+        self.assertIsNone(user_cache.get(self.sales_user.id))
+
+    def test_least_recently_used_is_dropped(self):
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.get(1)
+        cache.set(3, "c")
+        self.assertEqual(cache.get(1), "a")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.stats()["size"], 2)
+
+    def test_entries_expire(self):
+        cache = LRUCache(max_size=2, ttl=60)
+        with mock.patch("authentication.cache.time.monotonic") as monotonic:
+            monotonic.return_value = 0
+            cache.set(1, "a")
+            monotonic.return_value = 59
+            self.assertEqual(cache.get(1), "a")
+            monotonic.return_value = 61
+            self.assertIsNone(cache.get(1))
+
+
+class TokenCacheTest(DataTest):
+    def test_verified_token_is_cached(self):
+        token_cache.clear()
+        token = self.login(self.sales_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        self.client.get("/crm/events/", format="json")
+        hits = token_cache.hits
+        with mock.patch(
+                "rest_framework_simplejwt.authentication."
+                "JWTAuthentication.get_validated_token"
+        ) as get_validated_token:
+            response = self.client.get("/crm/events/", format="json")
+        self.assertEqual(response.status_code, 200)
+        get_validated_token.assert_not_called()
+        self.assertEqual(token_cache.hits - hits, 1)
+
+    def test_invalid_token_is_not_cached(self):
+        token_cache.clear()
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer not_a_token")
+        response = self.client.get("/crm/events/", format="json")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(token_cache.stats()["size"], 0)
+
+    def test_token_expires_from_cache(self):
+        token_cache.clear()
+        token = self.login(self.sales_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        self.client.get("/crm/events/", format="json")
+        misses = token_cache.misses
+        expired = (
+            time.monotonic()
+            + AccessToken(token["access"])["exp"] - time.time() + 1
+        )
+        with mock.patch("authentication.cache.time.monotonic") as monotonic:
+            monotonic.return_value = expired
+            self.assertIsNone(
+                token_cache.get(
+                    hashlib.sha256(token["access"].encode()).digest()
+                )
+            )
+        self.assertEqual(token_cache.misses - misses, 1)
+
+    def test_bench_auth(self):
+        out = io.StringIO()
+        call_command("bench_auth", requests=20, stdout=out)
+        self.assertIn("token cache on", out.getvalue())
+        self.assertIn("token cache off", out.getvalue())
+
+
+class ResponseCacheTest(SharedCache, DataTest):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(RESPONSE_CACHE, {"ENABLED": True})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        metrics.reset()
+
+    def get(self, user, url):
+        token = self.login(user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        return self.client.get(url, format="json")
+
+    def test_cached_list_needs_no_query(self):
+        first = self.get(self.management_user, "/crm/clients/")
+        with self.assertNumQueries(0):
+            second = self.client.get("/crm/clients/", format="json")
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(first.json(), second.json())
+
+    def test_query_string_is_normalized(self):
+        self.get(self.management_user, "/crm/events/?event_status=1&id=1")
+        with self.assertNumQueries(0):
+            self.client.get("/crm/events/?id=1&event_status=1")
+
+    def test_scopes_are_not_shared(self):
+        for user in [self.management_user, self.support_user2]:
+            with self.subTest(user=user.username):
+                response = self.get(user, "/crm/events/")
+                events = Event.objects.order_by("date_created", "id")
+                if user == self.support_user2:
+                    events = events.filter(support_contact=user)
+                self.assertEqual(
+                    [event["pk"] for event in response.json()["results"]],
+                    list(events.values_list("id", flat=True))
+                )
+
+    def test_saved_row_makes_response_stale(self):
+        url = f"/crm/clients/{self.client1.id}/"
+        self.get(self.management_user, url)
+        Client.objects.filter(id=self.client1.id).update(last_name="Kenobi")
+        # without signal the cached response is served
+        self.assertNotEqual(
+            self.client.get(url, format="json").json()["last_name"],
+            "Kenobi"
+        )
+        client = Client.objects.get(id=self.client1.id)
+        client.save()
+        self.assertEqual(
+            self.client.get(url, format="json").json()["last_name"],
+            "Kenobi"
+        )
+
+    def test_changed_ownership_makes_response_stale(self):
+        url = f"/crm/events/{self.event1.id}/"
+        self.assertEqual(self.get(self.support_user, url).status_code, 200)
+        self.event1.support_contact = self.support_user2
+        self.event1.save()
+        self.assertEqual(
+            self.client.get(url, format="json").status_code, 403
+        )
+
+    def test_errors_are_not_cached(self):
+        url = "/crm/clients/999999/"
+        self.get(self.management_user, url)
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn(
+            ("clients", "retrieve", "hits"),
+            metrics.response_cache_total.values
+        )
+
+    def test_process_local_backend_not_used(self):
+        # the versions of a worker miss the changes of the others
+        with self.settings(CACHES={
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            }
+        }):
+            self.get(self.management_user, "/crm/contracts/")
+            with self.assertNumQueries(1):
+                response = self.client.get("/crm/contracts/")
+            self.assertEqual(response.status_code, 200)
+        self.assertNotIn(
+            ("contracts", "list", "misses"),
+            metrics.response_cache_total.values
+        )
+
+    def test_hit_ratio_per_endpoint(self):
+        self.get(self.management_user, "/crm/clients/")
+        self.client.get("/crm/clients/")
+        self.client.get("/crm/clients/")
+        with tempfile.TemporaryDirectory() as directory:
+            # written by a worker, read by the command
+            name = f"1-{uuid.uuid4().hex}.json"
+            with open(os.path.join(directory, name), "w") as store:
+                json.dump(metrics.dump(), store)
+            metrics.reset()
+            out = io.StringIO()
+            with mock.patch.dict(metrics.METRICS, {"DIRECTORY": directory}):
+                call_command("response_cache_stats", stdout=out)
+        self.assertIn(
+            "clients    list      : 2 hits, 1 misses, 67% hit ratio",
+            out.getvalue()
+        )
+
+    def test_hit_ratio_needs_metrics_directory(self):
+        with self.assertRaises(CommandError):
+            call_command("response_cache_stats", stdout=io.StringIO())
+
+    def test_hits_in_metrics(self):
+        self.get(self.management_user, "/crm/clients/")
+        self.client.get("/crm/clients/")
+        self.assertIn(
+            'crm_response_cache_total{basename="clients",action="list",'
+            'result="hits"} 1',
+            self.client.get("/metrics/").content.decode()
+        )
+
+
+class ConditionalGetTest(SharedCache, DataTest):
+    def get(self, user, url, **headers):
+        token = self.login(user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        return self.client.get(url, format="json", **headers)
+
+    def test_list_not_modified(self):
+        response = self.get(self.management_user, "/crm/clients/")
+        self.assertIn("ETag", response)
+        self.assertNotIn("Last-Modified", response)
+        user_cache.clear()
+        # user lookup and MAX/COUNT, nothing serialized
+        with mock.patch.dict(RESPONSE_CACHE, {"ENABLED": False}):
+            with self.assertNumQueries(2):
+                response = self.client.get(
+                    "/crm/clients/", HTTP_IF_NONE_MATCH=response["ETag"]
+                )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertIn("ETag", response)
+
+    def test_list_modified(self):
+        response = self.get(self.management_user, "/crm/events/")
+        self.event1.date_updated = self.date_p20d
+        self.event1.save()
+        response = self.client.get(
+            "/crm/events/", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data["results"])
+
+    def test_list_modified_by_related_row(self):
+        response = self.get(self.management_user, "/crm/clients/")
+        # printed as the sales contact of the clients
+        self.sales_user.last_name = "Kenobi"
+        self.sales_user.save()
+        response = self.client.get(
+            "/crm/clients/", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Kenobi", json.dumps(response.data["results"]))
+
+    def test_detail_modified_by_related_row(self):
+        url = f"/crm/contracts/{self.contract1.id}/"
+        response = self.get(self.management_user, url)
+        self.client1.company_name = "Jedi Order"
+        self.client1.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+    def test_list_validators_depend_on_scope(self):
+        etags = {
+            self.get(user, "/crm/events/")["ETag"]
+            for user in (self.support_user, self.support_user2)
+        }
+        self.assertEqual(len(etags), 2)
+
+    def test_list_validators_depend_on_filters(self):
+        first = self.get(self.management_user, "/crm/events/")
+        second = self.client.get(f"/crm/events/?id={self.event1.id}")
+        self.assertNotEqual(first["ETag"], second["ETag"])
+
+    def test_modified_since_ignored_after_related_change(self):
+        url = f"/crm/contracts/{self.contract1.id}/"
+        response = self.get(self.sales_user, url)
+        self.assertEqual(response.status_code, 200)
+        self.client1.company_name = "Jedi Order"
+        self.client1.save()
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertEqual(response.status_code, 200)
+
+    def test_modified_since_ignored_after_delete(self):
+        response = self.get(self.management_user, "/crm/events/")
+        self.assertEqual(response.status_code, 200)
+        self.event2.delete()
+        response = self.client.get(
+            "/crm/events/", HTTP_IF_MODIFIED_SINCE=http_date()
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(
+            self.event2.id,
+            [event["pk"] for event in response.json()["results"]]
+        )
+
+    def test_cached_response_not_modified(self):
+        url = f"/crm/clients/{self.client1.id}/"
+        with mock.patch.dict(RESPONSE_CACHE, {"ENABLED": True}):
+            response = self.get(self.management_user, url)
+            with self.assertNumQueries(0):
+                response = self.client.get(
+                    url, HTTP_IF_NONE_MATCH=response["ETag"]
+                )
+        self.assertEqual(response.status_code, 304)
+
+    def test_validators_dont_bypass_permissions(self):
+        url = f"/crm/clients/{self.client1.id}/"
+        etag = self.get(self.management_user, url)["ETag"]
+        response = self.get(self.support_user2, url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 403)
+
+
+class DataETagTest(DataTest):
+    """
+    ETags with the cache of the process of the default settings,
+    digests of the data
+    """
+    def get(self, user, url, **headers):
+        token = self.login(user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        return self.client.get(url, format="json", **headers)
+
+    def test_list_not_modified(self):
+        response = self.get(self.management_user, "/crm/clients/")
+        # the versions of this process aren't used
+        bump_version(Client)
+        response = self.client.get(
+            "/crm/clients/", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_detail_modified_by_related_row(self):
+        url = f"/crm/contracts/{self.contract1.id}/"
+        response = self.get(self.management_user, url)
+        self.client1.company_name = "Jedi Order"
+        self.client1.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+    def test_list_modified_by_delete(self):
+        response = self.get(self.management_user, "/crm/events/")
+        self.event2.delete()
+        response = self.client.get(
+            "/crm/events/", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+class BulkClientCreateTest(DetectRepeatedQueries, DataTest):
+    def lead(self, index, **fields):
+        lead = {
+            'first_name': 'john',
+            'last_name': f'smith-{chr(97 + index % 26)}',
+            'email': f'lead{index}@show.com',
+            'phone': '1111111111',
+            'mobile': '222222',
+            'company_name': 'trade show',
+        }
+        lead.update(fields)
+        return lead
+
+    def post(self, user, data):
+        token = self.login(user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        return self.client.post("/crm/clients/", data, format="json")
+
+    def test_multi_status(self):
+        for statuses, expected in [
+            ([201, 201], 201), ([201, 400], 207), ([400, 400], 400)
+        ]:
+            with self.subTest(statuses=statuses):
+                self.assertEqual(
+                    multi_status(
+                        [{"status": status} for status in statuses], 201
+                    ),
+                    expected
+                )
+
+    def test_bulk_create(self):
+        clients_count = Client.objects.count()
+        response = self.post(
+            self.sales_user2, [self.lead(index) for index in range(3)]
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Client.objects.count(), clients_count + 3)
+        self.assertEqual(
+            [result["index"] for result in response.json()], [0, 1, 2]
+        )
+        created = Client.objects.get(pk=response.json()[0]["client"]["pk"])
+        self.assertEqual(created.sales_contact, self.sales_user2)
+        self.assertEqual(created.first_name, "John")
+
+    def test_bulk_create_query_count(self):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        user_cache.clear()
+        leads = [
+            self.lead(index, contact=self.sales_user2.id)
+            for index in range(200)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/crm/clients/", leads, format="json")
+        self.assertEqual(response.status_code, 201)
+        # user and contacts with their team, then the inserts
+        # in as many batches as the backend needs
+        selects = [
+            query for query in queries.captured_queries
+            if query["sql"].startswith("SELECT")
+        ]
+        inserts = [
+            query for query in queries.captured_queries
+            if query["sql"].startswith("INSERT")
+        ]
+        self.assertEqual(len(selects), 2)
+        self.assertLessEqual(len(inserts), 3)
+
+    def test_bulk_create_partial(self):
+        clients_count = Client.objects.count()
+        response = self.post(self.management_user, [
+            self.lead(0, contact=self.sales_user.id),
+            self.lead(1, contact=self.support_user.id),
+            self.lead(2, contact=999999),
+            self.lead(3),
+            self.lead(4, contact=self.sales_user.id, phone="phone"),
+        ])
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(Client.objects.count(), clients_count + 1)
+        results = response.json()
+        self.assertEqual(
+            [result["status"] for result in results],
+            [201, 400, 400, 400, 400]
+        )
+        self.assertEqual(
+            results[1]["errors"]["sales_contact error"],
+            "Please choose a user belonging to Sales team"
+        )
+        self.assertEqual(
+            results[2]["errors"]["sales_contact error"],
+            "This user doesn't exist."
+        )
+        self.assertIn("phone", str(results[4]["errors"]))
+
+    def test_bulk_create_all_invalid(self):
+        clients_count = Client.objects.count()
+        response = self.post(self.sales_user, [self.lead(0, email="nope")])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Client.objects.count(), clients_count)
+
+    def test_bulk_create_limits(self):
+        response = self.post(self.sales_user, [])
+        self.assertEqual(response.status_code, 400)
+        with mock.patch.object(ClientViewset, "bulk_create_max_items", 2):
+            response = self.post(
+                self.sales_user, [self.lead(index) for index in range(3)]
+            )
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_create_unauthorized(self):
+        response = self.post(self.support_user, [self.lead(0)])
+        self.assertEqual(response.status_code, 403)
+
+    def test_bulk_create_makes_list_stale(self):
+        before = self.post(self.sales_user2, [self.lead(0)])
+        self.assertEqual(before.status_code, 201)
+        listed = self.client.get("/crm/clients/?page_size=500").json()
+        self.post(self.sales_user2, [self.lead(1)])
+        self.assertEqual(
+            len(self.client.get("/crm/clients/?page_size=500").json()[
+                "results"]),
+            len(listed["results"]) + 1
+        )
+
+
+class EventBatchStatusTest(DetectRepeatedQueries, DataTest):
+    url = "/crm/events/status/"
+
+    def patch(self, user, data):
+        token = self.login(user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        return self.client.patch(self.url, data, format="json")
+
+    def test_close_events(self):
+        Event.objects.filter(id=self.event1.id).update(
+            event_date=self.date_a30d
+        )
+        response = self.patch(self.support_user, [
+            {"event_id": self.event1.id, "event_status": "Closed",
+             "notes": "All went fine"},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]["status"], 200)
+        event = Event.objects.get(id=self.event1.id)
+        self.assertEqual(event.event_status, "3")
+        self.assertEqual(event.notes, "All went fine")
+        self.assertGreater(event.date_updated, self.event1.date_updated)
+
+    def test_per_row_failures(self):
+        Event.objects.filter(id=self.event1.id).update(
+            event_date=self.date_a30d
+        )
+        response = self.patch(self.support_user, [
+            {"event_id": self.event1.id, "event_status": "In progress"},
+            {"event_id": self.event2.id, "event_status": "Closed"},
+            {"event_id": 999999, "event_status": "Closed"},
+            {"event_id": self.event1.id, "event_status": "Done"},
+            {"event_id": self.event1.id, "event_status": "Closed"},
+        ])
+        self.assertEqual(response.status_code, 207)
+        results = response.json()
+        self.assertEqual(
+            [result["status"] for result in results],
+            [200, 400, 404, 400, 400]
+        )
+        self.assertIn("later than the current date",
+                      str(results[1]["errors"]))
+        self.assertIn("Must be <Incoming>", str(results[3]["errors"]))
+        self.assertEqual(
+            Event.objects.get(id=self.event1.id).event_status, "2"
+        )
+        self.assertEqual(
+            Event.objects.get(id=self.event2.id).event_status, "1"
+        )
+
+    def test_other_support_contact_events_not_found(self):
+        response = self.patch(self.support_user2, [
+            {"event_id": self.event1.id, "event_status": "Incoming"},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()[0]["status"], 404)
+
+    def test_batch_query_count(self):
+        self.add_rows(50)
+        Event.objects.update(event_date=self.date_a30d)
+        events = Event.objects.filter(support_contact=self.support_user2)
+        events_id = list(events.values_list("id", flat=True))
+        token = self.login(self.support_user2)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        user_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(self.url, [
+                {"event_id": event_id, "event_status": "Closed"}
+                for event_id in events_id
+            ], format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [
+                query["sql"].split()[0] for query in queries.captured_queries
+                if "SAVEPOINT" not in query["sql"]
+            ],
+            ["SELECT", "SELECT", "UPDATE"]
+        )
+        self.assertFalse(events.exclude(event_status="3").exists())
+
+    def test_not_a_list(self):
+        response = self.patch(
+            self.support_user,
+            {"event_id": self.event1.id, "event_status": "Closed"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_makes_list_stale(self):
+        Event.objects.filter(id=self.event1.id).update(
+            event_date=self.date_a30d
+        )
+        url = f"/crm/events/?id={self.event1.id}"
+        self.patch(self.support_user, [])
+        self.client.get(url)
+        self.client.patch(self.url, [
+            {"event_id": self.event1.id, "event_status": "In progress"},
+        ], format="json")
+        response = self.client.get(url)
+        self.assertEqual(response.data["results"][0]["event_status"], "2")
+
+
+class ImportTest(DataTest):
+    def write_csv(self, directory, name, header, rows):
+        path = os.path.join(directory, name)
+        with open(path, "w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(header)
+            writer.writerows(rows)
+        return path
+
+    def import_crm(self, *args, **options):
+        out = io.StringIO()
+        err = io.StringIO()
+        call_command("import_crm", *args, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_import_clients(self):
+        clients_count = Client.objects.count()
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_csv(
+                directory, "clients.csv",
+                ["first_name", "last_name", "email", "phone", "mobile",
+                 "company_name", "sales_contact"],
+                [
+                    ["leia", "organa", "leia@rebels.com", "123", "456",
+                     "Rebels", self.sales_user.username],
+                    ["Luke", "Sky-walker", "luke@rebels.com", "123", "456",
+                     "Rebels", self.sales_user2.username],
+                    ["R2", "D2", "r2@rebels.com", "123", "456",
+                     "Rebels", self.sales_user.username],
+                    ["Han", "Solo", "han@rebels.com", "12a", "456",
+                     "Rebels", self.sales_user.username],
+                    ["Yoda", "Master", "yoda@rebels.com", "123", "456",
+                     "Jedi", self.support_user.username],
+                ]
+            )
+            out, err = self.import_crm("clients", path, batch_size=2)
+        self.assertEqual(Client.objects.count(), clients_count + 2)
+        leia = Client.objects.get(email="leia@rebels.com")
+        self.assertEqual(leia.first_name, "Leia")
+        self.assertEqual(leia.sales_contact, self.sales_user)
+        self.assertIn("2 clients imported, 3 rejected", out)
+        self.assertIn("rows/s", out)
+        self.assertIn("line 4 : <first_name>", err)
+        self.assertIn("line 5 : <phone>", err)
+        self.assertIn("line 6 : <sales_contact>", err)
+
+    def test_import_contracts_and_events(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_csv(
+                directory, "contracts.csv",
+                ["client", "status", "amount", "payment_due"],
+                [
+                    [self.client1.email, "True", "1000",
+                     "01-01-2030 10:00:00"],
+                    ["nobody@nowhere.com", "True", "1000",
+                     "01-01-2030 10:00:00"],
+                ]
+            )
+            out, err = self.import_crm("contracts", path)
+            self.assertIn("1 contracts imported, 1 rejected", out)
+            contract = Contract.objects.get(payment_due__year=2030)
+            self.assertEqual(contract.client, self.client1)
+            path = self.write_csv(
+                directory, "events.csv",
+                ["name", "contract", "support_contact", "event_status",
+                 "attendees", "event_date", "notes"],
+                [
+                    ["Party", contract.id, self.support_user.username,
+                     "Incoming", "10", "01-01-2030 20:00:00", ""],
+                    ["Second party", contract.id, "",
+                     "Incoming", "10", "01-01-2030 20:00:00", ""],
+                    ["Closed party", contract.id, "",
+                     "Closed", "10", "01-01-2030 20:00:00", ""],
+                ]
+            )
+            out, err = self.import_crm("events", path)
+        self.assertIn("1 events imported, 2 rejected", out)
+        self.assertEqual(contract.event.support_contact, self.support_user)
+        self.assertIn("line 3 : <contract>", err)
+        self.assertIn("line 4 : ", err)
+
+    def test_short_and_long_rows_rejected(self):
+        clients_count = Client.objects.count()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "clients.csv")
+            with open(path, "w") as csv_file:
+                csv_file.write(
+                    "first_name,last_name,email,phone,mobile,"
+                    "company_name,sales_contact\n"
+                    "han,solo\n"
+                    f"Leia,Organa,leia@rebels.com,1,2,Rebels,"
+                    f"{self.sales_user.username}\n"
+                    f"Luke,Skywalker,luke@rebels.com,1,2,Rebels,"
+                    f"{self.sales_user.username},extra\n"
+                )
+            out, err = self.import_crm("clients", path)
+            self.assertIn("1 clients imported, 2 rejected", out)
+            self.assertIn("line 2 : <email>: missing", err)
+            self.assertIn("<sales_contact>: missing", err)
+            self.assertIn("line 4 : more values than columns", err)
+            path = os.path.join(directory, "events.csv")
+            with open(path, "w") as csv_file:
+                csv_file.write(
+                    "name,contract,support_contact,event_status,"
+                    "attendees,event_date\n"
+                    "Party\n"
+                )
+            out, err = self.import_crm("events", path)
+        self.assertIn("0 events imported, 1 rejected", out)
+        self.assertIn("line 2 : <contract>: missing", err)
+        self.assertEqual(Client.objects.count(), clients_count + 1)
+
+    def test_values_longer_than_columns_rejected(self):
+        clients_count = Client.objects.count()
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_csv(
+                directory, "clients.csv",
+                ["first_name", "last_name", "email", "phone", "mobile",
+                 "company_name", "sales_contact"],
+                [
+                    ["A" * 26, "Organa", "leia@rebels.com", "1", "2",
+                     "Rebels", self.sales_user.username],
+                    ["Luke", "Skywalker", "l" * 95 + "@r.com", "1" * 21,
+                     "2", "Rebels", self.sales_user.username],
+                ]
+            )
+            out, err = self.import_crm("clients", path)
+            self.assertIn("0 clients imported, 2 rejected", out)
+            self.assertIn(
+                "line 2 : <first_name>: more than 25 characters", err
+            )
+            self.assertIn(
+                "line 3 : <email>: more than 100 characters; "
+                "<phone>: more than 20 characters",
+                err
+            )
+            self.contract1.event.delete()
+            path = self.write_csv(
+                directory, "events.csv",
+                ["name", "contract", "support_contact", "event_status",
+                 "attendees", "event_date"],
+                [["P" * 251, self.contract1.id, "", "Incoming", "10",
+                  "01-01-2030 20:00:00"]]
+            )
+            out, err = self.import_crm("events", path)
+        self.assertIn("0 events imported, 1 rejected", out)
+        self.assertIn("line 2 : <name>: more than 250 characters", err)
+        self.assertEqual(Client.objects.count(), clients_count)
+
+    def test_resume_from_checkpoint(self):
+        clients_count = Client.objects.count()
+        header = ["first_name", "last_name", "email", "phone", "mobile",
+                  "company_name", "sales_contact"]
+        rows = [
+            ["Lead", "Number", f"lead{index}@show.com", "1", "2",
+             "Show", self.sales_user.username]
+            for index in range(5)
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, "checkpoint")
+            path = self.write_csv(directory, "clients.csv", header, rows[:3])
+            self.import_crm("clients", path, checkpoint=checkpoint)
+            with open(checkpoint) as checkpoint_file:
+                self.assertEqual(checkpoint_file.read(), "3")
+            # the file grew, the first rows are skipped
+            path = self.write_csv(directory, "clients.csv", header, rows)
+            out, err = self.import_crm(
+                "clients", path, checkpoint=checkpoint, batch_size=1
+            )
+        self.assertIn("2 clients imported", out)
+        self.assertEqual(Client.objects.count(), clients_count + 5)
+        self.assertEqual(
+            Client.objects.filter(email="lead0@show.com").count(), 1
+        )
+
+    def test_import_with_copy(self):
+        if connection.vendor != "postgresql":
+            self.skipTest("COPY is only used on PostgreSQL")
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_csv(
+                directory, "contracts.csv",
+                ["client", "status", "amount", "payment_due"],
+                [[self.client1.email, "False", "10.5",
+                  "01-01-2030 10:00:00"]]
+            )
+            out, err = self.import_crm("contracts", path)
+        contract = Contract.objects.get(payment_due__year=2030)
+        self.assertFalse(contract.status)
+        self.assertEqual(contract.amount, 10.5)
+
+    def test_copy_keeps_empty_strings(self):
+        if connection.vendor != "postgresql":
+            self.skipTest("COPY is only used on PostgreSQL")
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_csv(
+                directory, "clients.csv",
+                ["first_name", "last_name", "email", "phone", "mobile",
+                 "company_name", "sales_contact"],
+                [["Leia", "Organa", "leia@rebels.com", "1", "2",
+                  "", self.sales_user.username]]
+            )
+            out, err = self.import_crm("clients", path)
+            self.assertIn("1 clients imported", out)
+            self.assertEqual(
+                Client.objects.get(email="leia@rebels.com").company_name, ""
+            )
+            self.contract1.event.delete()
+            path = self.write_csv(
+                directory, "events.csv",
+                ["name", "contract", "support_contact", "event_status",
+                 "attendees", "event_date", "notes"],
+                [["", self.contract1.id, "", "Incoming", "10",
+                  "01-01-2030 20:00:00", ""]]
+            )
+            out, err = self.import_crm("events", path)
+        self.assertIn("1 events imported", out)
+        event = Event.objects.get(contract=self.contract1)
+        self.assertEqual(event.name, "")
+        self.assertIsNone(event.notes)
+
+    def test_copy_line(self):
+        self.assertEqual(
+            copy_line([None, "", 'say "hi"', True, COPY_NULL]),
+            f'{COPY_NULL},"","say ""hi""","True","{COPY_NULL}"\n'
+        )
+
+    def test_missing_columns(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_csv(
+                directory, "clients.csv", ["first_name"], [["Leia"]]
+            )
+            with self.assertRaises(CommandError):
+                self.import_crm("clients", path)
+
+    def test_import_makes_responses_stale(self):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        before = len(self.client.get("/crm/clients/").data["results"])
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_csv(
+                directory, "clients.csv",
+                ["first_name", "last_name", "email", "phone", "mobile",
+                 "company_name", "sales_contact"],
+                [["Leia", "Organa", "leia@rebels.com", "1", "2",
+                  "Rebels", self.sales_user.username]]
+            )
+            self.import_crm("clients", path)
+        self.assertEqual(
+            len(self.client.get("/crm/clients/").data["results"]),
+            before + 1
+        )
+
+
+class ProvisioningTest(DataTest):
+    def user(self, first_name, last_name, team="Sales", password="toto1234"):
+        return {
+            "first_name": first_name,
+            "last_name": last_name,
+            "password1": password,
+            "password2": password,
+            "team": team,
+        }
+
+    def post(self, data):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        return self.client.post("/crm/users/bulk/", data, format="json")
+
+    def test_bulk_create_users(self):
+        users_count = User.objects.count()
+        response = self.post([
+            self.user("eva", "geret"),
+            self.user("eva", "geret", team="Management"),
+            self.user("jean-luc", "picard", team="Support"),
+            self.user("bad", "password", password="short"),
+        ])
+        self.assertEqual(response.status_code, 207)
+        results = response.json()
+        self.assertEqual(
+            [result["status"] for result in results], [201, 201, 201, 400]
+        )
+        # egeret is the management user of the tests
+        self.assertEqual(
+            [result["user"]["username"] for result in results[:3]],
+            ["egeret2", "egeret3", "jlpicard"]
+        )
+        self.assertEqual(User.objects.count(), users_count + 3)
+        picard = User.objects.get(username="jlpicard")
+        self.assertEqual(picard.get_team(), "Support team")
+        self.assertEqual(picard.first_name, "Jean-Luc")
+        self.assertTrue(picard.check_password("toto1234"))
+        self.assertTrue(User.objects.get(username="egeret3").is_staff)
+
+    def test_usernames_allocated_in_one_query(self):
+        with self.assertNumQueries(1):
+            usernames = allocate_usernames(
+                [("Eva", "Geret"), ("Yves", "Antou"), ("Eva", "Geret")]
+            )
+        self.assertEqual(usernames, ["egeret2", "yantou2", "egeret3"])
+
+    def test_passwords_hashed_by_processes(self):
+        passwords = [f"password{index}" for index in range(8)]
+        hashes = hash_passwords(passwords, workers=2)
+        self.assertEqual(len(set(hashes)), 8)
+        for password, password_hash in zip(passwords, hashes):
+            self.assertTrue(check_password(password, password_hash))
+
+    def test_bulk_create_users_unauthorized(self):
+        token = self.login(self.sales_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        response = self.client.post(
+            "/crm/users/bulk/", [self.user("eva", "geret")], format="json"
+        )
+        self.assertEqual(response.status_code, 403)
+
+    def test_provision_users_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "users.csv")
+            with open(path, "w", newline="") as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerow(
+                    ["first_name", "last_name", "password", "team"]
+                )
+                writer.writerow(["Kathryn", "Janeway", "voyager74", "Sales"])
+                writer.writerow(["Q", "Q", "omnipotent1", "Continuum"])
+            out = io.StringIO()
+            err = io.StringIO()
+            call_command(
+                "provision_users", path, workers=1, stdout=out, stderr=err
+            )
+        self.assertIn("kjaneway", out.getvalue())
+        self.assertIn("1 users created, 1 rejected", out.getvalue())
+        self.assertIn("line 3", err.getvalue())
+        self.assertEqual(
+            User.objects.get(username="kjaneway").get_team(), "Sales team"
+        )
+
+
+class LoginThrottleTest(DataTest):
+    def post_credentials(self, username, password="wrong123", ip=None):
+        extra = {"REMOTE_ADDR": ip} if ip else {}
+        return self.client.post(
+            reverse("login"),
+            {"username": username, "password": password},
+            format="json",
+            **extra
+        )
+
+    def test_username_throttled_before_any_query(self):
+        for _ in range(5):
+            response = self.post_credentials(self.sales_user.username)
+            self.assertEqual(response.status_code, 401)
+        with self.assertNumQueries(0), \
+                mock.patch("authentication.login.check_password") as check:
+            response = self.post_credentials(
+                self.sales_user.username, "toto1234"
+            )
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(check.called)
+        self.assertEqual(response["Retry-After"], "60")
+        # another username from the same ip isn't throttled
+        response = self.post_credentials(self.support_user.username)
+        self.assertEqual(response.status_code, 401)
+
+    def test_ip_throttled(self):
+        for index in range(20):
+            response = self.post_credentials(f"nobody{index}", ip="10.0.0.1")
+            self.assertEqual(response.status_code, 401)
+        response = self.post_credentials("nobody", ip="10.0.0.1")
+        self.assertEqual(response.status_code, 429)
+        # a token comes back every 6 seconds
+        self.assertTrue(0 < int(response["Retry-After"]) <= 6)
+        response = self.post_credentials("nobody", ip="10.0.0.2")
+        self.assertEqual(response.status_code, 401)
+
+    def test_successful_logins_not_throttled(self):
+        for _ in range(30):
+            response = self.post_credentials(
+                self.sales_user.username, "toto1234"
+            )
+            self.assertEqual(response.status_code, 200)
+
+    def test_success_fills_username_bucket(self):
+        for _ in range(4):
+            self.post_credentials(self.sales_user.username)
+        self.post_credentials(self.sales_user.username, "toto1234")
+        for _ in range(5):
+            response = self.post_credentials(self.sales_user.username)
+            self.assertEqual(response.status_code, 401)
+
+    def test_bucket_refills(self):
+        now = time.time()
+        for _ in range(5):
+            self.post_credentials(self.sales_user.username)
+        with mock.patch("time.time", return_value=now + 61):
+            response = self.post_credentials(self.sales_user.username)
+        self.assertEqual(response.status_code, 401)
+
+    def test_cache_buckets(self):
+        throttle = LoginThrottle(
+            CacheBuckets("default"), username_rule=(2, 60), ip_rule=(10, 6)
+        )
+        self.assertEqual(throttle.attempt("yantou", "10.0.0.1"), 0)
+        self.assertEqual(throttle.attempt("YANTOU", "10.0.0.1"), 0)
+        self.assertAlmostEqual(
+            throttle.attempt("yantou", "10.0.0.1"), 60, delta=1
+        )
+        throttle.succeeded("yantou", "10.0.0.1")
+        self.assertEqual(throttle.attempt("yantou", "10.0.0.1"), 0)
+
+    def test_client_ip_behind_proxy(self):
+        request = mock.Mock(META={
+            "REMOTE_ADDR": "10.0.0.254",
+            "HTTP_X_FORWARDED_FOR": "1.2.3.4, 5.6.7.8",
+        })
+        self.assertEqual(client_ip(request), "10.0.0.254")
+        with mock.patch.dict(LOGIN_THROTTLE, {"PROXY_COUNT": 1}):
+            self.assertEqual(client_ip(request), "5.6.7.8")
+
+
+class ProfilingTest(DataTest):
+    def get(self, user, url="/crm/clients/", **extra):
+        token = self.login(user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        return self.client.get(url, **extra)
+
+    @staticmethod
+    def timings(response):
+        return {
+            metric.split(";")[0]: metric
+            for metric in response["Server-Timing"].split(", ")
+        }
+
+    def test_server_timing_for_management(self):
+        self.get(self.management_user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get(
+                self.management_user,
+                f"/crm/clients/{self.client1.id}/",
+                HTTP_X_PROFILE="1"
+            )
+        self.assertEqual(response.status_code, 200)
+        timings = self.timings(response)
+        for step in ("perm", "queryset", "serialize", "render", "total"):
+            self.assertIn(step, timings)
+        # the queries of the login are made before the request
+        self.assertIn(f'desc="{len(queries) - 1} queries"', timings["sql"])
+
+    def test_no_server_timing_for_other_teams(self):
+        response = self.get(self.sales_user, HTTP_X_PROFILE="1")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("Server-Timing"))
+
+    def test_header_ignored_for_other_teams(self):
+        aggregate.reset()
+        with mock.patch.dict(PROFILING, {"SAMPLE_RATE": 0}):
+            self.get(self.sales_user, HTTP_X_PROFILE="1")
+            self.client.get("/crm/clients/", HTTP_X_PROFILE="1")
+        self.assertEqual(aggregate.endpoints, {})
+
+    def test_user_endpoints_timed(self):
+        self.get(self.management_user)
+        for url in ["/crm/users/", f"/crm/users/{self.sales_user.id}/"]:
+            with self.subTest(url=url):
+                response = self.client.get(url, HTTP_X_PROFILE="1")
+                self.assertEqual(response.status_code, 200)
+                timings = self.timings(response)
+                for step in ("perm", "queryset", "serialize", "render"):
+                    self.assertIn(step, timings)
+
+    def test_requests_not_sampled(self):
+        with mock.patch.dict(PROFILING, {"SAMPLE_RATE": 0}):
+            response = self.get(self.management_user)
+        self.assertFalse(response.has_header("Server-Timing"))
+
+    def test_requests_sampled(self):
+        with mock.patch.dict(PROFILING, {"SAMPLE_RATE": 1}):
+            response = self.get(self.management_user)
+        self.assertIn("total", self.timings(response))
+
+    def test_disabled(self):
+        with mock.patch.dict(PROFILING, {"ENABLED": False}):
+            response = self.get(self.management_user, HTTP_X_PROFILE="1")
+        self.assertFalse(response.has_header("Server-Timing"))
+
+    def test_aggregated_log(self):
+        aggregate.reset()
+        self.get(self.management_user, HTTP_X_PROFILE="1")
+        token = self.login(self.sales_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        with mock.patch.dict(PROFILING, {
+                "LOG_INTERVAL": 0, "SAMPLE_RATE": 1}), \
+                self.assertLogs("profiling", "INFO") as logs:
+            self.client.get("/crm/clients/")
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("GET clients-list: 2 requests", logs.output[0])
+        self.assertIn("serialize", logs.output[0])
+        self.assertEqual(aggregate.endpoints, {})
+
+    async def test_async_middleware(self):
+        profiles = []
+
+        async def get_response(request):
+            # a sync view under asgi.py, run by the thread of sync_to_async
+            profiles.append(await sync_to_async(current_profile.get)())
+            await sync_to_async(list)(Client.objects.all())
+            return HttpResponse()
+        middleware = ProfilingMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        request = RequestFactory().get("/crm/clients/", HTTP_X_PROFILE="1")
+        request.user = self.management_user
+        response = await middleware(request)
+        self.assertIn('desc="1 queries"', self.timings(response)["sql"])
+        self.assertEqual(profiles[0].queries, 1)
+        self.assertIsNone(current_profile.get())
+
+    def test_serializer_kept(self):
+        response = self.get(
+            self.management_user,
+            f"/crm/clients/{self.client1.id}/",
+            HTTP_X_PROFILE="1"
+        )
+        self.get(self.management_user, f"/crm/clients/{self.client1.id}/")
+        self.assertEqual(
+            response.json(),
+            self.client.get(f"/crm/clients/{self.client1.id}/").json()
+        )
+
+
+class MetricsTest(DataTest):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def get(self, url, user=None, **extra):
+        if user:
+            token = self.login(user)
+            self.client.credentials(
+                HTTP_AUTHORIZATION="Bearer " + token["access"]
+            )
+        return self.client.get(url, **extra)
+
+    def test_requests_counted_by_viewset_action_and_status(self):
+        self.get("/crm/clients/", self.management_user)
+        self.client.get("/crm/clients/")
+        self.client.get(f"/crm/clients/{self.client1.id}/")
+        self.client.get("/crm/clients/99999/")
+        self.assertEqual(metrics.requests_total.values, {
+            ("LoginView", "post", "200"): 1,
+            ("ClientViewset", "list", "200"): 2,
+            ("ClientViewset", "retrieve", "200"): 1,
+            ("ClientViewset", "retrieve", "404"): 1,
+        })
+        counts = metrics.request_duration.values[("ClientViewset", "list")]
+        self.assertEqual(sum(counts[:-1]), 2)
+
+    def test_queries_histogram(self):
+        self.get("/crm/clients/", self.management_user)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(f"/crm/users/{self.sales_user.id}/")
+        counts = metrics.request_queries.values[("UserViewset", "retrieve")]
+        # a single request, in the bucket of its number of queries
+        index = bisect.bisect_left(metrics.QUERIES_BUCKETS, len(queries))
+        self.assertEqual(counts[index], 1)
+        self.assertEqual(counts[-1], len(queries))
+
+    def test_prometheus_text(self):
+        self.get("/crm/clients/", self.management_user)
+        response = self.client.get("/metrics/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response["Content-Type"], "text/plain; version=0.0.4"
+        )
+        text = response.content.decode()
+        self.assertIn("# TYPE crm_requests_total counter", text)
+        self.assertIn(
+            'crm_requests_total{viewset="ClientViewset",action="list",'
+            'status="200"} 1',
+            text
+        )
+        self.assertIn(
+            'crm_request_duration_seconds_bucket{viewset="ClientViewset",'
+            'action="list",le="+Inf"} 1',
+            text
+        )
+        self.assertIn(
+            'crm_request_queries_count{viewset="ClientViewset",'
+            'action="list"} 1',
+            text
+        )
+
+    def test_process_caches(self):
+        self.get("/crm/clients/", self.management_user)
+        self.client.get("/crm/clients/")
+        text = self.get("/metrics/").content.decode()
+        for cache, stats in (("user", user_cache.stats()),
+                             ("token", token_cache.stats())):
+            for result in ("hits", "misses"):
+                with self.subTest(cache=cache, result=result):
+                    self.assertIn(
+                        f'crm_process_cache_total{{cache="{cache}",'
+                        f'result="{result}"}} {stats[result]}',
+                        text
+                    )
+        self.assertGreater(user_cache.stats()["hits"], 0)
+
+    async def test_async_middleware(self):
+        async def get_response(request):
+            # a sync view under asgi.py, run by the thread of sync_to_async
+            await sync_to_async(list)(Client.objects.all())
+            return HttpResponse()
+        middleware = metrics.MetricsMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = await middleware(RequestFactory().get("/crm/clients/"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            metrics.requests_total.values, {("unresolved", "get", "200"): 1}
+        )
+        counts = metrics.request_queries.values[("unresolved", "get")]
+        self.assertEqual(counts[-1], 1)
+
+    async def test_async_requests(self):
+        response = await self.async_client.post(
+            reverse("login"),
+            {"username": self.sales_user.username, "password": "toto1234"},
+            content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        # the queries of a sync view, made by the thread of sync_to_async
+        queries = CaptureQueriesContext(connection)
+        await sync_to_async(queries.__enter__)()
+        response = await self.async_client.get(
+            f"/crm/clients/{self.client1.id}/",
+            AUTHORIZATION="Bearer " + response.json()["access"]
+        )
+        await sync_to_async(queries.__exit__)(None, None, None)
+        captured = await sync_to_async(len)(queries)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(metrics.requests_total.values, {
+            ("LoginView", "post", "200"): 1,
+            ("ClientViewset", "retrieve", "200"): 1,
+        })
+        counts = metrics.request_queries.values[("ClientViewset", "retrieve")]
+        self.assertGreater(captured, 0)
+        self.assertEqual(counts[-1], captured)
+
+    def test_middlewares_async(self):
+        # under asgi.py no middleware is run by sync_to_async,
+        # the async views (LoginView) stay on the event loop
+        with self.settings(DEBUG=True), \
+                self.assertNoLogs("django.request", "DEBUG"):
+            ASGIHandler()
+
+    def test_metrics_internal(self):
+        response = self.client.get("/metrics/", REMOTE_ADDR="10.0.0.9")
+        self.assertEqual(response.status_code, 403)
+
+    @staticmethod
+    def write_worker(directory, pid):
+        # the metrics of the current process, as written by another worker
+        name = f"{pid}-{uuid.uuid4().hex}.json"
+        with open(os.path.join(directory, name), "w") as store:
+            json.dump(metrics.dump(), store)
+        return name
+
+    def scrape(self, directory):
+        with mock.patch.dict(metrics.METRICS, {"DIRECTORY": directory}):
+            return self.client.get("/metrics/").content.decode()
+
+    def assertListCount(self, text, count):
+        self.assertIn(
+            'crm_requests_total{viewset="ClientViewset",action="list",'
+            f'status="200"}} {count}',
+            text
+        )
+        self.assertIn(
+            'crm_request_queries_count{viewset="ClientViewset",'
+            f'action="list"}} {count}',
+            text
+        )
+
+    def test_metrics_of_every_worker(self):
+        self.get("/crm/clients/", self.management_user)
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_worker(directory, os.getpid())
+            store = metrics.DirectoryStore(directory)
+            store.flush(force=True)
+            self.assertTrue(
+                os.path.exists(os.path.join(
+                    directory, metrics.worker_name(os.getpid())
+                ))
+            )
+            self.assertListCount(self.scrape(directory), 2)
+
+    def test_stopped_workers_folded(self):
+        self.get("/crm/clients/", self.management_user)
+        with tempfile.TemporaryDirectory() as directory:
+            # a running worker and two stopped ones, one of them
+            # with the pid of the running one
+            self.write_worker(directory, 100)
+            self.write_worker(directory, 200)
+            self.write_worker(directory, 300)
+            store = metrics.DirectoryStore(directory)
+            with mock.patch.object(metrics, "is_running", lambda pid: (
+                    pid in (100, os.getpid()))):
+                store.flush(force=True)
+                self.assertEqual(
+                    sorted(pid for name, pid in store.worker_files()),
+                    sorted([100, os.getpid()])
+                )
+                self.assertListCount(self.scrape(directory), 4)
+                # a pid reused by a new worker doesn't replace the counts
+                self.write_worker(directory, 200)
+                store.flush(force=True)
+                self.assertListCount(self.scrape(directory), 5)
+
+    def test_fold_interrupted_before_removal(self):
+        self.get("/crm/clients/", self.management_user)
+        with tempfile.TemporaryDirectory() as directory:
+            name = self.write_worker(directory, 200)
+            store = metrics.DirectoryStore(directory)
+            with mock.patch.object(metrics, "is_running", lambda pid: (
+                    pid == os.getpid())), \
+                    mock.patch.object(metrics.os, "remove"):
+                store.flush(force=True)
+            self.assertTrue(os.path.exists(os.path.join(directory, name)))
+            self.assertListCount(self.scrape(directory), 2)
+            with mock.patch.object(metrics, "is_running", lambda pid: (
+                    pid == os.getpid())):
+                store.flush(force=True)
+            self.assertFalse(os.path.exists(os.path.join(directory, name)))
+            self.assertListCount(self.scrape(directory), 2)
+
+
+class RepeatedQueriesTest(DetectRepeatedQueries, DataTest):
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint(
+                'SELECT "name" FROM "crm_client"  WHERE "id" = 12\n'
+                "AND \"email\" = 'han@falcon.com' AND \"id\" IN (1, 2, 3)"
+            ),
+            'SELECT "name" FROM "crm_client" WHERE "id" = ? '
+            'AND "email" = ? AND "id" IN (...)'
+        )
+        self.assertEqual(
+            fingerprint('SELECT * FROM "t" WHERE "id" IN (%s, %s)'),
+            fingerprint('SELECT * FROM "t" WHERE "id" IN (%s)'),
+        )
+
+    def test_query_per_row_raises_with_stack(self):
+        self.add_rows(10)
+        with self.assertRaises(RepeatedQueriesError) as raised:
+            with detect_repeated_queries(threshold=5):
+                for client in Client.objects.all():
+                    client.sales_contact.username
+        message = str(raised.exception)
+        self.assertIn('FROM "authentication_user"', message)
+        self.assertIn("repeated 12 times", message)
+        self.assertIn("test_query_per_row_raises_with_stack", message)
+
+    def test_lists_without_query_per_row(self):
+        self.add_rows(30)
+        for index in range(10):
+            User.objects.create(
+                username=f"trooper{index}",
+                first_name="Trooper",
+                last_name=str(index)
+            ).groups.add(self.support_group)
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        for url in ["/crm/clients/", "/crm/contracts/",
+                    "/crm/events/", "/crm/users/"]:
+            response = self.client.get(url, format="json")
+            self.assertEqual(response.status_code, 200)
+
+    def test_warning_logged(self):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        with mock.patch.dict(NPLUSONE, {"ACTION": "log", "THRESHOLD": 0}), \
+                self.assertLogs("queries", "WARNING") as logs:
+            response = self.client.get("/crm/clients/", format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("GET /crm/clients/ repeated queries", logs.output[0])
+
+    async def test_async_middleware(self):
+        async def get_response(request):
+            # a sync view under asgi.py, run by the thread of sync_to_async
+            await sync_to_async(self.add_rows)(10)
+            await sync_to_async(lambda: [
+                client.sales_contact.username
+                for client in Client.objects.all()
+            ])()
+            return HttpResponse()
+        middleware = NPlusOneMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        with self.assertRaises(RepeatedQueriesError) as raised:
+            await middleware(RequestFactory().get("/crm/clients/"))
+        self.assertIn("GET /crm/clients/", str(raised.exception))
+
+
+class QueueFileHandlerTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "login.log")
+
+    def handler(self, **kwargs):
+        handler = QueueFileHandler(self.filename, **kwargs)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        self.addCleanup(handler.close)
+        return handler
+
+    @staticmethod
+    def record(message, *args, level=logging.INFO):
+        return logging.LogRecord(
+            "login_security", level, __file__, 1, message, args, None
+        )
+
+    def read(self, filename=None):
+        with open(filename or self.filename) as log:
+            return log.read()
+
+    def test_records_written_by_background_thread(self):
+        handler = self.handler()
+        threads = []
+        write = handler.write
+
+        def write_records(records):
+            threads.append(threading.current_thread().name)
+            write(records)
+
+        handler.write = write_records
+        for index in range(3):
+            handler.handle(self.record("user %s connected", index))
+        handler.flush()
+        self.assertEqual(
+            self.read(),
+            "INFO user 0 connected\nINFO user 1 connected\n"
+            "INFO user 2 connected\n"
+        )
+        self.assertEqual(set(threads), {"log-writer"})
+
+    def test_records_written_in_batches(self):
+        handler = self.handler(batch_size=10)
+        writes = []
+        write = handler.write
+
+        def write_records(records):
+            writes.append(len(records))
+            write(records)
+
+        handler.write = write_records
+        # the thread isn't started yet, the records wait in the queue
+        handler._pid = os.getpid()
+        for index in range(25):
+            handler.handle(self.record("record %s", index))
+        handler._pid = None
+        handler.start()
+        handler.flush()
+        self.assertEqual(writes, [10, 10, 5])
+        self.assertEqual(len(self.read().splitlines()), 25)
+
+    def test_rotation_by_size(self):
+        handler = self.handler(max_bytes=50, backup_count=2)
+        for index in range(4):
+            handler.handle(self.record("a record of 30 characters %s", index))
+            handler.flush()
+        self.assertEqual(self.read(), "INFO a record of 30 characters 3\n")
+        self.assertEqual(
+            self.read(f"{self.filename}.1"),
+            "INFO a record of 30 characters 2\n"
+        )
+        self.assertEqual(
+            self.read(f"{self.filename}.2"),
+            "INFO a record of 30 characters 1\n"
+        )
+        self.assertFalse(os.path.exists(f"{self.filename}.3"))
+
+    def test_rotation_by_another_worker(self):
+        # one handler per worker process, on the same file
+        first = self.handler(max_bytes=80, backup_count=2)
+        second = self.handler(max_bytes=80, backup_count=2)
+        for handler, index in [(first, 1), (second, 2), (first, 3)]:
+            handler.handle(self.record("a record of 30 characters %s", index))
+            handler.flush()
+        # rotated by the first worker, the second one follows
+        second.handle(self.record("a record of 30 characters %s", 4))
+        second.flush()
+        self.assertEqual(
+            self.read(),
+            "INFO a record of 30 characters 3\n"
+            "INFO a record of 30 characters 4\n"
+        )
+        self.assertEqual(
+            self.read(f"{self.filename}.1"),
+            "INFO a record of 30 characters 1\n"
+            "INFO a record of 30 characters 2\n"
+        )
+
+    def test_rotation_by_time(self):
+        with open(self.filename, "w") as log:
+            log.write("yesterday\n")
+        yesterday = time.time() - 24 * 60 * 60
+        os.utime(self.filename, (yesterday, yesterday))
+        handler = self.handler(rotate_every=24 * 60 * 60)
+        handler.handle(self.record("today"))
+        handler.flush()
+        self.assertEqual(self.read(), "INFO today\n")
+        self.assertEqual(self.read(f"{self.filename}.1"), "yesterday\n")
+
+    def test_overload_sampled_then_dropped(self):
+        handler = self.handler(queue_size=4, sample_above=0.5, sample_rate=2)
+        handler._pid = os.getpid()
+        for index in range(10):
+            handler.handle(self.record("record %s", index))
+        handler.handle(self.record("error", level=logging.ERROR))
+        # 2 records before sampling, then one in two until the queue is full
+        self.assertEqual(handler.queue.qsize(), 4)
+        self.assertEqual(handler.dropped, 7)
+        handler._pid = None
+        handler.start()
+        handler.handle(self.record("error", level=logging.ERROR))
+        handler.flush()
+        self.assertEqual(
+            self.read().splitlines(),
+            [
+                "INFO record 0", "INFO record 1", "INFO record 3",
+                "INFO record 5", "WARNING 7 log records dropped",
+                "ERROR error",
+            ]
+        )
+
+    def test_json_output(self):
+        handler = self.handler()
+        handler.setFormatter(JsonFormatter())
+        handler.handle(self.record("user %s connected", "yantou"))
+        handler.flush()
+        entry = json.loads(self.read())
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["logger"], "login_security")
+        self.assertEqual(entry["message"], "user yantou connected")
+
+
+class UsernameRaceTest(TransactionTestCase):
+    registrations = 8
+
+    def setUp(self):
+        Group.objects.create(name="Sales team")
+        User.objects.create(
+            username="lskywalker", first_name="Luke", last_name="Skywalker"
+        )
+
+    def register(self, errors):
+        serializer = RegisterUserSerializer(data={
+            "first_name": "luke",
+            "last_name": "skywalker",
+            "password1": "toto1234",
+            "password2": "toto1234",
+            "team": "Sales",
+        })
+        try:
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+        except Exception as error:
+            errors.append(error)
+        finally:
+            connection.close()
+
+    def test_parallel_registrations_of_the_same_name(self):
+        if connection.vendor == "sqlite":
+            self.skipTest("SQLite doesn't run concurrent write transactions")
+        barrier = threading.Barrier(self.registrations)
+        allocate = provisioning.allocate_usernames
+        allocated = threading.local()
+
+        def allocate_together(names):
+            # every registration reads the usernames
+            # before any of them is saved
+            usernames = allocate(names)
+            if not getattr(allocated, "once", False):
+                allocated.once = True
+                barrier.wait(timeout=10)
+            return usernames
+
+        errors = []
+        with mock.patch.object(
+                provisioning, "allocate_usernames", allocate_together
+        ), mock.patch.object(
+                provisioning, "USERNAME_ATTEMPTS", self.registrations
+        ):
+            threads = [
+                threading.Thread(target=self.register, args=(errors,))
+                for _ in range(self.registrations)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            set(User.objects.filter(
+                username__startswith="lskywalker"
+            ).values_list("username", flat=True)),
+            {"lskywalker"} | {
+                f"lskywalker{index}"
+                for index in range(2, self.registrations + 2)
+            }
+        )
+        self.assertEqual(
+            User.objects.filter(groups__name="Sales team").count(),
+            self.registrations
+        )
+
+    def test_username_taken_meanwhile(self):
+        allocate = provisioning.allocate_usernames
+
+        def allocate_then_taken(names):
+            usernames = allocate(names)
+            if not User.objects.filter(username="lskywalker2").exists():
+                User.objects.create(
+                    username="lskywalker2",
+                    first_name="Luke",
+                    last_name="Skywalker"
+                )
+            return usernames
+
+        with mock.patch.object(
+                provisioning, "allocate_usernames", allocate_then_taken
+        ):
+            user = provisioning.save_with_username(
+                User(first_name="Luke", last_name="Skywalker")
+            )
+        self.assertEqual(user.username, "lskywalker3")
+
+    def test_username_allocated_in_one_query(self):
+        for index in range(2, 30):
+            User.objects.create(
+                username=f"lskywalker{index}",
+                first_name="Luke",
+                last_name="Skywalker"
+            )
+        with self.assertNumQueries(1):
+            usernames = allocate_usernames([("Luke", "Skywalker")])
+        self.assertEqual(usernames, ["lskywalker30"])
+
+
+class PaginationTest(DetectRepeatedQueries, DataTest):
+    def test_pages_follow_cursor(self):
+        self.add_rows(25)
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        url = "/crm/clients/?page_size=10"
+        clients_pk = []
+        while url:
+            response = self.client.get(url, format="json")
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 10)
+            clients_pk += [data['pk'] for data in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(len(clients_pk), Client.objects.count())
+        self.assertEqual(len(set(clients_pk)), len(clients_pk))
+
+    def test_rows_created_together_are_paged_without_offset(self):
+        self.add_rows(35)
+        # a bulk import gives a whole batch the same date_created
+        Client.objects.update(date_created=self.date_now)
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        url = "/crm/clients/?page_size=10"
+        pages = []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, format="json")
+            for query in queries.captured_queries:
+                self.assertNotIn("OFFSET", query["sql"].upper())
+            pages.append([data["pk"] for data in response.data["results"]])
+            url = response.data["next"]
+        self.assertEqual(
+            sum(pages, []),
+            list(Client.objects.order_by("id").values_list("id", flat=True))
+        )
+        # and back from the last page
+        url = response.data["previous"]
+        for page in reversed(pages[:-1]):
+            response = self.client.get(url, format="json")
+            self.assertEqual(
+                [data["pk"] for data in response.data["results"]], page
+            )
+            url = response.data["previous"]
+        self.assertIsNone(url)
+
+    def test_descending_pages_follow_cursor(self):
+        self.add_rows(15)
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        url = "/crm/events/?page_size=4&ordering=-date_created"
+        events_pk = []
+        while url:
+            response = self.client.get(url, format="json")
+            events_pk += [data["pk"] for data in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(
+            events_pk,
+            list(Event.objects.order_by("-date_created", "-id")
+                 .values_list("id", flat=True))
+        )
+
+    def test_invalid_cursor(self):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        for position in ['["x", "y"]', '["1"]', "{"]:
+            cursor = base64.b64encode(
+                urlencode({"p": position}).encode()
+            ).decode()
+            response = self.client.get(
+                f"/crm/clients/?cursor={cursor}", format="json"
+            )
+            self.assertEqual(response.status_code, 404)
+
+    def test_page_size_is_capped(self):
+        self.add_rows(600)
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        response = self.client.get(
+            "/crm/events/?page_size=100000", format="json")
+        self.assertEqual(len(response.data['results']), 500)
+
+    def test_no_count_query(self):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        for url in ["/crm/clients/", "/crm/contracts/",
+                    "/crm/events/", "/crm/users/"]:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, format="json")
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("count", response.data)
+            # rows are only counted with MAX(date_updated)
+            # for the validators of the list
+            for query in queries.captured_queries:
+                if "COUNT(" in query['sql'].upper():
+                    self.assertIn("MAX(", query['sql'].upper())
+
+    def test_filter_with_page_size(self):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        response = self.client.get(
+            f"/crm/contracts/?client={self.client1.id}&page_size=2",
+            format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNotNone(response.data['next'])
+
+
+class ExportTest(DataTest):
+    def export(self, url):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    def test_export_clients_csv(self):
+        self.add_rows(30)
+        content = self.export("/crm/clients/export/?format=csv")
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0][:3], ["id", "first_name", "last_name"])
+        self.assertEqual(len(rows) - 1, Client.objects.count())
+
+    def test_export_contracts_ndjson_with_filter(self):
+        self.add_rows(30)
+        content = self.export(
+            f"/crm/contracts/export/?format=ndjson&client={self.client1.id}")
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(
+            len(rows), Contract.objects.filter(client=self.client1).count())
+        self.assertEqual(
+            {row["client"] for row in rows}, {self.client1.id})
+
+    def test_export_events_is_csv_by_default(self):
+        content = self.export("/crm/events/export/")
+        self.assertEqual(
+            len(content.splitlines()) - 1, Event.objects.count())
+
+    def test_export_with_incorrect_filter(self):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        response = self.client.get("/crm/events/export/?xzk=2")
+        self.assertEqual(response.status_code, 404)
+
+    def test_bench_export_command(self):
+        self.add_rows(10)
+        out = io.StringIO()
+        call_command("bench_export", "contracts", "--format=ndjson",
+                     stdout=out)
+        self.assertIn(f"{Contract.objects.count()} rows", out.getvalue())
+        self.assertIn("peak RSS", out.getvalue())
+
+
+class FilterTest(DetectRepeatedQueries, DataTest):
+    def get(self, url):
+        token = self.login(self.management_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        return self.client.get(url, format="json")
+
+    def test_filter_in_list(self):
+        response = self.get(
+            f"/crm/contracts/?id__in={self.contract1.id},{self.contract2.id}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {data['pk'] for data in response.data['results']},
+            {self.contract1.id, self.contract2.id})
+
+    def test_filter_isnull(self):
+        self.event2.support_contact = None
+        self.event2.save()
+        response = self.get("/crm/events/?support_contact__isnull=true")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [data['pk'] for data in response.data['results']],
+            [self.event2.id])
+
+    def test_filter_on_related_field(self):
+        response = self.get(
+            f"/crm/events/?contract__client={self.client1.id}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            len(response.data['results']),
+            Event.objects.filter(contract__client=self.client1).count())
+
+    def test_filter_last_name_iexact(self):
+        response = self.get("/crm/clients/?last_name__iexact=vador")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [data['pk'] for data in response.data['results']],
+            [self.client1.id])
+
+    def test_unindexed_lookup_is_rejected(self):
+        for url in ["/crm/events/?notes__icontains=star",
+                    "/crm/clients/?contract__event__notes__icontains=star",
+                    "/crm/contracts/?id__icontains=1"]:
+            with self.subTest(url=url):
+                response = self.get(url)
+                self.assertEqual(response.status_code, 400)
+
+    def test_invalid_value(self):
+        response = self.get("/crm/clients/?id=abc")
+        self.assertEqual(response.status_code, 400)
+
+    def test_ordering(self):
+        response = self.get("/crm/contracts/?ordering=-id")
+        self.assertEqual(response.status_code, 200)
+        contracts_pk = [data['pk'] for data in response.data['results']]
+        self.assertEqual(contracts_pk, sorted(contracts_pk, reverse=True))
+        response = self.get("/crm/contracts/?ordering=amount")
+        self.assertEqual(response.status_code, 400)
+
+    def test_filter_plan_is_cached(self):
+        spec = ClientViewset.filter_spec
+        spec.compile.cache_clear()
+        self.get(f"/crm/clients/?sales_contact={self.sales_user.id}")
+        self.get(f"/crm/clients/?sales_contact={self.sales_user2.id}")
+        self.assertEqual(spec.compile.cache_info().hits, 1)
+
+    def test_spec_rejects_unindexed_field(self):
+        with self.assertRaises(ImproperlyConfigured):
+            FilterSpec(Event, fields={"notes": ("icontains",)})
+
+    def test_partial_index_serves_its_condition(self):
+        FilterSpec(Contract, fields={"status": ("exact",)})
+        with self.assertRaises(ImproperlyConfigured):
+            FilterSpec(Contract, fields={"status": ("exact", "in")})
+
+    def test_filter_contract_status(self):
+        response = self.get("/crm/contracts/?status=True")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {data['pk'] for data in response.data['results']},
+            set(Contract.objects.filter(status=True)
+                .values_list("id", flat=True)))
+        response = self.get("/crm/contracts/export/?format=ndjson&status=True")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            len(b"".join(response.streaming_content).splitlines()),
+            Contract.objects.filter(status=True).count())
+
+    def test_detail_ignores_query_params(self):
+        response = self.get(f"/crm/clients/{self.client1.id}/?foo=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["pk"], self.client1.id)
+
+
+class ListScopeTest(DetectRepeatedQueries, DataTest):
+    def list_pk(self, user, url):
+        token = self.login(user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, 200)
+        return {data['pk'] for data in response.data['results']}
+
+    def test_management_sees_every_row(self):
+        self.add_rows(5)
+        self.assertEqual(
+            self.list_pk(self.management_user, "/crm/clients/"),
+            set(Client.objects.values_list("pk", flat=True)))
+
+    def test_sales_user_sees_own_clients_and_contracts(self):
+        self.add_rows(5)
+        self.assertEqual(
+            self.list_pk(self.sales_user, "/crm/clients/"),
+            {self.client1.id, self.client2.id})
+        self.assertEqual(
+            self.list_pk(self.sales_user2, "/crm/contracts/"),
+            set(Contract.objects.filter(
+                client__sales_contact=self.sales_user2
+            ).values_list("pk", flat=True)))
+
+    def test_sales_user_sees_events_of_own_clients(self):
+        self.add_rows(5)
+        self.assertEqual(
+            self.list_pk(self.sales_user, "/crm/events/"),
+            {self.event1.id, self.event2.id})
+
+    def test_support_user_sees_assigned_events_and_their_clients(self):
+        self.add_rows(5)
+        self.assertEqual(
+            self.list_pk(self.support_user, "/crm/events/"),
+            {self.event1.id, self.event2.id})
+        # one client with two supported events is listed once
+        self.assertEqual(
+            self.list_pk(self.support_user, "/crm/clients/"),
+            {self.client1.id})
+        self.assertEqual(
+            self.list_pk(self.support_user, "/crm/contracts/"), set())
+
+    def test_export_is_scoped(self):
+        self.add_rows(5)
+        token = self.login(self.sales_user)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer " + token["access"])
+        response = self.client.get("/crm/clients/export/?format=ndjson")
+        content = b"".join(response.streaming_content).decode()
+        self.assertEqual(len(content.splitlines()), 2)
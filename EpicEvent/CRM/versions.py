@@ -0,0 +1,76 @@
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models.signals import (
+    post_delete,
+    post_save
+)
+from authentication.models import User
+from .models import (
+    Client,
+    Contract,
+    Event
+)
+
+RESPONSE_CACHE = getattr(settings, "RESPONSE_CACHE", {})
+
+# models whose rows end up in responses or decide their visibility
+# a save or a delete of one of them bumps its version
+VERSIONED_MODELS = (Client, Contract, Event, User)
+
+# backends whose entries the other workers don't see
+PROCESS_LOCAL_BACKENDS = (LocMemCache, DummyCache)
+
+
+def get_cache():
+    return caches[RESPONSE_CACHE.get("ALIAS", "default")]
+
+
+def is_shared():
+    """
+    whether the versions are shared by the workers: in a cache
+    of the process, a change made by a worker doesn't make the
+    responses of the others stale
+    """
+    return not isinstance(get_cache(), PROCESS_LOCAL_BACKENDS)
+
+
+def version_key(model):
+    return f"crm:version:{model._meta.label_lower}"
+
+
+def bump_version(model):
+    """
+    makes every cached response and validator depending on model stale,
+    to be called after changes made without signals, e.g. bulk_create
+    """
+    cache = get_cache()
+    try:
+        cache.incr(version_key(model))
+    except ValueError:
+        # evicted or never set, a new starting point
+        # can't match the versions of older responses
+        cache.set(version_key(model), time.time_ns(), None)
+
+
+def get_versions(models):
+    cache = get_cache()
+    keys = [version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            versions[key] = time.time_ns()
+            if not cache.add(key, versions[key], None):
+                versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_version_on_change(sender, **kwargs):
+    bump_version(sender)
+
+
+for versioned_model in VERSIONED_MODELS:
+    post_save.connect(bump_version_on_change, sender=versioned_model)
+    post_delete.connect(bump_version_on_change, sender=versioned_model)
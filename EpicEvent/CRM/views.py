@@ -1,27 +1,50 @@
+from rest_framework import status
 from rest_framework.viewsets import ModelViewSet
-from django.core.exceptions import (
-    ObjectDoesNotExist,
-    FieldError
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseForbidden
 )
 from rest_framework.exceptions import NotFound
+from authentication.throttle import client_ip
 from .models import (
     Client,
     Contract,
     Event
 )
+from .filters import (
+    FilterSpec,
+    SpecFilterBackend
+)
+from .cache import CachedResponseMixin
+from .conditional import ConditionalGetMixin
+from .export import (
+    CSVRenderer,
+    NDJSONRenderer,
+    export_response
+)
 from .serializers import (
     ClientDetailSerializer,
     ClientListSerializer,
     ContractDetailSerializer,
     ContractListSerializer,
     EventDetailSerializer,
-    EventListSerializer
+    EventListSerializer,
+    bulk_create_clients,
+    bulk_update_event_status,
+    multi_status
+)
+from .metrics import (
+    METRICS,
+    collect,
+    render
 )
+from .profiling import ProfilingMixin
+from .versions import bump_version
 from .permissions import (
-    IsAuthenticated,
-    IsManagementTeam,
-    IsSalesTeam,
-    IsSupportTeam,
+    PermissionMatrixMixin,
     IsClientSalesContact,
     IsContractSalesContact,
     IsEventSupportContact,
@@ -31,8 +54,46 @@ from .permissions import (
 
 
 class MultipleSerializerMixin:
-    permission_classes = [IsAuthenticated]
     detail_serializer_class = None
+    filter_backends = [SpecFilterBackend]
+    filter_spec = None
+    # for each team, the ownership rule restricting the listed rows
+    # to the caller's ones, None to list every row
+    list_scopes = {}
+    # for each action, related objects read by the serializer
+    # they are loaded in the same query as the rows
+    select_related_plans = {}
+
+    def get_eager_queryset(self, queryset):
+        return queryset.select_related(
+            *self.select_related_plans.get(self.action, ())
+        )
+
+    def scope_queryset(self, queryset):
+        """
+        keeps the rows the caller could retrieve,
+        filtered by the database instead of the object permissions
+        """
+        team = self.request.user.get_team()
+        if team not in self.list_scopes:
+            return queryset.none()
+        permission = self.list_scopes[team]
+        if permission is None:
+            return queryset
+        return queryset.filter(permission.scope(self.request.user))
+
+    def get_object(self):
+        """
+        loads the row and its ownership chain in one query,
+        object permissions are then checked in memory
+        """
+        try:
+            return super().get_object()
+        except Http404:
+            name = self.get_queryset().model._meta.verbose_name
+            raise NotFound(
+                detail=f"Sorry, {name} {self.kwargs['pk']} doesn't exist"
+            )
 
     def get_serializer_class(self):
         if self.action == "retrieve" and self.get_serializer_class is not None:
@@ -44,202 +105,237 @@ class MultipleSerializerMixin:
         return super().get_serializer_class()
 
 
-class ClientViewset(MultipleSerializerMixin, ModelViewSet):
+class ExportMixin:
+    # columns of /export, read with values_list so no model is built
+    export_fields = ()
+
+    @action(
+        detail=False,
+        renderer_classes=[CSVRenderer, NDJSONRenderer]
+    )
+    def export(self, request):
+        """
+        streams the filtered rows as csv (default) or ndjson
+        e.g. /crm/contracts/export/?format=ndjson&status=True
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        return export_response(
+            queryset,
+            self.export_fields,
+            request.accepted_renderer.format,
+            self.basename
+        )
+
+
+class ClientViewset(ProfilingMixin, PermissionMatrixMixin,
+                    MultipleSerializerMixin, CachedResponseMixin,
+                    ConditionalGetMixin, ExportMixin, ModelViewSet):
     serializer_class = ClientListSerializer
     detail_serializer_class = ClientDetailSerializer
+    list_scopes = {
+        "Management team": None,
+        "Sales team": IsClientSalesContact,
+        "Support team": IsClientEventSupportContact,
+    }
+    filter_spec = FilterSpec(
+        Client,
+        fields={
+            "id": ("exact", "in"),
+            "sales_contact": ("exact", "in"),
+            "email": ("exact", "in"),
+            "last_name": ("exact", "in", "iexact"),
+            "date_created": ("exact", "gt", "gte", "lt", "lte", "range"),
+        },
+    )
+    export_fields = (
+        "id",
+        "first_name",
+        "last_name",
+        "email",
+        "phone",
+        "mobile",
+        "company_name",
+        "sales_contact",
+        "date_created",
+        "date_updated",
+    )
+    select_related_plans = {
+        "list": ("sales_contact",),
+        "retrieve": ("sales_contact",),
+        "update": ("sales_contact",),
+    }
 
-    def get_permissions(self):
-        permission_classes = []
-        if (self.request.method == 'GET'
-                and "pk" not in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                IsSalesTeam |
-                IsSupportTeam
-            ]
-        elif (self.request.method == 'GET'
-              and "pk" in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                (IsSalesTeam & IsClientSalesContact) |
-                (IsSupportTeam & IsClientEventSupportContact)
-            ]
-        elif (self.request.method == 'DELETE'
-              and "pk" in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                (IsSalesTeam & IsClientSalesContact)
-            ]
-        elif (self.request.method == 'PUT'
-              and "pk" in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                (IsSalesTeam & IsClientSalesContact)
-            ]
-        elif self.request.method == 'POST':
-            permission_classes = [IsManagementTeam | IsSalesTeam]
-        return [permission() for permission in permission_classes]
+    # items of a bulk create
+    bulk_create_max_items = 1000
+
+    def create(self, request, *args, **kwargs):
+        """
+        a json array of clients is created in bulk,
+        the response gives the result of each item
+        """
+        if not isinstance(request.data, list):
+            return super().create(request, *args, **kwargs)
+        if not 0 < len(request.data) <= self.bulk_create_max_items:
+            return Response(
+                {
+                    "detail":
+                        "Please send between 1 and "
+                        f"{self.bulk_create_max_items} clients"
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        results = bulk_create_clients(
+            request.data, self.get_serializer_context()
+        )
+        response_status = multi_status(results, status.HTTP_201_CREATED)
+        if response_status != status.HTTP_400_BAD_REQUEST:
+            # bulk_create sends no signal
+            bump_version(Client)
+        return Response(results, status=response_status)
 
     def get_queryset(self):
+        # list filters are applied by SpecFilterBackend,
+        # the detail row is fetched by get_object
+        queryset = self.get_eager_queryset(Client.objects.all())
         if "pk" not in self.request.parser_context["kwargs"]:
-            queryset = Client.objects.all()
-            try:
-                queryset = queryset.filter(
-                    **dict(self.request.query_params.items())
-                )
-                return queryset
-            except FieldError:
-                raise NotFound(
-                    detail=(
-                        "Sorry, looks like you search for inexistent fields. "
-                        "Please ensure you correctly entered searched fields."
-                    )
-                )
-            return queryset
+            return self.scope_queryset(queryset)
         else:
-            client_pk = self.request.parser_context["kwargs"]["pk"]
-            try:
-                Client.objects.get(id=client_pk)
-            except ObjectDoesNotExist:
-                raise NotFound(
-                    detail=f"Sorry, client {client_pk} doesn't exist"
+            # ownership chain of the caller,
+            # checked in memory by IsClientEventSupportContact
+            return queryset.annotate(
+                is_event_support_contact=IsClientEventSupportContact.scope(
+                    self.request.user
                 )
-            queryset = Client.objects.filter(
-                id=client_pk
             )
-            return queryset
 
 
-class ContractViewset(MultipleSerializerMixin, ModelViewSet):
+class ContractViewset(ProfilingMixin, PermissionMatrixMixin,
+                      MultipleSerializerMixin, CachedResponseMixin,
+                      ConditionalGetMixin, ExportMixin, ModelViewSet):
     serializer_class = ContractListSerializer
     detail_serializer_class = ContractDetailSerializer
-
-    def get_permissions(self):
-        if (self.request.method == 'GET'
-                and "pk" not in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                IsSalesTeam |
-                IsSupportTeam
-            ]
-        elif (self.request.method == 'GET'
-              and "pk" in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                (IsSalesTeam & IsContractSalesContact)
-            ]
-        elif (self.request.method == 'DELETE'
-              and "pk" in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                (IsSalesTeam & IsContractSalesContact)
-            ]
-        elif (self.request.method == 'PUT'
-              and "pk" in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                (IsSalesTeam & IsContractSalesContact)
-            ]
-        elif self.request.method == 'POST':
-            permission_classes = [
-                IsManagementTeam |
-                IsSalesTeam
-            ]
-        return [permission() for permission in permission_classes]
+    list_scopes = {
+        "Management team": None,
+        "Sales team": IsContractSalesContact,
+    }
+    filter_spec = FilterSpec(
+        Contract,
+        fields={
+            "id": ("exact", "in"),
+            "client": ("exact", "in"),
+            "client__sales_contact": ("exact", "in"),
+            # served by contract_signed_client_idx
+            "status": ("exact",),
+            "payment_due": ("exact", "gt", "gte", "lt", "lte", "range"),
+            "date_created": ("exact", "gt", "gte", "lt", "lte", "range"),
+        },
+    )
+    export_fields = (
+        "id",
+        "client",
+        "client__company_name",
+        "status",
+        "amount",
+        "payment_due",
+        "date_created",
+        "date_updated",
+    )
+    select_related_plans = {
+        "list": ("client__sales_contact",),
+        "retrieve": ("client__sales_contact",),
+        "update": ("client__sales_contact",),
+        "destroy": ("client",),
+    }
 
     def get_queryset(self):
+        # list filters are applied by SpecFilterBackend,
+        # the detail row is fetched by get_object
+        # with the ownership chain read by the permissions
+        queryset = self.get_eager_queryset(Contract.objects.all())
         if "pk" not in self.request.parser_context["kwargs"]:
-            queryset = Contract.objects.all()
-            try:
-                queryset = queryset.filter(
-                    **dict(self.request.query_params.items())
-                )
-                return queryset
-            except FieldError:
-                raise NotFound(
-                    detail=(
-                        "Sorry, looks like you search for inexistent fields. "
-                        "Please ensure you correctly entered searched fields."
-                    )
-                )
-        else:
-            contract_pk = self.request.parser_context["kwargs"]["pk"]
-            try:
-                Contract.objects.get(id=contract_pk)
-            except ObjectDoesNotExist:
-                raise NotFound(
-                    detail=f"Sorry, contract {contract_pk} doesn't exist"
-                )
-            queryset = Contract.objects.filter(
-                id=contract_pk
-            )
-            return queryset
+            return self.scope_queryset(queryset)
+        return queryset
 
 
-class EventViewset(MultipleSerializerMixin, ModelViewSet):
+class EventViewset(ProfilingMixin, PermissionMatrixMixin,
+                   MultipleSerializerMixin, CachedResponseMixin,
+                   ConditionalGetMixin, ExportMixin, ModelViewSet):
     serializer_class = EventListSerializer
     detail_serializer_class = EventDetailSerializer
-
-    def get_permissions(self):
-        if (self.request.method == 'GET'
-                and "pk" not in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                IsSalesTeam |
-                IsSupportTeam
-            ]
-        elif (self.request.method == 'GET'
-              and "pk" in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                (IsSalesTeam & IsEventContractSalesContact) |
-                (IsSupportTeam & IsEventSupportContact)
-            ]
-        elif (self.request.method == 'DELETE'
-              and "pk" in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                (IsSalesTeam & IsEventContractSalesContact)
-            ]
-        elif (self.request.method == 'PUT'
-              and "pk" in self.request.parser_context["kwargs"]):
-            permission_classes = [
-                IsManagementTeam |
-                (IsSalesTeam & IsEventContractSalesContact) |
-                (IsSupportTeam & IsEventSupportContact)
-            ]
-        elif self.request.method == 'POST':
-            permission_classes = [
-                IsManagementTeam |
-                IsSalesTeam
-            ]
-        return [permission() for permission in permission_classes]
+    list_scopes = {
+        "Management team": None,
+        "Sales team": IsEventContractSalesContact,
+        "Support team": IsEventSupportContact,
+    }
+    filter_spec = FilterSpec(
+        Event,
+        fields={
+            "id": ("exact", "in"),
+            "contract": ("exact", "in"),
+            "contract__client": ("exact", "in"),
+            "support_contact": ("exact", "in", "isnull"),
+            "event_status": ("exact", "in"),
+            "date_created": ("exact", "gt", "gte", "lt", "lte", "range"),
+        },
+    )
+    export_fields = (
+        "id",
+        "name",
+        "contract",
+        "support_contact",
+        "event_status",
+        "attendees",
+        "event_date",
+        "notes",
+        "date_created",
+        "date_updated",
+    )
+    select_related_plans = {
+        "list": ("contract__client", "support_contact"),
+        "retrieve": ("contract__client", "support_contact"),
+        "update": ("contract__client", "support_contact"),
+        "destroy": ("contract__client",),
+    }
 
     def get_queryset(self):
+        # list filters are applied by SpecFilterBackend,
+        # the detail row is fetched by get_object
+        # with the ownership chain read by the permissions
+        queryset = self.get_eager_queryset(Event.objects.all())
         if "pk" not in self.request.parser_context["kwargs"]:
-            queryset = Event.objects.all()
-            try:
-                queryset = queryset.filter(
-                    **dict(self.request.query_params.items())
-                )
-                return queryset
-            except FieldError:
-                raise NotFound(
-                    detail=(
-                        "Sorry, looks like you search for inexistent fields. "
-                        "Please ensure you correctly entered searched fields."
-                    )
-                )
-            return queryset
-        else:
-            event_pk = self.request.parser_context["kwargs"]["pk"]
-            try:
-                Event.objects.get(id=event_pk)
-            except ObjectDoesNotExist:
-                raise NotFound(
-                    detail=f"Sorry, event {event_pk} doesn't exist"
-                )
-            queryset = Event.objects.filter(
-                id=event_pk
+            return self.scope_queryset(queryset)
+        return queryset
+
+    @action(detail=False, methods=["patch"], url_path="status")
+    def batch_status(self, request):
+        """
+        changes the status, and optionally the notes, of a batch of events
+        e.g. [{"event_id": 3, "event_status": "Closed", "notes": "done"}]
+        the response gives the result of each item
+        """
+        if not isinstance(request.data, list) or not request.data:
+            return Response(
+                {"detail": "Please send a list of event status changes"},
+                status=status.HTTP_400_BAD_REQUEST
             )
-            return queryset
+        results = bulk_update_event_status(
+            request.data, self.scope_queryset(Event.objects.all())
+        )
+        response_status = multi_status(results, status.HTTP_200_OK)
+        if response_status != status.HTTP_400_BAD_REQUEST:
+            # bulk_update sends no signal
+            bump_version(Event)
+        return Response(results, status=response_status)
+
+
+def metrics(request):
+    """
+    metrics of every worker in the text format of Prometheus,
+    for the addresses of ALLOWED_IPS only
+    """
+    if client_ip(request) not in METRICS.get(
+            "ALLOWED_IPS", ("127.0.0.1", "::1")):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        render(collect()), content_type="text/plain; version=0.0.4"
+    )
@@ -0,0 +1,200 @@
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    one json object per line: time, level, logger and message,
+    with the traceback of the exception if any
+    """
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class QueueFileHandler(logging.Handler):
+    """
+    writes to filename from a background thread:
+    emit only puts the record in a queue of queue_size records,
+    the thread writes the records waiting in the queue together,
+    batch_size at most, with one write and one flush
+    the file is rotated beyond max_bytes or every rotate_every seconds,
+    backup_count previous files being kept as filename.1, filename.2...
+    a worker whose file was rotated by another one opens filename again
+    when the queue is more than sample_above full, only one in sample_rate
+    records below WARNING is kept, a full queue drops the records,
+    the number of records dropped is written in the file
+    """
+    def __init__(self, filename, max_bytes=0, rotate_every=0,
+                 backup_count=5, queue_size=10000, batch_size=500,
+                 sample_above=0.8, sample_rate=10, encoding="utf-8"):
+        super().__init__()
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.rotate_every = rotate_every
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.sample_above = int(queue_size * sample_above)
+        self.sample_rate = sample_rate
+        self.encoding = encoding
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.sampled = 0
+        self.stream = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        # started by the first record of each process,
+        # a forked worker doesn't inherit the thread of its parent
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self.listen, name="log-writer", daemon=True
+            )
+            self._thread.start()
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self.start()
+        if (record.levelno < logging.WARNING
+                and self.queue.qsize() >= self.sample_above):
+            self.sampled += 1
+            if self.sampled % self.sample_rate:
+                self.dropped += 1
+                return
+        try:
+            # the message is built now, its arguments may change meanwhile
+            record.msg = record.getMessage()
+            record.args = None
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def listen(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.write([record for record in batch if record is not None])
+            for _ in batch:
+                self.queue.task_done()
+            if None in batch:
+                return
+
+    def write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record) + "\n")
+            except Exception:
+                self.handleError(record)
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.append(self.format(logging.makeLogRecord({
+                "name": __name__,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": f"{dropped} log records dropped",
+            })) + "\n")
+        if not lines:
+            return
+        text = "".join(lines)
+        try:
+            if self.should_rotate(len(text.encode(self.encoding))):
+                self.rotate()
+            if self.stream is not None and self.moved():
+                self.stream.close()
+                self.stream = None
+            if self.stream is None:
+                self.open()
+            self.stream.write(text)
+            self.stream.flush()
+        except OSError:
+            if records:
+                self.handleError(records[0])
+
+    def open(self):
+        self.stream = open(self.filename, "a", encoding=self.encoding)
+
+    def moved(self):
+        """
+        whether filename isn't the open file anymore, as in
+        WatchedFileHandler: another worker rotated it meanwhile
+        """
+        try:
+            current = os.stat(self.filename)
+        except FileNotFoundError:
+            return True
+        opened = os.fstat(self.stream.fileno())
+        return (current.st_dev, current.st_ino) != (
+            opened.st_dev, opened.st_ino
+        )
+
+    def should_rotate(self, size):
+        if not os.path.exists(self.filename):
+            return False
+        if self.max_bytes and (
+                os.path.getsize(self.filename) + size > self.max_bytes):
+            return True
+        # periods of rotate_every seconds since the epoch, e.g. days,
+        # the file is rotated by the first write of a new period
+        return bool(self.rotate_every) and (
+            os.path.getmtime(self.filename) // self.rotate_every
+            != time.time() // self.rotate_every
+        )
+
+    def rotate(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        try:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = f"{self.filename}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.filename}.{index + 1}")
+            if self.backup_count:
+                os.replace(self.filename, f"{self.filename}.1")
+            else:
+                os.remove(self.filename)
+        except FileNotFoundError:
+            # rotated by another worker at the same time
+            pass
+
+    def flush(self):
+        # waits for the records already queued to be written
+        while (self.queue.unfinished_tasks and self._thread is not None
+               and self._thread.is_alive()):
+            time.sleep(0.001)
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(timeout=5)
+        self._pid = None
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        super().close()
@@ -50,6 +50,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'CRM.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,6 +58,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'CRM.profiling.ProfilingMiddleware',
+    'CRM.nplusone.NPlusOneMiddleware',
 ]
 
 ROOT_URLCONF = 'EpicEvent.urls'
@@ -147,8 +150,10 @@ REST_FRAMEWORK = {
     "DATETIME_FORMAT": "%Y/%m/%d %H:%M",
     "DATETIME_INPUT_FORMATS": "%d-%m-%Y %H:%M:%S",
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "authentication.authentication.JWTAuthentication",
     ),
+    "DEFAULT_PAGINATION_CLASS": "CRM.pagination.CRMCursorPagination",
+    "PAGE_SIZE": 50,
 }
 
 
@@ -158,6 +163,89 @@ SIMPLE_JWT = {
 
 AUTH_USER_MODEL = "authentication.User"
 
+# per-process cache of the users authenticated by their token
+USER_CACHE = {
+    "MAX_SIZE": 1024,
+    "TTL": 60,
+}
+
+# responses of the CRM lists and details, see CRM/cache.py
+# the cache and the versions of the ETags need a backend shared by the
+# processes, e.g. "django.core.cache.backends.filebased.FileBasedCache"
+# or "django.core.cache.backends.redis.RedisCache": with a backend of
+# the process (locmem) they are off, the ETags hash the responses
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "crm",
+    }
+}
+
+RESPONSE_CACHE = {
+    "ENABLED": False,
+    "ALIAS": "default",
+    "TIMEOUT": 300,
+}
+
+# per-process cache of the access tokens already verified
+TOKEN_CACHE = {
+    "ENABLED": True,
+    "MAX_SIZE": 4096,
+}
+
+# threads hashing the passwords of /crm/login/, and number of logins
+# being checked beyond which logins are refused with a 503
+PASSWORD_CHECK = {
+    "WORKERS": 4,
+    "MAX_PENDING": 64,
+}
+
+# token buckets of login attempts, for /crm/login/ and the admin site:
+# CAPACITY attempts in a burst, then one more every REFILL seconds
+# "BACKEND": "cache" shares the buckets through the cache ALIAS of CACHES
+# behind proxies, PROXY_COUNT is the number of X-Forwarded-For entries
+# they add
+LOGIN_THROTTLE = {
+    "ENABLED": True,
+    "BACKEND": "locmem",
+    "ALIAS": "default",
+    "MAX_SIZE": 10000,
+    "USERNAME": {"CAPACITY": 5, "REFILL": 60},
+    "IP": {"CAPACITY": 20, "REFILL": 6},
+    "PROXY_COUNT": 0,
+}
+
+# a sample of the requests is profiled, and the requests with a
+# X-Profile header: Server-Timing header for management users and
+# averages of each endpoint logged every LOG_INTERVAL seconds
+PROFILING = {
+    "ENABLED": True,
+    "SAMPLE_RATE": 0.01,
+    "LOG_INTERVAL": 60,
+}
+
+# statements repeated more than THRESHOLD times by a request,
+# e.g. a query per row of a list, are logged with the stack calling them
+# to enable in staging, tests opt in with DetectRepeatedQueries
+NPLUSONE = {
+    "ENABLED": False,
+    "THRESHOLD": 5,
+    "ACTION": "log",
+}
+
+# requests, latency and queries by viewset and action, at /metrics/
+# with several workers, DIRECTORY is a directory they share,
+# each one writes its metrics there every FLUSH_INTERVAL seconds
+METRICS = {
+    "ENABLED": True,
+    "DIRECTORY": None,
+    "FLUSH_INTERVAL": 5,
+    "ALLOWED_IPS": ["127.0.0.1", "::1"],
+}
+
+# records are written by a background thread of EpicEvent/log_handlers.py,
+# requests only put them in a queue, see QueueFileHandler for the options
+# "formatter": "json" writes one json object per line
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -165,20 +253,36 @@ LOGGING = {
         'verbose': {
             'format': "[%(asctime)s] %(levelname)s %(message)s",
             'datefmt': "%Y/%m/%d %H:%M:%S"
-        }
+        },
+        'json': {
+            '()': 'EpicEvent.log_handlers.JsonFormatter',
+        },
     },
     'handlers': {
         'file': {
             'level': 'ERROR',
-            'class': 'logging.FileHandler',
+            'class': 'EpicEvent.log_handlers.QueueFileHandler',
             'filename': 'CRM/log/debug.log',
             'formatter': 'verbose',
+            'max_bytes': 10 * 1024 * 1024,
+            'backup_count': 5,
         },
         'login_file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'EpicEvent.log_handlers.QueueFileHandler',
             'filename': 'CRM/log/login.log',
             'formatter': 'verbose',
+            'max_bytes': 10 * 1024 * 1024,
+            'rotate_every': 24 * 60 * 60,
+            'backup_count': 30,
+        },
+        'profiling_file': {
+            'level': 'INFO',
+            'class': 'EpicEvent.log_handlers.QueueFileHandler',
+            'filename': 'CRM/log/profiling.log',
+            'formatter': 'verbose',
+            'max_bytes': 10 * 1024 * 1024,
+            'backup_count': 5,
         },
     },
     'loggers': {
@@ -192,6 +296,16 @@ LOGGING = {
                 'level': 'INFO',
                 'propagate': False,
             },
+            'profiling': {
+                'handlers': ['profiling_file'],
+                'level': 'INFO',
+                'propagate': False,
+            },
+            'queries': {
+                'handlers': ['profiling_file'],
+                'level': 'WARNING',
+                'propagate': False,
+            },
     },
 
 }
@@ -15,17 +15,18 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from rest_framework_simplejwt.views import TokenRefreshView
 from rest_framework_nested import routers
 from authentication.admin import MyLoginView
 from authentication.views import (
     UserViewset,
-    TokenObtainPairView
+    LoginView,
+    TokenRefreshView
 )
 from CRM.views import (
     ClientViewset,
     ContractViewset,
-    EventViewset
+    EventViewset,
+    metrics
 )
 
 admin.sites.AdminSite.site_header = 'Epic Events CRM'
@@ -44,5 +45,6 @@ urlpatterns = [
     path("crm/token/refresh/", TokenRefreshView.as_view(),
          name="token_refresh"),
     path("crm/", include(router.urls)),
-    path("crm/login/", TokenObtainPairView.as_view(), name="login"),
+    path("crm/login/", LoginView.as_view(), name="login"),
+    path("metrics/", metrics, name="metrics"),
 ]
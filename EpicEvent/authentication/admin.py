@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.contrib import messages
 from django.urls import resolve
 from django.db.models import Q
 from .models import User
@@ -12,13 +13,25 @@ from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django import forms
 from django.core.exceptions import ValidationError
 from .validators import Validators
+from .provisioning import save_with_username
+from .throttle import (
+    client_ip,
+    login_throttle,
+    use_login_throttle
+)
 from django.contrib.auth.signals import user_logged_out
 from django.dispatch import receiver
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.views import LoginView
 from django.utils.html import format_html
+from CRM.reassign import (
+    ROLES,
+    reassign,
+    team_members
+)
 import datetime
 import logging
+import math
 
 login_logger = logging.getLogger("login_security")
 
@@ -29,6 +42,27 @@ def post_logout(sender, request, user, **kwargs):
 
 
 class MyAuthForm(AuthenticationForm):
+    def clean(self):
+        # attempts beyond LOGIN_THROTTLE are refused
+        # before the user is read or the password hashed
+        username = self.cleaned_data.get("username")
+        ip = client_ip(self.request) if self.request else ""
+        if username and use_login_throttle:
+            wait = login_throttle.attempt(username, ip)
+            if wait:
+                login_logger.warning(
+                    "login of %s from %s to admin site throttled",
+                    username, ip
+                )
+                raise ValidationError(
+                    "Too many login attempts, please retry "
+                    f"in {math.ceil(wait)} seconds"
+                )
+        cleaned_data = super().clean()
+        if username and use_login_throttle:
+            login_throttle.succeeded(username, ip)
+        return cleaned_data
+
     def get_invalid_login_error(self):
         self.error_messages["invalid_login"] = (
             "You must provide both valid username"
@@ -101,16 +135,20 @@ class UserForm(forms.ModelForm):
         user = super().save(commit=False)
         user.first_name = user.first_name.title()
         user.last_name = user.last_name.title()
-        # in add form, username is set automatically
-        if "username" not in self.fields:
-            user.username = Validators.is_valid_username(
-                user.first_name, user.last_name
-            )
         if self.cleaned_data["password1"]:
             user.set_password(self.cleaned_data["password1"])
-        if self.cleaned_data["groups"].first().name == "Management team":
+        team = self.cleaned_data["groups"].first().name
+        if user.pk and user.get_team() != team:
+            # tokens carrying the previous team can't be refreshed
+            user.role_version += 1
+        if team == "Management team":
             user.is_staff = True
-        user.save()
+        # in add form, username is set automatically
+        # and allocated again if taken meanwhile
+        if "username" not in self.fields:
+            save_with_username(user)
+        else:
+            user.save()
         return user
 
 
@@ -186,6 +224,45 @@ class CustomUserAdmin(BaseUserAdmin):
 
     number_of_clients.short_description = "nb of clients"
 
+    actions = ["count_book", "spread_book_across_team"]
+
+    @admin.action(description="Count clients and events of selected users")
+    def count_book(self, request, queryset):
+        selected = list(queryset.values_list("id", flat=True))
+        for role, (model, _, team) in ROLES.items():
+            count = reassign(role, selected, [], dry_run=True)
+            self.message_user(
+                request,
+                f"{count} {model._meta.verbose_name_plural} would be "
+                f"spread across {len(team_members(role, selected))} "
+                f"members of {team}"
+            )
+
+    @admin.action(
+        description="Spread clients and events of selected users "
+                    "across their team"
+    )
+    def spread_book_across_team(self, request, queryset):
+        selected = list(queryset.values_list("id", flat=True))
+        for role, (model, _, team) in ROLES.items():
+            to_users = team_members(role, selected)
+            name = model._meta.verbose_name_plural
+            if not to_users:
+                if reassign(role, selected, [], dry_run=True):
+                    self.message_user(
+                        request,
+                        f"Nobody else is member of {team}, "
+                        f"{name} were not moved",
+                        messages.WARNING
+                    )
+                continue
+            count = reassign(role, selected, to_users)
+            self.message_user(
+                request,
+                f"{count} {name} spread across {len(to_users)} "
+                f"members of {team}"
+            )
+
     def get_form(self, request, obj=None, **kwargs):
         form = super().get_form(request, obj, **kwargs)
         if obj:
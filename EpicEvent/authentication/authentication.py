@@ -0,0 +1,110 @@
+import copy
+import hashlib
+import time
+from django.conf import settings
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save
+)
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import (
+    JWTAuthentication as BaseJWTAuthentication
+)
+from rest_framework_simplejwt.exceptions import (
+    AuthenticationFailed,
+    InvalidToken
+)
+from rest_framework_simplejwt.settings import api_settings
+from authentication.cache import LRUCache
+from authentication.models import User
+from CRM.metrics import register_cache
+
+USER_CACHE = getattr(settings, "USER_CACHE", {})
+TOKEN_CACHE = getattr(settings, "TOKEN_CACHE", {})
+
+# users of the tokens, by user_id, with the name of their team
+user_cache = LRUCache(
+    max_size=USER_CACHE.get("MAX_SIZE", 1024),
+    ttl=USER_CACHE.get("TTL", 60),
+)
+# validated access tokens, by digest of the raw token, until they expire
+token_cache = LRUCache(
+    max_size=TOKEN_CACHE.get("MAX_SIZE", 4096),
+    ttl=api_settings.ACCESS_TOKEN_LIFETIME.total_seconds(),
+)
+# their hits and misses at /metrics/
+register_cache("user", user_cache)
+register_cache("token", token_cache)
+
+
+class JWTAuthentication(BaseJWTAuthentication):
+    """
+    loads the user of the token together with the name of their team,
+    or takes it from user_cache, so that neither the authentication
+    nor the permissions need a query
+    the team of the token, when there is one, is the one permissions read
+    tokens already verified are taken from token_cache
+    """
+    use_token_cache = TOKEN_CACHE.get("ENABLED", True)
+
+    def get_validated_token(self, raw_token):
+        if not self.use_token_cache:
+            return super().get_validated_token(raw_token)
+        digest = hashlib.sha256(raw_token).digest()
+        validated_token = token_cache.get(digest)
+        if validated_token is None:
+            validated_token = super().get_validated_token(raw_token)
+            ttl = validated_token["exp"] - time.time()
+            if ttl > 0:
+                token_cache.set(digest, validated_token, ttl)
+        return validated_token
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(
+                _("Token contained no recognizable user identification")
+            )
+        user = user_cache.get(user_id)
+        if user is None:
+            try:
+                user = self.user_model.objects.with_team().get(
+                    **{api_settings.USER_ID_FIELD: user_id}
+                )
+            except self.user_model.DoesNotExist:
+                raise AuthenticationFailed(
+                    _("User not found"), code="user_not_found"
+                )
+            user_cache.set(user_id, user)
+        # each request gets its own instance
+        user = copy.copy(user)
+        # the team is a claim of tokens issued by LoginUserSerializer
+        if "team" in validated_token:
+            user.team = validated_token["team"]
+        if not user.is_active:
+            raise AuthenticationFailed(
+                _("User is inactive"), code="user_inactive"
+            )
+        return user
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user(sender, instance, **kwargs):
+    user_cache.delete(instance.pk)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def forget_user_groups(sender, instance, reverse, pk_set, **kwargs):
+    if not reverse:
+        user_cache.delete(instance.pk)
+    elif pk_set:
+        # users added to or removed from a group
+        for pk in pk_set:
+            user_cache.delete(pk)
+    else:
+        # a group cleared of its users
+        user_cache.clear()
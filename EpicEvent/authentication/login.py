@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import check_password
+from authentication.models import User
+
+login_logger = logging.getLogger("login_security")
+
+PASSWORD_CHECK = getattr(settings, "PASSWORD_CHECK", {})
+
+# passwords are hashed by these threads only, whatever the number of logins
+# hashlib releases the GIL, the other requests keep running meanwhile
+password_pool = ThreadPoolExecutor(
+    max_workers=PASSWORD_CHECK.get("WORKERS", 4),
+    thread_name_prefix="password-check",
+)
+# logins being checked or waiting for a thread of password_pool
+pending_checks = threading.BoundedSemaphore(
+    PASSWORD_CHECK.get("MAX_PENDING", 64)
+)
+
+
+class TooManyLogins(Exception):
+    pass
+
+
+def find_user(username):
+    """
+    the user with their team in one query,
+    read for the log, the password check and the token
+    """
+    user = User.objects.with_team().filter(username=username).first()
+    if user is None:
+        login_logger.warning("someone with username %s "
+                             "tried to connect to API", username)
+    else:
+        login_logger.info("user %s connected to API", user)
+    return user
+
+
+def verify_password(user, password):
+    if user is None:
+        # as ModelBackend, an unknown username takes as long
+        # as a wrong password
+        User().set_password(password)
+        return False
+    # no setter, a hash needing an upgrade is upgraded at the next login
+    # through the admin site rather than from a thread of password_pool
+    return check_password(password, user.password) and user.is_active
+
+
+async def authenticate(username, password):
+    """
+    the active user with these credentials or None,
+    the password being checked in password_pool
+    raises TooManyLogins when MAX_PENDING logins are already in progress
+    """
+    if not pending_checks.acquire(blocking=False):
+        raise TooManyLogins
+    try:
+        user = await sync_to_async(find_user)(username)
+        valid = await asyncio.get_running_loop().run_in_executor(
+            password_pool, verify_password, user, password
+        )
+    finally:
+        pending_checks.release()
+    return user if valid else None
@@ -3,7 +3,12 @@ from django.contrib.auth.models import (
     PermissionsMixin,
     BaseUserManager
 )
+from django.contrib.auth.models import Group
 from django.db import models
+from django.db.models import (
+    OuterRef,
+    Subquery
+)
 
 
 class UserManager(BaseUserManager):
@@ -22,6 +27,19 @@ class UserManager(BaseUserManager):
         user.save(using=self._db)
         return user
 
+    def with_team(self):
+        """
+        annotates users with the name of their team,
+        a user belongs to only one group
+        """
+        return self.get_queryset().annotate(
+            team=Subquery(
+                Group.objects.filter(
+                    user=OuterRef("pk")
+                ).values("name")[:1]
+            )
+        )
+
     def create_superuser(self, username, password, **extra_fields):
         extra_fields.setdefault('is_staff', True)
         extra_fields.setdefault('is_superuser', True)
@@ -46,8 +64,23 @@ class User(PermissionsMixin, AbstractBaseUser):
         help_text="Designates whether the user can log into this admin site.",
     )
     is_superuser = models.BooleanField(default=False)
+    role_version = models.PositiveIntegerField(
+        default=0,
+        help_text="Incremented when the user changes team, "
+                  "tokens issued with a previous version can't be refreshed.",
+    )
 
     objects = UserManager()
 
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
+
+    def get_team(self):
+        """
+        name of the user's team (e.g. "Sales team") or None
+        loaded with the user by UserManager.with_team(),
+        otherwise read once and kept on the instance
+        """
+        if not hasattr(self, "team"):
+            self.team = self.groups.values_list("name", flat=True).first()
+        return self.team
@@ -0,0 +1,167 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from operator import or_
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.db import (
+    IntegrityError,
+    transaction
+)
+from django.db.models import Q
+from authentication.models import User
+
+# below this number of passwords, starting processes costs more
+# than hashing in the current one
+PARALLEL_HASHING_MIN = 8
+
+# a concurrent registration of the same name takes the allocated username
+# at most this number of times before the error is raised
+USERNAME_ATTEMPTS = 10
+
+
+def username_base(first_name, last_name):
+    # the lower first(s) letter(s) of first_name
+    # completed with the lower last_name
+    initials = ''.join([name[0] for name in first_name.split("-")])
+    return initials.lower() + last_name.lower()
+
+
+def next_username(base, taken):
+    # base, then base2, base3... the first one not taken
+    if base not in taken:
+        return base
+    counter = 2
+    while f"{base}{counter}" in taken:
+        counter += 1
+    return f"{base}{counter}"
+
+
+def allocate_usernames(names):
+    """
+    a username for each (first_name, last_name) of names,
+    the usernames starting like them being read in one query
+    """
+    bases = [username_base(first_name, last_name)
+             for first_name, last_name in names]
+    if not bases:
+        return []
+    taken = set(
+        User.objects.filter(
+            reduce(or_, [Q(username__startswith=base) for base in set(bases)])
+        ).values_list("username", flat=True)
+    )
+    usernames = []
+    for base in bases:
+        username = next_username(base, taken)
+        taken.add(username)
+        usernames.append(username)
+    return usernames
+
+
+def save_with_username(user):
+    """
+    saves a new user with the next free username for their name,
+    allocated again when a concurrent save took it first
+    """
+    for attempt in range(USERNAME_ATTEMPTS):
+        user.username = allocate_usernames(
+            [(user.first_name, user.last_name)]
+        )[0]
+        try:
+            # a savepoint, the transaction of the caller stays usable
+            with transaction.atomic():
+                user.save()
+            return user
+        except IntegrityError:
+            if attempt == USERNAME_ATTEMPTS - 1:
+                raise
+
+
+def hash_passwords(passwords, workers=None):
+    """
+    hashes of passwords, computed by a pool of processes,
+    one per core unless workers is given
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(passwords) < PARALLEL_HASHING_MIN:
+        return [make_password(password) for password in passwords]
+    # spawned processes don't share the database connections
+    # or the threads of the server
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=django.setup
+    ) as executor:
+        return list(executor.map(
+            make_password,
+            passwords,
+            chunksize=max(1, len(passwords) // (workers * 4))
+        ))
+
+
+def insert_users(created, teams, groups):
+    User.objects.bulk_create(created)
+    if any(user.pk is None for user in created):
+        # backends not returning the ids of inserted rows
+        ids = dict(
+            User.objects.filter(
+                username__in=[user.username for user in created]
+            ).values_list("username", "id")
+        )
+        for user in created:
+            user.pk = ids[user.username]
+    User.groups.through.objects.bulk_create([
+        User.groups.through(
+            user_id=user.pk, group_id=groups[f"{team} team"].pk
+        )
+        for user, team in zip(created, teams)
+    ])
+
+
+def provision_users(users, workers=None):
+    """
+    creates users, each a dict with first_name, last_name,
+    password and team (Management, Sales or Support)
+    usernames are allocated in one pass, passwords hashed in parallel,
+    users and their group memberships inserted with bulk_create
+    returns the created users, in order
+    """
+    hashes = hash_passwords(
+        [user["password"] for user in users], workers
+    )
+    groups = {
+        group.name: group for group in Group.objects.filter(
+            name__in={f"{user['team']} team" for user in users}
+        )
+    }
+    created = [
+        User(
+            first_name=user["first_name"].title(),
+            last_name=user["last_name"].title(),
+            password=password_hash,
+            is_staff=user["team"] == "Management",
+        )
+        for user, password_hash in zip(users, hashes)
+    ]
+    for attempt in range(USERNAME_ATTEMPTS):
+        usernames = allocate_usernames(
+            [(user.first_name, user.last_name) for user in created]
+        )
+        for user, username in zip(created, usernames):
+            user.username = username
+        try:
+            with transaction.atomic():
+                insert_users(
+                    created, [user["team"] for user in users], groups
+                )
+            return created
+        except IntegrityError:
+            # a concurrent registration took one of the usernames
+            for user in created:
+                user.pk = None
+            if attempt == USERNAME_ATTEMPTS - 1:
+                raise
@@ -1,26 +1,55 @@
 from rest_framework import serializers
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.serializers import (
+    TokenObtainPairSerializer,
+    TokenRefreshSerializer
+)
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
 from authentication.models import User
 from django.contrib.auth.models import Group
 from .validators import Validators
-import logging
-
-login_logger = logging.getLogger("login_security")
+from .provisioning import (
+    provision_users,
+    save_with_username
+)
+from CRM.reassign import (
+    ROLES,
+    team_members
+)
 
 
 class LoginUserSerializer(TokenObtainPairSerializer):
     """
-    enable to follow connexions to API
+    tokens of the users logged in by LoginView,
+    connexions to API are logged by login.find_user
+    """
+    @classmethod
+    def get_token(cls, user):
+        """
+        the team of the user is read from the token by permissions,
+        role_version tells whether it's still the user's team
+        """
+        token = super().get_token(user)
+        token["team"] = user.get_team()
+        token["role_version"] = user.role_version
+        return token
+
+
+class RefreshUserSerializer(TokenRefreshSerializer):
+    """
+    refuses refresh tokens issued before a team change
     """
     def validate(self, attrs):
-        if User.objects.filter(username=attrs['username']).exists():
-            user = User.objects.get(username=attrs['username'])
-            login_logger.info("user %s connected to API", user)
-        else:
-            login_logger.warning("someone with username %s "
-                                 "tried to connect to API", attrs['username'])
-        data = super().validate(attrs)
-        return data
+        refresh = self.token_class(attrs["refresh"])
+        if not User.objects.filter(
+                id=refresh[api_settings.USER_ID_CLAIM],
+                role_version=refresh.get("role_version", 0)
+        ).exists():
+            raise InvalidToken(
+                "Your team has changed since this token was issued, "
+                "please log in again"
+            )
+        return super().validate(attrs)
 
 
 class UserListSerializer(serializers.ModelSerializer):
@@ -42,6 +71,20 @@ class UserListSerializer(serializers.ModelSerializer):
         ]
 
 
+class SalesContactSerializer(serializers.ModelSerializer):
+    """
+    short user representation nested in clients,
+    it doesn't need any query on groups
+    """
+    class Meta:
+        model = User
+        fields = [
+            "id",
+            "last_name",
+            "first_name",
+        ]
+
+
 class UserDetailSerializer(serializers.ModelSerializer):
     groups = serializers.SlugRelatedField(
         many=True, read_only=True, slug_field="name")
@@ -106,13 +149,9 @@ class RegisterUserSerializer(serializers.ModelSerializer):
         return data
 
     def save(self, **kwargs):
-        username = Validators.is_valid_username(
-            self.validated_data['first_name'],
-            self.validated_data['last_name'])
         user = User(
             first_name=self.validated_data['first_name'],
             last_name=self.validated_data['last_name'],
-            username=username
         )
         user.set_password(self.validated_data["password1"])
         group = Group.objects.get(name=self.validated_data["team"] + " team")
@@ -120,12 +159,49 @@ class RegisterUserSerializer(serializers.ModelSerializer):
             user.is_staff = True
         user.first_name = user.first_name.title()
         user.last_name = user.last_name.title()
-        user.save()
+        # the username is allocated again if taken meanwhile
+        save_with_username(user)
         user.groups.add(group)
-        user.save()
         return user
 
 
+def bulk_register_users(items, workers=None):
+    """
+    validates every item as RegisterUserSerializer does
+    and creates the valid ones with provision_users
+    returns, in order, the result of each item :
+    {"index", "status": 201, "user"} or {"index", "status": 400, "errors"}
+    """
+    serializers_ = [RegisterUserSerializer(data=item) for item in items]
+    results = []
+    valid = []
+    for index, serializer in enumerate(serializers_):
+        if serializer.is_valid():
+            results.append({"index": index, "status": 201})
+            valid.append({
+                "first_name": serializer.validated_data["first_name"],
+                "last_name": serializer.validated_data["last_name"],
+                "password": serializer.validated_data["password1"],
+                "team": serializer.validated_data["team"],
+            })
+        else:
+            results.append(
+                {"index": index, "status": 400, "errors": serializer.errors}
+            )
+    created = iter(provision_users(valid, workers))
+    for result in results:
+        if result["status"] == 201:
+            user = next(created)
+            result["user"] = {
+                "id": user.id,
+                "username": user.username,
+                "first_name": user.first_name,
+                "last_name": user.last_name,
+                "is_staff": user.is_staff,
+            }
+    return results
+
+
 class UpdateUserSerializer(serializers.ModelSerializer):
     password1 = serializers.CharField(required=False)
     password2 = serializers.CharField(required=False)
@@ -183,8 +259,49 @@ class UpdateUserSerializer(serializers.ModelSerializer):
 
     def update(self, instance, validated_data):
         # remove user from all groups then add to the specified group
+        previous_team = instance.get_team()
         instance.groups.clear()
         group = Group.objects.get(name=self.validated_data["team"] + " team")
         instance.groups.add(group)
+        if group.name != previous_team:
+            # tokens carrying the previous team can't be refreshed
+            instance.role_version += 1
+            instance.team = group.name
         instance = super().update(instance, validated_data)
         return instance
+
+
+class ReassignSerializer(serializers.Serializer):
+    """
+    moves the rows of role owned by the user of the context
+    to the user "to", or to the members of their team if "to" is missing
+    """
+    role = serializers.ChoiceField(choices=list(ROLES))
+    to = serializers.IntegerField(required=False)
+    dry_run = serializers.BooleanField(default=False)
+
+    def validate(self, data):
+        from_user = self.context["user"]
+        team = ROLES[data["role"]][2]
+        if "to" not in data:
+            data["to_users"] = team_members(data["role"], [from_user.id])
+            if not data["to_users"]:
+                raise serializers.ValidationError(
+                    {"to": f"Sorry, nobody else is member of {team}"}
+                )
+            return data
+        if data["to"] == from_user.id:
+            raise serializers.ValidationError(
+                {"to": "Please choose another user"}
+            )
+        to_user = User.objects.with_team().filter(id=data["to"]).first()
+        if to_user is None:
+            raise serializers.ValidationError(
+                {"to": f"Sorry, user {data['to']} doesn't exist"}
+            )
+        if to_user.get_team() != team:
+            raise serializers.ValidationError(
+                {"to": f"Sorry, user {data['to']} isn't member of {team}"}
+            )
+        data["to_users"] = [to_user.id]
+        return data
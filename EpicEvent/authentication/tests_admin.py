@@ -66,6 +66,23 @@ class TestLogin(Data):
         self.assertEqual(error.message, "Only members of management team "
                                         "are allowed to use this site.")
 
+    def test_login_throttled(self):
+        for _ in range(5):
+            self.browser.post(
+                "/admin/login/",
+                {'username': 'egeret', 'password': 'bidon'}
+            )
+        with self.assertNumQueries(0):
+            response = self.browser.post(
+                "/admin/login/",
+                {'username': 'egeret', 'password': 'toto1234'}
+            )
+        error = response.context['form'].errors.as_data()["__all__"][0]
+        self.assertEqual(
+            error.message,
+            "Too many login attempts, please retry in 60 seconds"
+        )
+
 
 class TestLogout(Data):
     def test_valid_logout(self):
@@ -135,6 +152,49 @@ class TestUsers(Data):
         self.assertEqual(User.objects.count(), users_count + 1)
         self.assertEqual(User.objects.last().last_name, 'Luke')
 
+    def test_change_user_team_bumps_role_version(self):
+        self.browser.login(username='egeret', password='toto1234')
+        user = self.support_user
+        self.browser.post(
+            f"/admin/authentication/user/{user.id}/change/",
+            data={
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'username': user.username,
+                'groups': self.sales_group.id
+            }, follow=True
+        )
+        user.refresh_from_db()
+        self.assertEqual(user.get_team(), "Sales team")
+        self.assertEqual(user.role_version, 1)
+
+    def test_spread_book_across_team(self):
+        self.browser.login(username='egeret', password='toto1234')
+        response = self.browser.post("/admin/authentication/user/", data={
+            'action': 'spread_book_across_team',
+            '_selected_action': [self.sales_user.id, self.support_user.id],
+        }, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(
+            Client.objects.filter(sales_contact=self.sales_user).exists()
+        )
+        self.assertFalse(
+            Event.objects.filter(support_contact=self.support_user).exists()
+        )
+
+    def test_count_book(self):
+        self.browser.login(username='egeret', password='toto1234')
+        count = Client.objects.filter(sales_contact=self.sales_user).count()
+        response = self.browser.post("/admin/authentication/user/", data={
+            'action': 'count_book',
+            '_selected_action': [self.sales_user.id],
+        }, follow=True)
+        self.assertContains(response, f"{count} clients would be spread")
+        self.assertEqual(
+            Client.objects.filter(sales_contact=self.sales_user).count(),
+            count
+        )
+
     def test_created_user_must_belong_to_a_group(self):
         self.browser.login(username='egeret', password='toto1234')
         password_created = make_password('toto1234')
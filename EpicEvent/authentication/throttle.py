@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from authentication.cache import LRUCache
+
+login_logger = logging.getLogger("login_security")
+
+LOGIN_THROTTLE = getattr(settings, "LOGIN_THROTTLE", {})
+
+
+def take_token(bucket, capacity, refill, now):
+    """
+    a bucket is (tokens, time of the last update), a missing one is full,
+    one token comes back every refill seconds
+    returns the new bucket and 0, or the seconds to wait for a token
+    """
+    tokens, updated = bucket or (capacity, now)
+    tokens = min(capacity, tokens + (now - updated) / refill)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) * refill
+
+
+def give_token(bucket, capacity, refill, now):
+    tokens, updated = bucket or (capacity, now)
+    tokens = min(capacity, tokens + (now - updated) / refill + 1)
+    return (tokens, now), 0
+
+
+class LocMemBuckets:
+    """
+    buckets of the current process, the least recently used
+    are dropped beyond max_size
+    """
+    def __init__(self, max_size):
+        self.buckets = LRUCache(max_size=max_size, ttl=0)
+        self._lock = threading.Lock()
+
+    def update(self, key, change, ttl):
+        with self._lock:
+            bucket, result = change(self.buckets.get(key))
+            self.buckets.set(key, bucket, ttl)
+        return result
+
+    def delete(self, key):
+        self.buckets.delete(key)
+
+    def clear(self):
+        self.buckets.clear()
+
+
+class CacheBuckets:
+    """
+    buckets shared by the processes through a cache of CACHES,
+    read and written without lock: concurrent attempts from several
+    processes may get a few more tokens than the capacity
+    """
+    def __init__(self, alias):
+        self.alias = alias
+
+    def update(self, key, change, ttl):
+        cache = caches[self.alias]
+        bucket, result = change(cache.get(key))
+        cache.set(key, bucket, math.ceil(ttl))
+        return result
+
+    def delete(self, key):
+        caches[self.alias].delete(key)
+
+    def clear(self):
+        pass
+
+
+class LoginThrottle:
+    """
+    token buckets of login attempts, one per username and one per ip,
+    taken before the user is read or the password hashed
+    a successful login fills the bucket of the username again
+    and gives its token back to the bucket of the ip
+    """
+    def __init__(self, buckets, username_rule, ip_rule):
+        self.buckets = buckets
+        # (capacity, refill): attempts in a burst, seconds per attempt
+        self.rules = {"username": username_rule, "ip": ip_rule}
+
+    @classmethod
+    def from_settings(cls, config):
+        if config.get("BACKEND", "locmem") == "cache":
+            buckets = CacheBuckets(config.get("ALIAS", "default"))
+        else:
+            buckets = LocMemBuckets(config.get("MAX_SIZE", 10000))
+        username = config.get("USERNAME", {})
+        ip = config.get("IP", {})
+        return cls(
+            buckets,
+            (username.get("CAPACITY", 5), username.get("REFILL", 60)),
+            (ip.get("CAPACITY", 20), ip.get("REFILL", 6)),
+        )
+
+    @staticmethod
+    def key(kind, value):
+        digest = hashlib.sha256(value.lower().encode()).hexdigest()
+        return f"login-throttle:{kind}:{digest}"
+
+    def apply(self, kind, value, function):
+        capacity, refill = self.rules[kind]
+        now = time.time()
+        return self.buckets.update(
+            self.key(kind, value),
+            lambda bucket: function(bucket, capacity, refill, now),
+            # time for an empty bucket to be full, it's then forgotten
+            capacity * refill,
+        )
+
+    def attempt(self, username, ip):
+        """
+        takes a token for username and for ip
+        returns 0, or the seconds to wait before the next attempt
+        """
+        wait = self.apply("username", username, take_token)
+        if wait:
+            return wait
+        wait = self.apply("ip", ip, take_token)
+        if wait:
+            self.apply("username", username, give_token)
+        return wait
+
+    def succeeded(self, username, ip):
+        self.buckets.delete(self.key("username", username))
+        self.apply("ip", ip, give_token)
+
+
+def client_ip(request):
+    """
+    REMOTE_ADDR, or behind PROXY_COUNT proxies the address
+    the first of them received the request from
+    """
+    proxies = LOGIN_THROTTLE.get("PROXY_COUNT", 0)
+    forwarded = request.META.get("HTTP_X_FORWARDED_FOR")
+    if proxies and forwarded:
+        addresses = [address.strip() for address in forwarded.split(",")]
+        return addresses[-min(proxies, len(addresses))]
+    return request.META.get("REMOTE_ADDR", "")
+
+
+login_throttle = LoginThrottle.from_settings(LOGIN_THROTTLE)
+use_login_throttle = LOGIN_THROTTLE.get("ENABLED", True)
@@ -1,5 +1,4 @@
 from django.core.exceptions import ValidationError
-from authentication.models import User
 
 
 class Validators:
@@ -63,25 +62,3 @@ class Validators:
         if due.date() < created.date():
             raise ValidationError(
                 "Payment due date can't be prior to creation date")
-
-    @staticmethod
-    def is_valid_username(first_name, last_name):
-        # set the username from first_name and last_name
-        # it's the lower first(s) letter(s) of first_name
-        # completed with the lower last_name
-        # if this username already exists, a number is added, starting from 2
-        initials = ''.join([name[0] for name in first_name.split("-")])
-        initials = initials.lower()
-        last_name = last_name.lower()
-        counter = 2
-        if User.objects.filter(username=initials + last_name).exists():
-            while True:
-                if User.objects.filter(
-                        username=initials + last_name + str(counter)).exists():
-                    counter += 1
-                else:
-                    break
-            username = initials + last_name + str(counter)
-        else:
-            username = initials + last_name
-        return username
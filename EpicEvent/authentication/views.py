@@ -1,33 +1,135 @@
-from rest_framework import serializers
+from rest_framework import status
+from rest_framework.decorators import action
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.views import TokenViewBase
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import update_last_login
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from .login import (
+    TooManyLogins,
+    authenticate,
+    login_logger
+)
 from .models import User
-from CRM.models import (
-    Client,
-    Event
+from .throttle import (
+    client_ip,
+    login_throttle,
+    use_login_throttle
+)
+import json
+import math
+from CRM.pagination import UserCursorPagination
+from CRM.reassign import (
+    OWNED_COUNT_LIMIT,
+    owned_counts,
+    reassign
 )
 from .serializers import (
     UserListSerializer,
     UserDetailSerializer,
     RegisterUserSerializer,
     UpdateUserSerializer,
-    LoginUserSerializer
-)
-from CRM.permissions import (
-    IsAuthenticated,
-    IsManagementTeam
+    LoginUserSerializer,
+    RefreshUserSerializer,
+    ReassignSerializer,
+    bulk_register_users
 )
+from CRM.permissions import PermissionMatrixMixin
+from CRM.serializers import multi_status
+from CRM.profiling import ProfilingMixin
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class LoginView(View):
+    """
+    gives a refresh and an access token for a username and a password,
+    as TokenObtainPairView, served asynchronously under asgi.py:
+    the password is checked by the threads of login.password_pool,
+    the workers keep serving the other requests meanwhile
+    attempts beyond LOGIN_THROTTLE are refused before any query
+    """
+    credentials = ("username", "password")
+
+    async def post(self, request):
+        if request.content_type == "application/json":
+            try:
+                data = json.loads(request.body or b"{}")
+            except ValueError:
+                return JsonResponse(
+                    {"detail": "JSON parse error"}, status=400
+                )
+            if not isinstance(data, dict):
+                data = {}
+        else:
+            data = request.POST
+        errors = {
+            field: ["This field is required."]
+            for field in self.credentials
+            if not data.get(field) or not isinstance(data.get(field), str)
+        }
+        if errors:
+            return JsonResponse(errors, status=400)
+        ip = client_ip(request)
+        if use_login_throttle:
+            wait = await sync_to_async(login_throttle.attempt)(
+                data["username"], ip
+            )
+            if wait:
+                login_logger.warning(
+                    "login of %s from %s throttled", data["username"], ip
+                )
+                response = JsonResponse(
+                    {
+                        "detail":
+                            "Too many login attempts, please retry "
+                            f"in {math.ceil(wait)} seconds"
+                    },
+                    status=429
+                )
+                response["Retry-After"] = str(math.ceil(wait))
+                return response
+        try:
+            user = await authenticate(data["username"], data["password"])
+        except TooManyLogins:
+            response = JsonResponse(
+                {"detail": "Too many logins in progress, please retry"},
+                status=503
+            )
+            response["Retry-After"] = "1"
+            return response
+        if user is None:
+            return JsonResponse(
+                {
+                    "detail":
+                        "No active account found with the given credentials"
+                },
+                status=401
+            )
+        if use_login_throttle:
+            await sync_to_async(login_throttle.succeeded)(
+                data["username"], ip
+            )
+        refresh = LoginUserSerializer.get_token(user)
+        if api_settings.UPDATE_LAST_LOGIN:
+            await sync_to_async(update_last_login)(None, user)
+        return JsonResponse(
+            {"refresh": str(refresh), "access": str(refresh.access_token)}
+        )
 
 
-class TokenObtainPairView(TokenViewBase):
-    serializer_class = LoginUserSerializer
+class TokenRefreshView(TokenViewBase):
+    serializer_class = RefreshUserSerializer
 
 
-class UserViewset(ModelViewSet):
-    permission_classes = [IsAuthenticated, IsManagementTeam]
+class UserViewset(ProfilingMixin, PermissionMatrixMixin, ModelViewSet):
+    pagination_class = UserCursorPagination
 
     def create(self, request):
         """override create function to custom response so that
@@ -50,32 +152,81 @@ class UserViewset(ModelViewSet):
         else:
             return Response(serializer.errors)
 
-    def perform_destroy(self, instance):
-        if Client.objects.filter(sales_contact=instance).exists():
-            clients = Client.objects.filter(sales_contact=instance)
-            raise serializers.ValidationError(
+    def destroy(self, request, *args, **kwargs):
+        instance = self.get_object()
+        counts = owned_counts(instance)
+        if any(counts.values()):
+            owned = {
+                name: f"more than {OWNED_COUNT_LIMIT}"
+                if count > OWNED_COUNT_LIMIT else count
+                for name, count in counts.items()
+            }
+            return Response(
                 {
                     "Unauthorized delete":
                         "This user is sales contact "
-                        "for the following clients : "
-                        f"{[client for client in clients]}. "
-                        "You must change these clients sales contact "
-                        "prior to delete this user."
+                        f"for {owned['clients']} clients "
+                        "and support contact "
+                        f"for {owned['events']} events. "
+                        "You must reassign them "
+                        f"(POST /crm/users/{instance.id}/reassign/) "
+                        "prior to delete this user.",
+                    **owned
                 },
+                status=status.HTTP_400_BAD_REQUEST
             )
-        if Event.objects.filter(support_contact=instance).exists():
-            events = Event.objects.filter(support_contact=instance)
-            raise serializers.ValidationError(
+        self.perform_destroy(instance)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    # items of a bulk creation
+    bulk_create_max_items = 1000
+
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        """
+        creates a json array of users as create does,
+        passwords being hashed in parallel,
+        the response gives the result of each item
+        """
+        if (not isinstance(request.data, list)
+                or not 0 < len(request.data) <= self.bulk_create_max_items):
+            return Response(
                 {
-                    "Unauthorized delete":
-                        "This user is support for the following events : "
-                        f"{[event for event in events]}. "
-                        "You must change these events support contact "
-                        "prior to delete this user."
+                    "detail":
+                        "Please send a list of 1 to "
+                        f"{self.bulk_create_max_items} users"
                 },
+                status=status.HTTP_400_BAD_REQUEST
             )
-        else:
-            instance.delete()
+        results = bulk_register_users(request.data)
+        return Response(
+            results, status=multi_status(results, status.HTTP_201_CREATED)
+        )
+
+    @action(detail=True, methods=["post"])
+    def reassign(self, request, pk=None):
+        """
+        moves the clients (role sales_contact) or the events
+        (role support_contact) of the user to the user "to",
+        or spreads them over the other members of their team
+        e.g. {"role": "sales_contact", "to": 12, "dry_run": true}
+        """
+        user = self.get_object()
+        serializer = ReassignSerializer(
+            data=request.data, context={"user": user}
+        )
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        count = reassign(
+            data["role"], [user.id], data["to_users"], data["dry_run"]
+        )
+        return Response({
+            "role": data["role"],
+            "from": user.id,
+            "to": data["to_users"],
+            "dry_run": data["dry_run"],
+            "count": count,
+        })
 
     def get_serializer(self, *args, **kwargs):
         if self.request.method == "PUT":
@@ -92,7 +243,8 @@ class UserViewset(ModelViewSet):
 
     def get_queryset(self):
         if not self.request.parser_context["kwargs"]:
-            return User.objects.all()
+            # groups of every user of the page in one query
+            return User.objects.prefetch_related("groups")
 
         else:
             user_pk = self.request.parser_context["kwargs"]["pk"]